@@ -2,6 +2,8 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from rest_framework.exceptions import ValidationError
 from accounts.models import UserProfile
+from accounts.services import UserService
+from utils.serializers import PrefetchListSerializer
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -21,9 +23,14 @@ class UserSerializerWithProfile(UserSerializer):
             return obj.profile.avatar.url
         return None
 
+    def prefetch_through_cache(self, users):
+        # 被嵌套在一页 tweets/comments 等里面的时候, 把所有用户的 profile 一次取出来
+        UserService.prefetch_profiles_through_cache(users)
+
     class Meta:
         model = User
         fields = ('id', 'username', 'nickname', 'avatar_url')
+        list_serializer_class = PrefetchListSerializer
 
 
 class UserProfileSerializerForUpdate(serializers.ModelSerializer):
@@ -48,6 +55,10 @@ class UserSerializerForLike(UserSerializerWithProfile):
     pass
 
 
+class UserSerializerForNotification(UserSerializerWithProfile):
+    pass
+
+
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField()
@@ -1,7 +1,9 @@
 from accounts.models import UserProfile
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import caches
 from twitter.cache import USER_PROFILE_PATTERN
+from utils.identity_map import IdentityMap
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -10,6 +12,18 @@ class UserService:
 
     @classmethod
     def get_profile_through_cache(cls, user_id):
+        # 同一个请求里已经取过的 profile 直接从 identity map 里拿
+        profile = IdentityMap.get(UserProfile, user_id)
+        if profile is None:
+            profile = IdentityMap.add(
+                UserProfile,
+                user_id,
+                cls._get_profile_through_cache(user_id),
+            )
+        return profile
+
+    @classmethod
+    def _get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
 
         # read from cache first
@@ -23,7 +37,81 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_cached_profiles(cls, user_ids):
+        # 一次 get_many 从 memcached 里拿到所有用户的 profile, 返回 {user_id: profile}
+        keys = {USER_PROFILE_PATTERN.format(user_id=user_id): user_id for user_id in user_ids}
+        return {
+            keys[key]: profile
+            for key, profile in cache.get_many(keys.keys()).items()
+        }
+
+    @classmethod
+    def load_profiles_to_cache(cls, user_ids):
+        profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=user_ids)
+        }
+        # 还没有 profile 的用户一次性批量创建, 不然渲染的时候每个用户都要 get_or_create 一次
+        # 别的请求可能同时在创建, 撞上 unique index 的直接忽略, 再查一次拿到数据库里的那个
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in profiles]
+        if missing_user_ids:
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=user_id) for user_id in missing_user_ids],
+                ignore_conflicts=True,
+            )
+            profiles.update({
+                profile.user_id: profile
+                for profile in UserProfile.objects.filter(user_id__in=missing_user_ids)
+            })
+        cache.set_many({
+            USER_PROFILE_PATTERN.format(user_id=user_id): profile
+            for user_id, profile in profiles.items()
+        })
+        return profiles
+
+    @classmethod
+    def _set_prefetched_profiles(cls, users, profiles):
+        for user in users:
+            if user.id in profiles:
+                setattr(user, '_cached_user_profile', profiles[user.id])
+
+    @classmethod
+    def prefetch_profiles_through_cache(cls, users):
+        # 一次 get_many 拿到这一页所有用户的 profile, 存到 user 上, 之后访问 user.profile 就不用再查了
+        users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        profiles = IdentityMap.get_many(UserProfile, [user.id for user in users])
+        loaded_profiles = cls.get_cached_profiles([
+            user.id for user in users if user.id not in profiles
+        ])
+        missing_user_ids = [
+            user.id for user in users
+            if user.id not in profiles and user.id not in loaded_profiles
+        ]
+        if missing_user_ids:
+            loaded_profiles.update(cls.load_profiles_to_cache(missing_user_ids))
+        profiles.update(IdentityMap.add_many(UserProfile, loaded_profiles))
+        cls._set_prefetched_profiles(users, profiles)
+
+    @classmethod
+    async def prefetch_profiles_through_cache_async(cls, users):
+        # async 版本, 读 memcached 放到线程池里, cache miss 的时候在 django 的同步线程里查数据库
+        users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        profiles = IdentityMap.get_many(UserProfile, [user.id for user in users])
+        loaded_profiles = await sync_to_async(cls.get_cached_profiles, thread_sensitive=False)([
+            user.id for user in users if user.id not in profiles
+        ])
+        missing_user_ids = [
+            user.id for user in users
+            if user.id not in profiles and user.id not in loaded_profiles
+        ]
+        if missing_user_ids:
+            loaded_profiles.update(await sync_to_async(cls.load_profiles_to_cache)(missing_user_ids))
+        profiles.update(IdentityMap.add_many(UserProfile, loaded_profiles))
+        cls._set_prefetched_profiles(users, profiles)
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+        IdentityMap.discard(UserProfile, user_id)
@@ -0,0 +1,51 @@
+from bisect import bisect_left
+
+from rest_framework.response import Response
+from utils.paginations import KeysetPagination
+
+
+class CommentPagination(KeysetPagination):
+    # 评论和 tweets 不一样, 是按照 (created_at, id) 正序排列的, 最早的评论在最前面
+    # 向下翻页用 ?cursor=<next_cursor>, 返回这个 cursor 之后的评论
+    # 新的评论总是加在最后面, 翻到最后一页就能看到, 所以不需要下拉刷新
+
+    def get_cursor(self, request):
+        if 'cursor' not in request.query_params:
+            return None
+        return self.decode_cursor(request.query_params['cursor'])
+
+    def paginate_ordered_list(self, ordered_list, request):
+        cursor = self.get_cursor(request)
+        start = 0
+        if cursor is not None:
+            start = bisect_left(
+                ordered_list,
+                True,
+                key=lambda obj: self.is_newer(obj, cursor, self.tiebreaker),
+            )
+        self.has_next_page = len(ordered_list) > start + self.page_size
+        return self._set_cursors(ordered_list[start: start + self.page_size])
+
+    def is_refreshing(self, request):
+        # cache 里是最早的 REDIS_LIST_LENGTH_LIMIT 个评论, 没有下拉刷新的情况
+        return False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if type(queryset) == list:
+            return self.paginate_ordered_list(queryset, request)
+
+        cursor = self.get_cursor(request)
+        queryset = queryset.order_by('created_at', self.tiebreaker)
+        if cursor is not None:
+            queryset = self.filter_newer_than(queryset, cursor, self.tiebreaker)
+        # 多取一个用来判断是否还有下一页
+        objects = list(queryset[:self.page_size + 1])
+        self.has_next_page = len(objects) > self.page_size
+        return self._set_cursors(objects[:self.page_size])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor if self.has_next_page else None,
+            'comments': data,
+        })
@@ -1,13 +1,16 @@
 from rest_framework import serializers
 from accounts.api.serializers import UserSerializerForComment
+from django.contrib.auth.models import User
 from rest_framework.exceptions import ValidationError
 from comments.models import Comment
 from tweets.models import Tweet
-from likes.services import LikeService
+from likes.api.serializers import HasLikedMixin
+from utils.redis_counters import RedisCounters
+from utils.serializers import PrefetchListSerializer, PrefetchThroughCacheMixin
 
 
-class CommentSerializer(serializers.ModelSerializer):
-    user = UserSerializerForComment()
+class CommentSerializer(HasLikedMixin, PrefetchThroughCacheMixin, serializers.ModelSerializer):
+    user = UserSerializerForComment(source='cached_user')
     has_liked = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
 
@@ -23,12 +26,12 @@ class CommentSerializer(serializers.ModelSerializer):
             "likes_count",
             "has_liked",
         )
-
-    def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_user': (User, 'user_id')}
+        cached_counts = ('likes_count', )
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        return RedisCounters.get_count(obj, 'likes_count')
 
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
@@ -1,7 +1,12 @@
 from comments.models import Comment
+from comments.services import CommentService
 from django.utils import timezone
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from twitter.cache import CACHE_INVALIDATED_PATTERN, TWEET_COMMENTS_PATTERN
+from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 
 COMMENT_URL = '/api/comments/'
 COMMENT_DETAIL_URL = '/api/comments/{}/'
@@ -54,6 +59,100 @@ class CommentApiTests(TestCase):
         })
         self.assertEqual(len(response.data['comments']), 2)
 
+    def test_pagination(self):
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.dongxie, self.tweet, str(i))
+            for i in range(page_size * 2 + 3)
+        ]
+        # 所有评论的 created_at 都一样, 靠 id 区分先后
+        Comment.objects.filter(tweet=self.tweet).update(
+            created_at=comments[0].created_at,
+        )
+        self.clear_cache()
+
+        for i in range(2):
+            # 第一次是从数据库里读, 第二次是从 redis 里读
+            results, params = [], {'tweet_id': self.tweet.id}
+            while True:
+                response = self.anonymous_client.get(COMMENT_URL, params)
+                self.assertEqual(response.status_code, 200)
+                results.extend(response.data['comments'])
+                if not response.data['has_next_page']:
+                    self.assertEqual(response.data['next_cursor'], None)
+                    break
+                self.assertEqual(len(response.data['comments']), page_size)
+                params['cursor'] = response.data['next_cursor']
+            self.assertEqual(
+                [comment['id'] for comment in results],
+                [comment.id for comment in comments],
+            )
+
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'cursor': 'invalid cursor',
+        })
+        self.assertEqual(response.status_code, 404)
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cached_comments(self):
+        comment = self.create_comment(self.linghu, self.tweet, 'original')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=self.tweet.id)
+        conn = RedisClient.get_connection()
+
+        def get_contents():
+            response = self.anonymous_client.get(COMMENT_URL, {
+                'tweet_id': self.tweet.id,
+            })
+            return [comment['content'] for comment in response.data['comments']]
+
+        self.assertEqual(get_contents(), ['original'])
+        self.assertEqual(conn.exists(key), 1)
+        with self.assertNumQueries(0):
+            comments = CommentService.get_cached_comments(self.tweet.id)
+        self.assertEqual([c.id for c in comments], [comment.id])
+
+        # 修改评论之后 cache 被删掉了, 下一次读的时候重建
+        self.linghu_client.put(COMMENT_DETAIL_URL.format(comment.id), {
+            'content': 'new',
+        })
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(get_contents(), ['new'])
+        self.assertEqual(conn.exists(key), 1)
+
+        # 新建评论
+        response = self.dongxie_client.post(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'content': 'second',
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(get_contents(), ['new', 'second'])
+
+        # 删除评论
+        self.linghu_client.delete(COMMENT_DETAIL_URL.format(comment.id))
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(get_contents(), ['second'])
+
+    def test_rebuild_started_before_invalidation(self):
+        self.create_comment(self.linghu, self.tweet, 'original')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=self.tweet.id)
+        conn = RedisClient.get_connection()
+        queryset = CommentService.get_comments_queryset(self.tweet.id)
+
+        # 重建读完数据库之后, 写回 cache 之前评论被修改了, 读到的数据不会写进去
+        invalidated = conn.get(CACHE_INVALIDATED_PATTERN.format(key=key))
+        objects = list(queryset)
+        self.create_comment(self.dongxie, self.tweet, 'second')
+        RedisHelper._load_objects_to_cache(key, objects, queryset, invalidated)
+        self.assertEqual(conn.exists(key), 0)
+
+        # 作废之后才开始的重建可以写进去
+        invalidated = conn.get(CACHE_INVALIDATED_PATTERN.format(key=key))
+        RedisHelper._load_objects_to_cache(key, list(queryset.all()), queryset, invalidated)
+        self.assertEqual(conn.llen(key), 2)
+
     def test_create(self):
         # 匿名不可以创建
         response = self.anonymous_client.post(COMMENT_URL)
@@ -1,11 +1,14 @@
 from utils.permissions import IsObjectOwner
 from comments.models import Comment
+from comments.api.paginations import CommentPagination
+from comments.services import CommentService
 from comments.api.serializers import (
     CommentSerializer,
     CommentSerializerForCreate,
     CommentSerializerForUpdate,
 )
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
@@ -13,6 +16,22 @@ from utils.decorators import required_params
 from inbox.services import NotificationService
 
 
+def get_comments_page(paginator, request, tweet_id):
+    # 热门 tweet 可能有很多评论, 不能一次全部返回, 按照时间正序翻页
+    # 前面几页从 redis 里取, 翻到 cache 之外的时候再去数据库里查
+    # /api/tweets/1/comments/ 也是用这个函数取一页评论
+    comments = paginator.paginate_cached_list(
+        lambda limit: CommentService.get_cached_comments(tweet_id, limit),
+        request,
+    )
+    if comments is None:
+        comments = paginator.paginate_queryset(
+            CommentService.get_comments_queryset(tweet_id),
+            request,
+        )
+    return comments
+
+
 class CommentsViewSet(viewsets.GenericViewSet):
     """
     只实现 list, create, update, destroy方法
@@ -21,6 +40,7 @@ class CommentsViewSet(viewsets.GenericViewSet):
     queryset = Comment.objects.all()
     # 这里是为django_filters定义的 filter
     filterset_fields = ('tweet_id',) # 我可以根据 tweet_id 去 filter comments 的 queryset
+    pagination_class = CommentPagination
 
     def get_permissions(self):
         if self.action == "create":
@@ -43,22 +63,25 @@ class CommentsViewSet(viewsets.GenericViewSet):
         # }, status=status.HTTP_200_OK)
 
         # 这里引入了 django-filter 的包,
-        queryset = self.get_queryset() # 这里是所有的 tweets
+        # queryset = self.get_queryset() # 这里是所有的 tweets
         # 这里调用了 django_filters 中的filterset_fields
         # 它会自动到 request.query_params中去找有没有参数是 filterset_fields中定义的 field
         # 有的化就返回查询结果
-        comments = self.filter_queryset(queryset)\
-            .prefetch_related('user')\
-            .order_by('created_at')
+        # comments = self.filter_queryset(queryset)\
+        #     .prefetch_related('user')\
+        #     .order_by('created_at')
 
+        try:
+            tweet_id = int(request.query_params['tweet_id'])
+        except ValueError:
+            raise ValidationError({'tweet_id': 'A valid integer is required.'})
+        comments = get_comments_page(self.paginator, request, tweet_id)
         serializer = CommentSerializer(
             comments,
             context={'request': request},
             many=True,
         )
-        return Response({
-            'comments': serializer.data,
-        }, status=status.HTTP_200_OK)
+        return self.get_paginated_response(serializer.data)
 
     def create(self, request, *args, **kwargs):
         data = {
@@ -0,0 +1,18 @@
+def incr_comments_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from tweets.models import Tweet
+    from utils.redis_counters import RedisCounters
+    RedisCounters.incr(Tweet, instance.tweet_id, 'comments_count')
+
+
+def decr_comments_count(sender, instance, **kwargs):
+    from tweets.models import Tweet
+    from utils.redis_counters import RedisCounters
+    RedisCounters.decr(Tweet, instance.tweet_id, 'comments_count')
+
+
+def invalidate_cached_comments(sender, instance, **kwargs):
+    from comments.services import CommentService
+    CommentService.invalidate_cached_comments(instance.tweet_id)
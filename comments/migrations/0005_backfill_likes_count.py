@@ -0,0 +1,50 @@
+# Generated by Django 3.2 on 2026-10-18 19:00
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# 0004 加上 likes_count 的时候默认值是 0, 已经有的评论需要从 Like 表里数一遍
+# 和 tweets 的 0007 一样按照主键分批 update, 要在新代码开始写 redis 计数器之前跑完
+BATCH_SIZE = 1000
+
+
+def backfill_likes_count(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    Like = apps.get_model('likes', 'Like')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    content_type = ContentType.objects.filter(app_label='comments', model='comment').first()
+    # 新建的数据库里 content type 还没有创建, 也就不会有点赞
+    if content_type is None:
+        return
+    likes_count = Coalesce(Subquery(
+        Like.objects.filter(
+            content_type_id=content_type.id,
+            object_id=OuterRef('id'),
+        ).order_by().values('object_id').annotate(
+            count=Count('id'),
+        ).values('count'),
+    ), 0)
+
+    last_id = 0
+    while True:
+        comment_ids = list(Comment.objects.filter(
+            id__gt=last_id,
+        ).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not comment_ids:
+            return
+        Comment.objects.filter(id__in=comment_ids).update(likes_count=likes_count)
+        last_id = comment_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_comment_likes_count'),
+        ('likes', '0003_alter_like_id'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_likes_count, migrations.RunPython.noop),
+    ]
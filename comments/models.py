@@ -1,6 +1,13 @@
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    invalidate_cached_comments,
+)
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils.functional import cached_property
 from likes.models import Like
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
@@ -13,6 +20,9 @@ class Comment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # 和 Tweet 一样, 反范式化存储的点赞数
+    likes_count = models.IntegerField(default=0, null=True)
+
     class Meta:
         # 根据某一条 tweet 筛选, 然后降序
         index_together = (('tweet', 'created_at'), )
@@ -24,7 +34,7 @@ class Comment(models.Model):
             object_id=self.id,
         ).order_by('-created_at')
 
-    @property
+    @cached_property
     def cached_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
@@ -36,3 +46,9 @@ class Comment(models.Model):
             self.tweet_id,
         )
 
+
+post_save.connect(incr_comments_count, sender=Comment)
+post_delete.connect(decr_comments_count, sender=Comment)
+# 新建, 修改, 删除评论之后, redis 里 cache 的评论都要作废
+post_save.connect(invalidate_cached_comments, sender=Comment)
+post_delete.connect(invalidate_cached_comments, sender=Comment)
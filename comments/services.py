@@ -0,0 +1,23 @@
+from comments.models import Comment
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_helper import RedisHelper
+
+
+class CommentService:
+
+    @classmethod
+    def get_comments_queryset(cls, tweet_id):
+        # 评论是按照时间正序展示的, 用的是 (tweet, created_at) 的联合索引
+        return Comment.objects.filter(tweet_id=tweet_id).order_by('created_at', 'id')
+
+    @classmethod
+    def get_cached_comments(cls, tweet_id, limit=None):
+        # 热门 tweet 的每个读者都要看第一页评论, 放在 redis 里, 不用每次都去数据库里查
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects(key, cls.get_comments_queryset(tweet_id), limit)
+
+    @classmethod
+    def invalidate_cached_comments(cls, tweet_id):
+        # 新的评论加在 list 的最后面, 修改和删除要改 list 的中间, 都没法直接 push, 所以直接删掉
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        RedisHelper.invalidate(key)
@@ -1,5 +1,6 @@
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from utils.paginations import KeysetPagination
 
 
 class FriendshipPagination(PageNumberPagination):
@@ -13,7 +14,48 @@ class FriendshipPagination(PageNumberPagination):
     # 允许客户端指定的最大 page_size 是多少
     max_page_size = 20
 
+    # 有两种翻页方式:
+    # 1. 默认按照页码翻页 (?page=3), 会返回精确的总数和总页数, 已有的客户端拿到的格式不变
+    #    但是每一页都要 COUNT(*) 一遍, 再 OFFSET 扫过前面所有页, 粉丝有几百万的时候会非常慢
+    # 2. 带了 ?mode=cursor 或者 ?cursor=<next_cursor> 参数的, 用 cursor 翻页
+    #    用的是 (to_user_id, created_at) 和 (from_user_id, created_at) 的联合索引, 每一页都一样快
+    #    总数是 cache 里的近似值, 由 view 的 get_approximate_count 提供
+    cursor_query_param = 'cursor'
+    mode_query_param = 'mode'
+
+    def __init__(self):
+        super(FriendshipPagination, self).__init__()
+        self.cursor_paginator = None
+        self.view = None
+
+    def is_cursor_mode(self, request):
+        return (
+            self.cursor_query_param in request.query_params
+            or request.query_params.get(self.mode_query_param) == 'cursor'
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        if not self.is_cursor_mode(request):
+            self.cursor_paginator = None
+            return super(FriendshipPagination, self).paginate_queryset(
+                queryset,
+                request,
+                view,
+            )
+        self.cursor_paginator = KeysetPagination()
+        self.cursor_paginator.page_size = self.get_page_size(request)
+        return self.cursor_paginator.paginate_queryset(queryset, request, view)
+
     def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            paginator = self.cursor_paginator
+            return Response({
+                'approximate_total_results': self.view.get_approximate_count(),
+                'has_next_page': paginator.has_next_page,
+                'next_cursor': paginator.next_cursor if paginator.has_next_page else None,
+                'results': data,
+            })
         return Response({
             'total_results': self.page.paginator.count,
             'total_pages': self.page.paginator.num_pages,
@@ -21,5 +63,3 @@ class FriendshipPagination(PageNumberPagination):
             'has_next_page': self.page.has_next(),
             'results': data,
         })
-
-
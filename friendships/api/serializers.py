@@ -1,26 +1,38 @@
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from accounts.api.serializers import UserSerializerForFriendship
+from django.contrib.auth.models import User
 from friendships.services import FriendshipService
 from friendships.models import Friendship
+from utils.serializers import PrefetchListSerializer, PrefetchThroughCacheMixin
 
 
 class FollowingUserIdSetMixin:
+    # 列表里的每个用户, 当前登录的用户有没有关注
+    # 渲染一页之前用 smismember 把这一页的 id 一起查出来, 不用把当前用户关注的人的整个 set 读出来
+    # Meta.followed_user_id_attname 是列表里的用户的 id 在 object 上的字段名
 
-    @property
-    def following_user_id_set(self: serializers.ModelSerializer):
+    def prefetch_through_cache(self, objects):
+        super().prefetch_through_cache(objects)
+        self._cached_followed_user_ids = self.get_followed_user_ids(objects)
+
+    def get_followed_user_ids(self, objects):
         if self.context['request'].user.is_anonymous:
-            return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
+            return set()
+        return FriendshipService.get_followed_user_ids(
             self.context['request'].user.id,
+            [getattr(obj, self.Meta.followed_user_id_attname) for obj in objects],
         )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
+
+    def get_has_followed(self, obj):
+        # 不是列表 (比如 follow 之后返回的那一个) 的时候没有 prefetch, 只查这一个
+        followed_user_ids = getattr(self, '_cached_followed_user_ids', None)
+        if followed_user_ids is None:
+            followed_user_ids = self.get_followed_user_ids([obj])
+        return getattr(obj, self.Meta.followed_user_id_attname) in followed_user_ids
 
 
-class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
+class FollowerSerializer(FollowingUserIdSetMixin, PrefetchThroughCacheMixin, serializers.ModelSerializer):
     # 需要显示 user 的详细信息
     # 这里的 source 可以从 model 中去取字段, 实际的字段名是 from_user
     user = UserSerializerForFriendship(source='cached_from_user')
@@ -29,35 +41,23 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship  # 实例化的入参
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_from_user': (User, 'from_user_id')}
+        followed_user_id_attname = 'from_user_id'
         # 这里只是key 名, 默认会从Serializer的定义中取找,
         # 如果没有找到, 才会去 model Friendship 的字段中去找
     # 因为只是展示数据, 不需要校验
 
-    def get_has_followed(self, obj):
-        if self.context['request'].user.is_anonymous:
-            return False
-
-        # TODO: 这里对每一个好友列表中的人都做了一次查询, 后续需要优化
-        # return FriendshipService.has_followed(self.context['request'].user, obj.from_user)
-        return obj.from_user_id in self.following_user_id_set
-
-class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
+class FollowingSerializer(FollowingUserIdSetMixin, PrefetchThroughCacheMixin, serializers.ModelSerializer):
     user = UserSerializerForFriendship(source='cached_to_user')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
-
-    def get_has_followed(self, obj):
-        if self.context['request'].user.is_anonymous:
-            return False
-
-        # # <TODO> 这个部分会对每个 object 都去执行一次 SQL 查询，速度会很慢，如何优化呢？
-        # # 我们将在后序的课程中解决这个问题
-        # return FriendshipService.has_followed(self.context['request'].user,
-        #                                       obj.to_user)
-        return obj.to_user_id in self.following_user_id_set
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_to_user': (User, 'to_user_id')}
+        followed_user_id_attname = 'to_user_id'
 
 class FriendshipSerialierForCreate(serializers.ModelSerializer):
     # 需要检测 to_user是否存在
@@ -1,7 +1,12 @@
+from unittest import mock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from testing.testcases import TestCase
 from rest_framework.test import APIClient
 from friendships.models import Friendship
 from friendships.api.paginations import FriendshipPagination
+from utils.redis_set import RedisSet
 
 
 FOLLOW_URL = '/api/friendships/{}/follow/'
@@ -186,7 +191,9 @@ class FriendshipApiTests(TestCase):
             self.assertEqual(result['has_followed'], False)
 
         # dongxie has followed users with even id
-        response = self.dongxie_client.get(url, {'page': 1})
+        # 只判断这一页的用户, 不会把 dongxie 关注的人的整个 set 读出来
+        with mock.patch.object(RedisSet, 'get_members', side_effect=AssertionError):
+            response = self.dongxie_client.get(url, {'page': 1})
         for result in response.data['results']:
             has_followed = (result['user']['id'] % 2 == 0)
             self.assertEqual(result['has_followed'], has_followed)
@@ -196,6 +203,66 @@ class FriendshipApiTests(TestCase):
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], True)
 
+    def test_cursor_pagination(self):
+        page_size = FriendshipPagination.page_size
+        users = [
+            self.create_user('linghu_friend{}'.format(i))
+            for i in range(page_size * 2 + 3)
+        ]
+        for user in users:
+            Friendship.objects.create(from_user=user, to_user=self.linghu)
+            Friendship.objects.create(from_user=self.linghu, to_user=user)
+        # created_at 都一样的时候也不会漏掉或者重复
+        Friendship.objects.update(created_at=Friendship.objects.first().created_at)
+        expected_ids = [user.id for user in reversed(users)]
+
+        for url in [
+            FOLLOWERS_URL.format(self.linghu.id),
+            FOLLOWINGS_URL.format(self.linghu.id),
+        ]:
+            results, params = [], {'mode': 'cursor'}
+            while True:
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.anonymous_client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                # 总数 cache 住之后, 翻页就不会再去数据库里 COUNT(*)
+                if 'cursor' in params:
+                    for query in queries:
+                        self.assertNotIn('COUNT(', query['sql'].upper())
+                self.assertEqual(response.data['approximate_total_results'], len(users))
+                self.assertNotIn('total_pages', response.data)
+                results.extend(response.data['results'])
+                if not response.data['has_next_page']:
+                    self.assertEqual(response.data['next_cursor'], None)
+                    break
+                params = {'cursor': response.data['next_cursor']}
+            self.assertEqual(
+                [result['user']['id'] for result in results],
+                expected_ids,
+            )
+
+        # size 参数也可以用, 但是不能超过 max_page_size
+        response = self.anonymous_client.get(
+            FOLLOWERS_URL.format(self.linghu.id),
+            {'mode': 'cursor', 'size': 2},
+        )
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.anonymous_client.get(
+            FOLLOWERS_URL.format(self.linghu.id),
+            {'mode': 'cursor', 'size': FriendshipPagination.max_page_size + 1},
+        )
+        self.assertEqual(
+            len(response.data['results']),
+            FriendshipPagination.max_page_size,
+        )
+
+        # 不带参数的时候还是按照页码翻页, 已有的客户端拿到的格式不变
+        response = self.anonymous_client.get(FOLLOWERS_URL.format(self.linghu.id))
+        self.assertEqual(response.data['total_results'], len(users))
+        self.assertEqual(response.data['total_pages'], 3)
+        self.assertEqual(response.data['page_number'], 1)
+        self.assertNotIn('next_cursor', response.data)
+
     def _test_friendship_pagination(self, url, page_size, max_page_size):
         # 获取第一页
         response = self.anonymous_client.get(url, {'page': 1})
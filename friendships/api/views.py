@@ -30,6 +30,14 @@ class FriendshipViewSet(GenericViewSet):
 
     # 一般来说，不同的 views 所需要的 pagination 规则肯定是不同的，因此一般都需要自定义
     pagination_class = FriendshipPagination  # 引入 pagination 之后就可以在方法中调动 self.pagination
+
+    def get_approximate_count(self):
+        # cursor 翻页的时候返回的总数, 从 cache 里取, 不用每一页都 COUNT(*)
+        user_id = int(self.kwargs['pk'])
+        if self.action == 'followers':
+            return FriendshipService.get_follower_count(user_id)
+        return FriendshipService.get_following_count(user_id)
+
     # 这里我们写一下自定义的action, followers显示用户的粉丝
     # GET /api/friendships/1/followers/
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
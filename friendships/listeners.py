@@ -1,8 +1,16 @@
 def friendship_changed(sender, instance, **kwargs):
     # 这个 import 必须写在里面, 否则会报循环引用的错
     # 因为 friendship.service 会引用 friendship.model
-    # friendship.model又会应用invalidate_following_cache
-    # invalidate_following_cache又会应用friendship.service
+    # friendship.model又会应用friendship_changed
+    # friendship_changed又会应用friendship.service
     # 循环应用的工程规范把引用写在函数内部
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
\ No newline at end of file
+    # post_save 会带上 created 参数, pre_delete 没有
+    if kwargs.get('created'):
+        FriendshipService.incr_follower_count_cache(instance.to_user_id)
+        FriendshipService.add_follower_id(instance.to_user_id, instance.from_user_id)
+        FriendshipService.add_following_id(instance.from_user_id, instance.to_user_id)
+    elif 'created' not in kwargs:
+        FriendshipService.incr_follower_count_cache(instance.to_user_id, -1)
+        FriendshipService.remove_follower_id(instance.to_user_id, instance.from_user_id)
+        FriendshipService.remove_following_id(instance.from_user_id, instance.to_user_id)
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, pre_delete
+from django.utils.functional import cached_property
 
 # 在 save 之后, 和删除之前
 # 因为是在创建和删除 Freindship 都会触发删除缓存的操作, 所以用 django 的 signal 机制在 model 层面来处理这个问题
@@ -36,11 +37,11 @@ class Friendship(models.Model):
         )  # 不同重复关注
         ordering = ('-created_at', )  # 加在所有的查询后面, 除非你制定了 order_by
 
-    @property
+    @cached_property
     def cached_from_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
 
-    @property
+    @cached_property
     def cached_to_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
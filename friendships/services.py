@@ -1,7 +1,13 @@
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Count
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import (
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWERS_COUNT_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.redis_set import RedisSet
 
 
 # 如果是想访问 default cache, 可以只引入 from django.core.cache import cache
@@ -39,6 +45,25 @@ class FriendshipService(object):
         ).prefetch_related('from_user')
         return [friendship.from_user for friendship in friendships]
 
+    @classmethod
+    def iter_follower_id_batches(cls, to_user_id, batch_size):
+        # fanout 的时候只需要粉丝的 id, 不需要去 User 表里把粉丝都查出来
+        # 粉丝的 id 存在 redis 的 set 里, 每次取 batch_size 个, 不会一次把所有粉丝都放在内存里
+        key = FOLLOWER_IDS_PATTERN.format(user_id=to_user_id)
+        queryset = Friendship.objects.filter(
+            to_user_id=to_user_id,
+            from_user_id__isnull=False,
+        ).order_by().values_list('from_user_id', flat=True)
+        return RedisSet.scan_batches(key, queryset, batch_size)
+
+    @classmethod
+    def add_follower_id(cls, to_user_id, from_user_id):
+        RedisSet.add(FOLLOWER_IDS_PATTERN.format(user_id=to_user_id), from_user_id)
+
+    @classmethod
+    def remove_follower_id(cls, to_user_id, from_user_id):
+        RedisSet.remove(FOLLOWER_IDS_PATTERN.format(user_id=to_user_id), from_user_id)
+
     # 当我去关注别人的好友列表式, 我可以看到我对他的好友是否关注了, 或者可以取关
     @classmethod
     def has_followed(cls, from_user, to_user):
@@ -47,24 +72,93 @@ class FriendshipService(object):
             to_user=to_user,
         ).exists()
 
+    @classmethod
+    def _get_following_ids_queryset(cls, from_user_id):
+        return Friendship.objects.filter(
+            from_user_id=from_user_id,
+            to_user_id__isnull=False,
+        ).order_by().values_list('to_user_id', flat=True)
+
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
+        # 以前是整个 set pickle 之后存在 memcached 里, 每次关注和取关都要删掉
+        # 关注了很多人的用户, 下次读的时候就要从数据库里把整个 set 重新读一遍再写回去
+        # 现在存成 redis 的 set, 关注和取关的时候 sadd/srem 增量更新, 不需要重新加载
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)  # 在 get 时, django 也会进行发序列化, 返回一个 set
-        if user_id_set is not None:
-            return user_id_set
-
-        friendships = Friendship.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
-        ])
-        cache.set(key, user_id_set)  # 本质上 memcached 中 key 和 value 都是字符串
-        # 在调用 set 方法时, django 会对集合做处理, 将集合序列化成为一个字符串
-        return user_id_set
-
-    # 删除 key 的操作
+        return RedisSet.get_members(key, cls._get_following_ids_queryset(from_user_id))
+
+    @classmethod
+    def get_followed_user_ids(cls, from_user_id, user_ids):
+        # user_ids 里 from_user 关注了的那些, 列表页的 has_followed 只需要判断这一页的用户
+        # 用 smismember 只传这一页的 id, 关注了很多人的用户也不用把整个 set 读出来
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        return RedisSet.contains_many(
+            key,
+            user_ids,
+            cls._get_following_ids_queryset(from_user_id),
+            'to_user_id',
+        )
+
+    @classmethod
+    def add_following_id(cls, from_user_id, to_user_id):
+        RedisSet.add(FOLLOWINGS_PATTERN.format(user_id=from_user_id), to_user_id)
+
+    @classmethod
+    def remove_following_id(cls, from_user_id, to_user_id):
+        RedisSet.remove(FOLLOWINGS_PATTERN.format(user_id=from_user_id), to_user_id)
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        return cls.get_follower_counts([to_user_id])[to_user_id]
+
+    @classmethod
+    def get_follower_counts(cls, to_user_ids):
+        # 一次 get_many 从 memcached 里拿出所有人的粉丝数
+        # cache miss 的用户用一条 group by 的 query 一起算出来, 而不是每人一个 COUNT
+        keys = {
+            FOLLOWERS_COUNT_PATTERN.format(user_id=user_id): user_id
+            for user_id in to_user_ids
+        }
+        cached_counts = cache.get_many(keys.keys())
+        counts = {keys[key]: count for key, count in cached_counts.items()}
+
+        missing_user_ids = [
+            user_id for user_id in to_user_ids if user_id not in counts
+        ]
+        if not missing_user_ids:
+            return counts
+
+        rows = Friendship.objects.filter(
+            to_user_id__in=missing_user_ids,
+        ).order_by().values('to_user_id').annotate(count=Count('id'))
+        missing_counts = {user_id: 0 for user_id in missing_user_ids}
+        for row in rows:
+            missing_counts[row['to_user_id']] = row['count']
+        cache.set_many({
+            FOLLOWERS_COUNT_PATTERN.format(user_id=user_id): count
+            for user_id, count in missing_counts.items()
+        })
+        counts.update(missing_counts)
+        return counts
+
+    @classmethod
+    def incr_follower_count_cache(cls, to_user_id, delta=1):
+        # 大 V 每分钟都有很多人关注, 如果每次都把 cache 删掉, 每次读都要 COUNT 一遍几百万行
+        # 所以直接在 cache 里加减, 和数据库之间可能会有一点点误差, cache 过期之后会重新算一次
+        key = FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # key 不存在, 下次读的时候再从数据库里算
+            pass
+
+    @classmethod
+    def invalidate_follower_count_cache(cls, to_user_id):
+        key = FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        cache.delete(key)
+
     @classmethod
-    def invalidate_following_cache(cls, from_user_id):
+    def get_following_count(cls, from_user_id):
+        # 关注的人的 id 集合本身就 cache 在 redis 里, 直接 scard, 不需要 COUNT
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
\ No newline at end of file
+        return RedisSet.count(key, cls._get_following_ids_queryset(from_user_id))
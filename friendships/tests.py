@@ -1,6 +1,14 @@
+from unittest import mock
+
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from testing.testcases import TestCase
+from twitter.cache import (
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.redis_set import RedisSet
 
 
 class FriendshipServiceTests(TestCase):
@@ -23,4 +31,138 @@ class FriendshipServiceTests(TestCase):
         Friendship.objects.filter(from_user=self.linghu, to_user=self.dongxie).delete()
         # FriendshipService.invalidate_following_cache(self.linghu.id)
         user_id_set = FriendshipService.get_following_user_id_set(self.linghu.id)
-        self.assertSetEqual(user_id_set, {user1.id, user2.id})
\ No newline at end of file
+        self.assertSetEqual(user_id_set, {user1.id, user2.id})
+
+    def test_follower_count_cache(self):
+        user1 = self.create_user('user1')
+        Friendship.objects.create(from_user=user1, to_user=self.linghu)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 1)
+
+        # cache 里有了之后, 关注和取关都是直接在 cache 上加减, 不再去数据库里 COUNT
+        Friendship.objects.create(from_user=self.dongxie, to_user=self.linghu)
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+        Friendship.objects.filter(from_user=user1, to_user=self.linghu).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 1)
+
+    def test_iter_follower_id_batches(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            Friendship.objects.create(from_user=follower, to_user=self.linghu)
+        conn = RedisClient.get_connection()
+        key = FOLLOWER_IDS_PATTERN.format(user_id=self.linghu.id)
+
+        def get_batches():
+            return list(FriendshipService.iter_follower_id_batches(self.linghu.id, 2))
+
+        # 关注的时候 set 还不在 redis 里, 第一次读的时候从数据库里建起来
+        batches = get_batches()
+        self.assertEqual(conn.exists(key), 1)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(
+            sorted(sum(batches, [])),
+            sorted(follower.id for follower in followers),
+        )
+
+        # 之后都从 redis 里读, 不再查数据库
+        with self.assertNumQueries(0):
+            batches = get_batches()
+        self.assertEqual(
+            sorted(sum(batches, [])),
+            sorted(follower.id for follower in followers),
+        )
+
+        # 关注和取关的时候增量更新
+        Friendship.objects.create(from_user=self.dongxie, to_user=self.linghu)
+        Friendship.objects.filter(from_user=followers[0]).delete()
+        with self.assertNumQueries(0):
+            follower_ids = sum(get_batches(), [])
+        self.assertEqual(
+            sorted(follower_ids),
+            sorted([follower.id for follower in followers[1:]] + [self.dongxie.id]),
+        )
+
+        # 没有粉丝的用户也会 cache 住
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(FriendshipService.iter_follower_id_batches(self.dongxie.id, 2)),
+                [],
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                list(FriendshipService.iter_follower_id_batches(self.dongxie.id, 2)),
+                [],
+            )
+
+    def test_rebuild_started_before_change(self):
+        conn = RedisClient.get_connection()
+        key = FOLLOWER_IDS_PATTERN.format(user_id=self.linghu.id)
+
+        class FakeQuerySet(list):
+            def iterator(self, chunk_size):
+                return iter(self)
+
+        class ChangingQuerySet(FakeQuerySet):
+            # 模拟从数据库里读粉丝的过程中又有人关注了
+            def iterator(self, chunk_size):
+                RedisSet.add(key, self.dongxie_id)
+                return iter(self)
+
+        queryset = ChangingQuerySet([1001, 1002])
+        queryset.dongxie_id = self.dongxie.id
+        self.assertFalse(RedisSet._load(key, queryset))
+        self.assertEqual(conn.exists(key), 0)
+        # 变化之后才开始的重建可以写进去, 不需要等一段时间
+        self.assertTrue(RedisSet._load(key, FakeQuerySet([1001, 1002, self.dongxie.id])))
+        self.assertEqual(conn.scard(key), 4)
+
+    def test_following_user_id_set_is_updated_incrementally(self):
+        user1 = self.create_user('user1')
+        Friendship.objects.create(from_user=self.linghu, to_user=user1)
+        conn = RedisClient.get_connection()
+        key = FOLLOWINGS_PATTERN.format(user_id=self.linghu.id)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {user1.id},
+        )
+
+        # 关注和取关之后 set 是增量更新的, 不会从数据库里重新加载
+        Friendship.objects.create(from_user=self.linghu, to_user=self.dongxie)
+        with self.assertNumQueries(0):
+            self.assertSetEqual(
+                FriendshipService.get_following_user_id_set(self.linghu.id),
+                {user1.id, self.dongxie.id},
+            )
+        Friendship.objects.filter(from_user=self.linghu, to_user=user1).delete()
+        with self.assertNumQueries(0):
+            self.assertSetEqual(
+                FriendshipService.get_following_user_id_set(self.linghu.id),
+                {self.dongxie.id},
+            )
+            self.assertEqual(FriendshipService.get_following_count(self.linghu.id), 1)
+
+    def test_followed_user_ids_and_count(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users[:2]:
+            Friendship.objects.create(from_user=self.linghu, to_user=user)
+        user_ids = [user.id for user in users] + [self.dongxie.id]
+
+        # 刚关注完 set 还不在 redis 里, 第一次读的时候建起来
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.linghu.id, user_ids),
+            {users[0].id, users[1].id},
+        )
+        # 之后只用 smismember 和 scard, 不会把整个 set 读出来
+        with mock.patch.object(RedisSet, 'get_members', side_effect=AssertionError):
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    FriendshipService.get_followed_user_ids(self.linghu.id, user_ids),
+                    {users[0].id, users[1].id},
+                )
+                self.assertEqual(FriendshipService.get_following_count(self.linghu.id), 2)
+                self.assertEqual(
+                    FriendshipService.get_followed_user_ids(self.linghu.id, []),
+                    set(),
+                )
+        self.assertEqual(FriendshipService.get_following_count(self.dongxie.id), 0)
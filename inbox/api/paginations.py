@@ -0,0 +1,8 @@
+from utils.paginations import KeysetPagination
+
+
+class NotificationPagination(KeysetPagination):
+    # 通知按照 (timestamp, id) 倒序用 cursor 翻页, 向下翻页用 ?cursor=<next_cursor>
+    # 不像 PageNumberPagination 那样每一页都要 COUNT(*), 再 OFFSET 扫过前面所有页
+    # 翻到多深都只用到 (recipient, unread, timestamp) 或者 (recipient, timestamp) 的联合索引
+    ordering_field = 'timestamp'
@@ -1,22 +1,60 @@
+from accounts.api.serializers import UserSerializerForNotification
+from inbox.services import NotificationService
 from rest_framework import serializers
 from notifications.models import Notification
+from utils.serializers import PrefetchListSerializer
 
 
 class NotificationSerializer(serializers.ModelSerializer):
+    # actor 和 target 都是 generic foreign key, 每一行都通过 notification.actor 去取的话
+    # 每一行都要查一次, 所以渲染一页通知之前先按照 content type 分组一起取出来
+    actor = UserSerializerForNotification(source='cached_actor')
+    target = serializers.SerializerMethodField()
+    # 第三方库的 data 字段 DRF 不认识, 默认会被渲染成字符串
+    data = serializers.JSONField(read_only=True)
+
+    def get_target(self, obj):
+        # target 是 tweet 或者 comment, 只返回通知里需要展示的部分
+        if obj.cached_target is None:
+            return None
+        return {
+            'id': obj.cached_target.id,
+            'content': obj.cached_target.content,
+        }
+
+    def prefetch_through_cache(self, notifications):
+        NotificationService.prefetch_generic_objects(notifications, 'actor')
+        NotificationService.prefetch_generic_objects(notifications, 'target')
+        self.fields['actor'].prefetch_through_cache([
+            notification.cached_actor
+            for notification in notifications
+            if notification.cached_actor is not None
+        ])
+
+    def to_representation(self, instance):
+        # 单独渲染一个 notification 的时候 (比如 update 之后) 没有经过 list serializer 的 prefetch
+        if 'cached_actor' not in instance.__dict__:
+            self.prefetch_through_cache([instance])
+        return super().to_representation(instance)
 
     class Meta:
         model = Notification
+        list_serializer_class = PrefetchListSerializer
         fields = (
             'id',
             'actor_content_type',   # 这是 generic foreign key
             'actor_object_id',
             'verb',  # 关注
+            'description',  # 合并了多个人的点赞时, 比如 "A and 12 others liked your tweet"
+            'data',  # {'actors_count': 13} 一共有多少人
             'action_object_content_type',
             'action_object_object_id',
             'target_content_type',
             'target_object_id',
             'timestamp',
             'unread',
+            'actor',
+            'target',
         )
 
 
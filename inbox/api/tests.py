@@ -1,3 +1,7 @@
+from unittest import mock
+
+from inbox.api.paginations import NotificationPagination
+from inbox.services import NotificationService
 from notifications.models import Notification
 from testing.testcases import TestCase
 
@@ -34,6 +38,7 @@ class NotificationTests(TestCase):
 class NotificationApiTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.linghu, self.linghu_client = self.create_user_and_client('linghu')
         self.dongxie, self.dongxie_client = self.create_user_and_client('dongxie')
         self.linghu_tweet = self.create_tweet(self.linghu)
@@ -59,6 +64,41 @@ class NotificationApiTests(TestCase):
         response = self.dongxie_client.get(url)
         self.assertEqual(response.data['unread_count'], 0)  # dongxie是看不到的, 保证是按照用户 filter 的
 
+    def test_unread_count_cache(self):
+        url = '/api/notifications/unread-count/'
+        # 第一次读的时候从数据库里数出来放到 redis 里
+        response = self.linghu_client.get(url)
+        self.assertEqual(response.data['unread_count'], 0)
+
+        self.dongxie_client.post(LIKE_URL, {
+            'content_type': 'tweet',
+            'object_id': self.linghu_tweet.id,
+        })
+        self.dongxie_client.post(COMMENT_URL, {
+            'tweet_id': self.linghu_tweet.id,
+            'content': 'a ha',
+        })
+        # 之后只读 redis 里的计数器, force_authenticate 之后也不用查 session 和 user
+        # 所以这个请求一条 SQL 都没有
+        self.linghu_client.force_authenticate(self.linghu)
+        with self.assertNumQueries(0):
+            response = self.linghu_client.get(url)
+        self.assertEqual(response.data['unread_count'], 2)
+
+        notification = self.linghu.notifications.first()
+        notification_url = '{}{}/'.format(NOTIFICATION_URL, notification.id)
+        self.linghu_client.put(notification_url, {'unread': False})
+        self.linghu_client.put(notification_url, {'unread': False})
+        response = self.linghu_client.get(url)
+        self.assertEqual(response.data['unread_count'], 1)
+        self.linghu_client.put(notification_url, {'unread': True})
+        response = self.linghu_client.get(url)
+        self.assertEqual(response.data['unread_count'], 2)
+
+        self.linghu_client.post('/api/notifications/mark-all-as-read/')
+        with self.assertNumQueries(0):
+            response = self.linghu_client.get(url)
+        self.assertEqual(response.data['unread_count'], 0)
 
     def test_mark_all_as_read(self):
         self.dongxie_client.post(LIKE_URL, {
@@ -89,6 +129,74 @@ class NotificationApiTests(TestCase):
         response = self.linghu_client.get(unread_url)
         self.assertEqual(response.data['unread_count'], 0)
 
+    def test_mark_all_as_read_in_background(self):
+        for index in range(5):
+            user = self.create_user('user{}'.format(index))
+            tweet = self.create_tweet(self.linghu)
+            NotificationService.send_like_notification(self.create_like(user, tweet))
+        unread_url = '/api/notifications/unread-count/'
+        progress_url = '/api/notifications/mark-all-as-read-progress/'
+        response = self.linghu_client.get(progress_url)
+        self.assertEqual(response.data, {'status': 'unknown'})
+
+        # 超过 NOTIFICATION_MARK_AS_READ_SYNC_LIMIT 条放到后台去做, 测试的时候 celery 是 eager 的
+        response = self.linghu_client.post('/api/notifications/mark-all-as-read/')
+        self.assertEqual(response.status_code, 202)
+        response = self.linghu_client.get(progress_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'status': 'finished', 'total': 5, 'marked': 5})
+        response = self.linghu_client.get(unread_url)
+        self.assertEqual(response.data['unread_count'], 0)
+        self.assertEqual(self.linghu.notifications.filter(unread=True).count(), 0)
+        # 别人的进度是看不到的
+        response = self.dongxie_client.get(progress_url)
+        self.assertEqual(response.data, {'status': 'unknown'})
+
+    def test_mark_all_as_read_job_not_enqueued_twice(self):
+        for index in range(5):
+            user = self.create_user('user{}'.format(index))
+            tweet = self.create_tweet(self.linghu)
+            NotificationService.send_like_notification(self.create_like(user, tweet))
+        mark_url = '/api/notifications/mark-all-as-read/'
+
+        # 任务还在排队的时候再 post 一次, 返回同一个任务的进度, 不会再提交一次
+        with mock.patch('inbox.api.views.mark_all_as_read_task') as task:
+            response = self.linghu_client.post(mark_url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data, {'status': 'pending', 'total': 5, 'marked': 0})
+            response = self.linghu_client.post(mark_url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data, {'status': 'pending', 'total': 5, 'marked': 0})
+            self.assertEqual(task.delay.call_count, 1)
+
+            # 正在执行的时候也一样
+            responses = []
+            NotificationService.run_mark_as_read_job(
+                self.linghu.id,
+                batch_size=1,
+                on_batch=lambda marked: responses.append(self.linghu_client.post(mark_url)),
+            )
+            self.assertEqual(responses[0].status_code, 202)
+            self.assertEqual(responses[0].data, {'status': 'running', 'total': 5, 'marked': 1})
+            self.assertEqual(task.delay.call_count, 1)
+
+            # 完成了之后可以再提交新的任务
+            for index in range(5):
+                user = self.create_user('other{}'.format(index))
+                tweet = self.create_tweet(self.linghu)
+                NotificationService.send_like_notification(self.create_like(user, tweet))
+            response = self.linghu_client.post(mark_url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data, {'status': 'pending', 'total': 5, 'marked': 0})
+            self.assertEqual(task.delay.call_count, 2)
+
+        # worker 挂了的任务超时之后也可以再提交
+        with mock.patch('inbox.api.views.mark_all_as_read_task') as task, \
+                self.settings(NOTIFICATION_MARK_AS_READ_JOB_TIMEOUT=0):
+            response = self.linghu_client.post(mark_url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(task.delay.call_count, 1)
+
     def test_list(self):
         # dongxie 对 linghu 的 tweet 点赞
         self.dongxie_client.post(LIKE_URL, {
@@ -110,28 +218,72 @@ class NotificationApiTests(TestCase):
         response = self.dongxie_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, 200)
 
-        # 这里的返回值是 pagenization 过得
-        # ([('count', 0), ('next', None), ('previous', None), ('results', [])])
-        self.assertEqual(response.data['count'], 0)
+        # 这里的返回值是用 cursor 翻页的, 没有 count
+        # {'has_next_page': False, 'next_cursor': None, 'refresh_cursor': None, 'results': []}
+        self.assertEqual(len(response.data['results']), 0)
         # linghu 看到两个 notifications
         response = self.linghu_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, 200)
 
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         # 标记之后看到一个未读
         notification = self.linghu.notifications.first()
         notification.unread = False # 把第一个通知改为已读
         notification.save()
         response = self.linghu_client.get(NOTIFICATION_URL)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         # 查询未读的
         # listModelMixin里面是支持删选机制的
         # 在 view 中用 filterset_fields = ('unread',)  配置了筛选
         response = self.linghu_client.get(NOTIFICATION_URL, {'unread': True})
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
         # 查询已读的
         response = self.linghu_client.get(NOTIFICATION_URL, {'unread': False})
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_cursor_pagination(self):
+        comment = self.create_comment(self.linghu, self.linghu_tweet)
+        for index in range(5):
+            client = self.create_user_and_client('user{}'.format(index))[1]
+            tweet = self.create_tweet(self.linghu)
+            client.post(LIKE_URL, {'content_type': 'tweet', 'object_id': tweet.id})
+            client.post(LIKE_URL, {'content_type': 'comment', 'object_id': comment.id})
+        # 对同一个 comment 的点赞合并成了一条, 一共 6 条通知
+        self.assertEqual(self.linghu.notifications.count(), 6)
+
+        def list_all(num_queries=None):
+            results, params = [], {}
+            while True:
+                if num_queries is None:
+                    response = self.linghu_client.get(NOTIFICATION_URL, params)
+                else:
+                    with self.assertNumQueries(num_queries.pop(0)):
+                        response = self.linghu_client.get(NOTIFICATION_URL, params)
+                self.assertEqual(response.status_code, 200)
+                results.extend(response.data['results'])
+                if not response.data['has_next_page']:
+                    return results
+                params = {'cursor': response.data['next_cursor']}
+
+        with mock.patch.object(NotificationPagination, 'page_size', 4):
+            list_all()
+            # 一页通知里所有的 actor 和 target 都是按照 content type 批量取的, 和一页有多少条无关
+            # cache 建好之后, 第一页一条 SQL 查通知, 一条 SQL 查 comment
+            # 第二页里只有 tweet 的通知, user 和 tweet 都在 memcached 里, 只需要查通知
+            results = list_all(num_queries=[2, 1])
+        self.assertEqual(len({result['id'] for result in results}), 6)
+        timestamps = [result['timestamp'] for result in results]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+        newest = results[0]
+        self.assertEqual(newest['actor']['username'], 'user4')
+        self.assertEqual(newest['target']['id'], comment.id)
+        self.assertEqual(newest['target']['content'], comment.content)
+        self.assertEqual(newest['data']['actors_count'], 5)
+        self.assertEqual(len(newest['data']['actor_ids']), 5)
+        self.assertEqual(newest['description'], 'user4 and 4 others liked your comment')
+        self.assertEqual(results[1]['actor']['username'], 'user4')
+        self.assertEqual(results[1]['description'], None)
 
     def test_update(self):
         self.dongxie_client.post(LIKE_URL, {
@@ -1,8 +1,12 @@
+from django.conf import settings
 from django_filters.rest_framework import DjangoFilterBackend
 from inbox.api.serializers import (
     NotificationSerializer,
     NotificationSerializerForUpdate,
 )
+from inbox.api.paginations import NotificationPagination
+from inbox.services import NotificationService
+from inbox.tasks import mark_all_as_read_task
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
@@ -18,6 +22,7 @@ class NotificationViewSet(
     serializer_class = NotificationSerializer
     permission_classes = (IsAuthenticated,)
     filterset_fields = ('unread',)  # 这里配置了筛选机制
+    pagination_class = NotificationPagination
 
     def get_queryset(self):
         # 还有一种写法是引入 Notification model, 然后 filter user, 但是要配置 AUTH_USER_MODEL
@@ -30,22 +35,41 @@ class NotificationViewSet(
     # /api/notifications/unread-count
     @action(methods=['GET'], detail=False, url_path='unread-count')
     def unread_count(self, request, *args, **kwargs):
-        # 如果代码量多, 可以不用 self.get_queryset() 因为可能超过一屏, 阅读时需要跳转查看
+        # 客户端会不停地轮询这个接口, 所以未读数从 redis 里的计数器读, 不去数据库里 COUNT(*)
+        # 计数器不在 redis 里的时候才会去数据库里数一遍:
         # Notification.objects.filter(
         #     recipient=self.request.user,
         #     unread=True,
         # ).count()
-        count = self.get_queryset().filter(unread=True).count()
+        count = NotificationService.get_unread_count(request.user.id)
         return Response({'unread_count': count}, status=status.HTTP_200_OK)
 
 
     @action(methods=['POST'], detail=False, url_path='mark-all-as-read')
     def mark_all_as_read(self, request, *args, **kwargs):
-        # 应该先 filter 一下再 update
+        # 未读的通知很多的时候, 放到 celery 里分批标记, 返回 202
+        # 客户端再通过 mark-all-as-read-progress 查询进度
+        # 已经有任务在排队或者在执行的时候 (比如客户端重试或者连点了两次), 不再提交新的任务, 直接返回它的进度
+        unread_count = NotificationService.get_unread_count(request.user.id)
+        if unread_count > settings.NOTIFICATION_MARK_AS_READ_SYNC_LIMIT:
+            if NotificationService.init_mark_as_read_progress(request.user.id):
+                mark_all_as_read_task.delay(request.user.id)
+            return Response(
+                NotificationService.get_mark_as_read_progress(request.user.id),
+                status=status.HTTP_202_ACCEPTED,
+            )
+        # 不多的时候直接在请求里标记, 也是按照主键分批 update, 未读数在 redis 里有偏差的时候也不会一次锁住很多行
         # 在 Notification中已经对 recipient 和 unread 进行了索引
-        updated_count = self.get_queryset().filter(unread=True).update(unread=False)
+        updated_count = NotificationService.mark_all_as_read(request.user.id)
         return Response({'marked_count': updated_count}, status=status.HTTP_200_OK)
 
+    @action(methods=['GET'], detail=False, url_path='mark-all-as-read-progress')
+    def mark_all_as_read_progress(self, request, *args, **kwargs):
+        return Response(
+            NotificationService.get_mark_as_read_progress(request.user.id),
+            status=status.HTTP_200_OK,
+        )
+
     @required_params(method='PUT', params=['unread'])
     def update(self, request, *args, **kwargs):
         """
@@ -60,8 +84,10 @@ class NotificationViewSet(
         两种方法都可以，我更偏好重载 update，因为更通用更 rest 一些, 而且 mark as unread 和
         mark as read 可以公用一套逻辑。
         """
+        instance = self.get_object()
+        was_unread = instance.unread
         serializer = NotificationSerializerForUpdate(
-            instance=self.get_object(), # update用的 serializer 是必须要传 instance, 才能在 save 是调用 update
+            instance=instance, # update用的 serializer 是必须要传 instance, 才能在 save 是调用 update
             data=request.data,
         )
         if not serializer.is_valid():
@@ -70,6 +96,11 @@ class NotificationViewSet(
                 'errors': serializer.errors,
             }, status=status.HTTP_400_BAD_REQUEST)
         notification = serializer.save()  # 会调用 serializer 中 update 的方法
+        # 已读标记成已读, 未读标记成未读的时候 delta 是 0, 计数器不变
+        NotificationService.incr_unread_count(
+            request.user.id,
+            int(notification.unread) - int(was_unread),
+        )
         return Response(
             NotificationSerializer(notification).data,
             status=status.HTTP_200_OK,
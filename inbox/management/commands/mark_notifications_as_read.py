@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from inbox.services import NotificationService
+
+
+class Command(BaseCommand):
+    help = "Mark all of a user's notifications as read in primary key batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.NOTIFICATION_MARK_AS_READ_BATCH_SIZE,
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=settings.NOTIFICATION_MARK_AS_READ_SLEEP,
+            help='seconds to sleep between batches',
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError('user {} does not exist'.format(options['username']))
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive')
+
+        # 和 api 的后台任务一样会把进度记到 redis 里, 用户在客户端也能看到进度
+        if not NotificationService.init_mark_as_read_progress(user.id):
+            raise CommandError(
+                'a mark as read job of {} is already pending or running'.format(user.username),
+            )
+        total = NotificationService.get_mark_as_read_progress(user.id)['total']
+        marked_count = NotificationService.run_mark_as_read_job(
+            user.id,
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            on_batch=lambda marked: self.stdout.write(
+                '{} / ~{} marked as read'.format(marked, total),
+            ),
+        )
+        self.stdout.write('done, {} notifications marked as read'.format(marked_count))
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+# Notification 是第三方 app 里的 model, 不能直接改它的 Meta.indexes
+# 所以在 inbox 的 migration 里用 schema_editor 给它的表加上索引
+# 通知列表按照 recipient (以及 unread) 筛选, 再按照 (timestamp, id) 倒序用 cursor 翻页
+# innodb 的二级索引里本来就带着主键 id, 所以翻页的时候不需要再排序
+INDEX = models.Index(
+    fields=['recipient', 'unread', 'timestamp'],
+    name='notif_recipient_unread_ts',
+)
+
+
+def add_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.add_index(Notification, INDEX)
+
+
+def remove_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.remove_index(Notification, INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0008_index_together_recipient_unread'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
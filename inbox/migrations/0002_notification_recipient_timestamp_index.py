@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+# 0001 的 (recipient, unread, timestamp) 只覆盖了按照 unread 筛选的列表
+# 不带 unread 参数的通知列表只按照 recipient 筛选, 用那个索引的话要把一个人所有的通知取出来再排序
+# 所以再加一个 (recipient, timestamp) 的索引, 翻页的时候一样不需要排序
+INDEX = models.Index(
+    fields=['recipient', 'timestamp'],
+    name='notif_recipient_ts',
+)
+
+
+def add_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.add_index(Notification, INDEX)
+
+
+def remove_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.remove_index(Notification, INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0001_notification_recipient_unread_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
@@ -0,0 +1,15 @@
+from django.db import models
+
+
+class NotificationDelivery(models.Model):
+    # 已经写进数据库的一批通知 event 的 id, 和这批通知在同一个事务里写入
+    # 投递完事务已经提交, 还没来得及把这批 event 从队列里去掉就挂了的话
+    # 下一次投递看到这个 id 已经存在, 就知道这批通知已经写过了, 不会再通知一次, 也不会再加一次未读数
+    batch_id = models.CharField(max_length=64, unique=True)
+    # 这一批有多少个 event, 跳过的时候从队列里去掉这么多个
+    # 两次投递之间改了 NOTIFICATION_DELIVERY_BATCH_SIZE 也不会多去掉或者少去掉
+    events_count = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.batch_id} {self.created_at}'
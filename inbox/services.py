@@ -1,40 +1,549 @@
-from comments.models import Comment
+import json
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from notifications.signals import notify
+from django.db import transaction
+from django.db.models import Count, Max
+from inbox.models import NotificationDelivery
+from notifications.models import Notification
 from tweets.models import Tweet
+from twitter.cache import (
+    DELIVERING_NOTIFICATIONS_ID_KEY,
+    DELIVERING_NOTIFICATIONS_KEY,
+    MARK_AS_READ_PROGRESS_PATTERN,
+    NOTIFICATION_DELIVERY_LOCK_KEY,
+    PENDING_NOTIFICATIONS_KEY,
+    UNREAD_NOTIFICATIONS_COUNT_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_counters import INCR_IF_EXISTS_SCRIPT
+from utils.redis_lock import RedisLock
+from utils.time_helpers import utc_now
+
+LIKE_EVENT = 'like'
+COMMENT_EVENT = 'comment'
+
+LIKED_TWEET_VERB = 'liked your tweet'
+LIKED_COMMENT_VERB = 'liked your comment'
+
+# 只有 redis 里的值还是对账开始前读到的值的时候才改
+# 对账期间有新的通知或者标记了已读, 说明数据库里数出来的已经旧了, 留给下一次对账
+# KEYS 是计数器的 key, ARGV 里依次是每个 key 读到的旧值和数据库里数出来的新值
+RECONCILE_IF_NOT_CHANGED_SCRIPT = """
+local fixed = 0
+for index, key in ipairs(KEYS) do
+    local current = redis.call('get', key)
+    if current == ARGV[index * 2 - 1] and current ~= ARGV[index * 2] then
+        redis.call('set', key, ARGV[index * 2], 'keepttl')
+        fixed = fixed + 1
+    end
+end
+return fixed
+"""
+
+# 用户的后台标记已读任务还在排队或者正在执行的时候不再开始新的任务, 返回 0
+# 否则重新记录进度, 返回 1, 检查和写入是原子的, 同时来的两个请求只有一个会提交任务
+# 开始 (或者进队列) 超过 ARGV[2] 秒还没有完成的任务当作 worker 已经挂了
+# KEYS[1] 是进度的 key, ARGV 依次是现在的时间, 任务超时的秒数, 估计的总数, 进度的过期时间
+START_MARK_AS_READ_JOB_SCRIPT = """
+if redis.call('hexists', KEYS[1], 'finished_at') == 0 then
+    local since = redis.call('hget', KEYS[1], 'started_at') or redis.call('hget', KEYS[1], 'enqueued_at')
+    if since and tonumber(since) > tonumber(ARGV[1]) - tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('del', KEYS[1])
+redis.call('hset', KEYS[1], 'enqueued_at', ARGV[1], 'total', ARGV[3])
+redis.call('expire', KEYS[1], ARGV[4])
+return 1
+"""
 
 
 class NotificationService(object):
+    scripts = {}
+
+    @classmethod
+    def _get_script(cls, source):
+        if source not in cls.scripts:
+            conn = RedisClient.get_connection()
+            cls.scripts[source] = conn.register_script(source)
+        return cls.scripts[source]
 
+    # 点赞和评论的通知不在请求里同步创建, 只往 redis 的队列里放一条很小的 event
+    # 请求里不用通过 generic foreign key 去查 like.content_object, 也不用写数据库
+    # 接收者是谁, 是不是自己给自己点赞, 都等投递的时候一批 event 一起查出来
     @classmethod
     def send_like_notification(cls, like):
-        target = like.content_object
-        # 如果自己点赞自己的帖子, 自己点赞自己的评论, 不做通知
-        # 注意: 这种判断一般写在内部而不是函数外部, 这样可以让阅读代码的人, 在使用我们的函数时, 不必注意这种检测问题
-        if like.user == target.user:
-            return
-        if like.content_type == ContentType.objects.get_for_model(Tweet):
-            notify.send(
-                like.user,
-                recipient=target.user,
-                verb='liked your tweet',
-                target=target,
+        cls._enqueue(LIKE_EVENT, like.user_id, like.content_type_id, like.object_id)
+
+    @classmethod
+    def send_comment_notification(cls, comment):
+        cls._enqueue(
+            COMMENT_EVENT,
+            comment.user_id,
+            ContentType.objects.get_for_model(Tweet).id,  # get_for_model 有进程内的 cache, 不会查数据库
+            comment.tweet_id,
+        )
+
+    @classmethod
+    def _enqueue(cls, kind, actor_id, content_type_id, object_id):
+        conn = RedisClient.get_connection()
+        event = json.dumps([kind, actor_id, content_type_id, object_id, time.time()])
+        # 队列从空变成非空的时候安排一次投递, 等一小会儿再投递, 这段时间里的通知会一起写进数据库
+        # 测试的时候 celery 是 eager 的, 会直接投递
+        if conn.rpush(PENDING_NOTIFICATIONS_KEY, event) == 1:
+            # import 写在里面避免循环依赖
+            from inbox.tasks import deliver_notifications_task
+            deliver_notifications_task.apply_async(
+                countdown=settings.NOTIFICATION_DELIVERY_DELAY,
+            )
+
+    @classmethod
+    def deliver_pending_notifications(cls):
+        # 由 celery 的 deliver_notifications_task 调用, 返回创建和合并了多少条通知
+        # 同一时间只有一个 worker 在投递, 否则同一个 event 可能被投递两次
+        token = RedisLock.acquire(
+            NOTIFICATION_DELIVERY_LOCK_KEY,
+            settings.NOTIFICATION_DELIVERY_LOCK_TIMEOUT * 1000,
+        )
+        if token is None:
+            return 0
+        try:
+            conn = RedisClient.get_connection()
+            # 和 RedisCounters.flush 一样, 先把 pending rename 成 delivering 再投递
+            # 投递的过程中新的 event 会放到新的 pending 里
+            # 上一次投递中途失败了的话, delivering 还在, 先把它投递完
+            delivered_count = cls._deliver_queue()
+            if conn.exists(PENDING_NOTIFICATIONS_KEY):
+                # 每次 rename 出来的这些通知有一个新的 id, 和 rename 放在同一个事务里
+                # offset 是已经投递并且从队列里去掉了多少个 event
+                pipeline = conn.pipeline()
+                pipeline.rename(PENDING_NOTIFICATIONS_KEY, DELIVERING_NOTIFICATIONS_KEY)
+                pipeline.delete(DELIVERING_NOTIFICATIONS_ID_KEY)
+                pipeline.hset(DELIVERING_NOTIFICATIONS_ID_KEY, mapping={
+                    'id': uuid.uuid4().hex,
+                    'offset': 0,
+                })
+                pipeline.execute()
+                delivered_count += cls._deliver_queue()
+            return delivered_count
+        finally:
+            RedisLock.release(NOTIFICATION_DELIVERY_LOCK_KEY, token)
+
+    @classmethod
+    def _deliver_queue(cls):
+        conn = RedisClient.get_connection()
+        batch_size = settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+        delivered_count = 0
+        while True:
+            events = conn.lrange(DELIVERING_NOTIFICATIONS_KEY, 0, batch_size - 1)
+            if not events:
+                conn.delete(DELIVERING_NOTIFICATIONS_ID_KEY)
+                return delivered_count
+            # 每一批的 id 是这些通知的 id 加上这一批在里面的位置, 投递中途挂了之后再投递, 同一批的 id 不变
+            delivering_id, offset = conn.hmget(DELIVERING_NOTIFICATIONS_ID_KEY, ['id', 'offset'])
+            if delivering_id is None:
+                # 加 id 之前留下来的 delivering, 给它补一个
+                delivering_id, offset = uuid.uuid4().hex.encode(), b'0'
+                conn.hset(DELIVERING_NOTIFICATIONS_ID_KEY, mapping={
+                    'id': delivering_id,
+                    'offset': offset,
+                })
+            batch_id = '{}:{}'.format(delivering_id.decode(), int(offset))
+            count, events_count = cls._deliver_events(
+                [json.loads(event) for event in events],
+                batch_id,
+            )
+            delivered_count += count
+            # 写进数据库之后再从队列里去掉, 中途失败的话剩下的 event 留到下一次投递
+            # 去掉 event 和往后移 offset 在同一个事务里, 整个 list 都被 trim 掉的时候 redis 会把 key 删掉
+            pipeline = conn.pipeline()
+            pipeline.ltrim(DELIVERING_NOTIFICATIONS_KEY, events_count, -1)
+            pipeline.hincrby(DELIVERING_NOTIFICATIONS_ID_KEY, 'offset', events_count)
+            pipeline.execute()
+
+    @classmethod
+    def _deliver_events(cls, events, batch_id):
+        # 返回写进数据库的通知数, 以及要从队列里去掉多少个 event
+        owners = cls._get_target_owners(events)
+        user_content_type = ContentType.objects.get_for_model(User)
+        tweet_content_type = ContentType.objects.get_for_model(Tweet)
+
+        new_notifications = []
+        # 同一个人的同一个 tweet/comment 收到的点赞合并成一条通知
+        # key 是 (recipient_id, target_content_type_id, target_object_id, verb)
+        like_groups = OrderedDict()
+        for kind, actor_id, content_type_id, object_id, timestamp in events:
+            recipient_id = owners.get((content_type_id, object_id))
+            # 目标已经被删掉了, 或者自己点赞评论自己的 tweet/comment, 不做通知
+            if recipient_id is None or recipient_id == actor_id:
+                continue
+            timestamp = datetime.fromtimestamp(timestamp, tz=pytz.utc)
+            if kind == COMMENT_EVENT:
+                new_notifications.append(Notification(
+                    recipient_id=recipient_id,
+                    actor_content_type=user_content_type,
+                    actor_object_id=actor_id,
+                    verb=LIKED_COMMENT_VERB,
+                    target_content_type_id=content_type_id,
+                    target_object_id=object_id,
+                    timestamp=timestamp,
+                ))
+                continue
+            if content_type_id == tweet_content_type.id:
+                verb = LIKED_TWEET_VERB
+            else:
+                verb = LIKED_COMMENT_VERB
+            key = (recipient_id, content_type_id, str(object_id), verb)
+            group = like_groups.setdefault(key, {'actor_ids': [], 'timestamp': None})
+            if actor_id not in group['actor_ids']:
+                group['actor_ids'].append(actor_id)
+            group['timestamp'] = timestamp
+
+        # 通知和这一批的 id 在同一个事务里写进数据库
+        # 事务提交之后, 从队列里去掉之前挂了的话, 下一次投递看到 id 已经在了就不会再写一次
+        with transaction.atomic():
+            delivery, created = NotificationDelivery.objects.get_or_create(
+                batch_id=batch_id,
+                defaults={'events_count': len(events)},
+            )
+            if not created:
+                return 0, delivery.events_count
+            # id 只是用来判断挂掉之前的那次投递有没有写完, 不需要一直留着
+            NotificationDelivery.objects.filter(
+                created_at__lt=utc_now() - timedelta(days=1),
+            ).delete()
+            # 要合并进去的通知在这个事务里一直锁着, 读出来之后不会被标记成已读, 也不会被别人同时合并
+            merged_notifications = cls._coalesce_like_notifications(like_groups)
+            for key, group in like_groups.items():
+                if key in merged_notifications:
+                    continue
+                recipient_id, content_type_id, object_id, verb = key
+                notification = Notification(
+                    recipient_id=recipient_id,
+                    actor_content_type=user_content_type,
+                    verb=verb,
+                    target_content_type_id=content_type_id,
+                    target_object_id=object_id,
+                )
+                cls._set_likers(notification, group)
+                new_notifications.append(notification)
+            cls._set_descriptions(
+                new_notifications + list(merged_notifications.values()),
             )
-        if like.content_type == ContentType.objects.get_for_model(Comment):
-            notify.send(
-                like.user,
-                recipient=target.user,
-                verb='liked your comment',
-                target=target,
+
+            Notification.objects.bulk_create(
+                new_notifications,
+                batch_size=settings.NOTIFICATION_DELIVERY_BATCH_SIZE,
+            )
+            Notification.objects.bulk_update(
+                merged_notifications.values(),
+                ['actor_object_id', 'description', 'data', 'timestamp'],
+                batch_size=settings.NOTIFICATION_DELIVERY_BATCH_SIZE,
             )
+        # 合并进去的通知本来就是未读的, 只有新创建的通知才算新的未读
+        recipient_counts = Counter(
+            notification.recipient_id for notification in new_notifications
+        )
+        for recipient_id, count in recipient_counts.items():
+            cls.incr_unread_count(recipient_id, count)
+        return len(new_notifications) + len(merged_notifications), len(events)
 
     @classmethod
-    def send_comment_notification(cls, comment):
-        if comment.user == comment.tweet.user:  # 自己评论自己的评论不做通知
+    def _get_target_owners(cls, events):
+        # 每种 content type 的 tweet/comment 用一条 SQL 查出作者, {(content_type_id, object_id): user_id}
+        object_ids = defaultdict(set)
+        for _, _, content_type_id, object_id, _ in events:
+            object_ids[content_type_id].add(object_id)
+        owners = {}
+        for content_type_id, ids in object_ids.items():
+            model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            for object_id, user_id in model_class.objects.filter(
+                id__in=ids,
+            ).values_list('id', 'user_id'):
+                owners[(content_type_id, object_id)] = user_id
+        return owners
+
+    @classmethod
+    def _coalesce_like_notifications(cls, like_groups):
+        # 最近一段时间里同一个 tweet/comment 还没读的点赞通知, 新的点赞直接合并进去
+        # 而不是再创建一条, 返回 {key: 合并之后的 notification}
+        if not like_groups:
+            return {}
+        since = utc_now() - timedelta(seconds=settings.NOTIFICATION_COALESCE_WINDOW)
+        # 用到 (recipient, unread) 的联合索引
+        # 必须在事务里调用, select_for_update 把读出来的通知锁到事务结束
+        notifications = Notification.objects.select_for_update().filter(
+            recipient_id__in={key[0] for key in like_groups},
+            unread=True,
+            verb__in=[LIKED_TWEET_VERB, LIKED_COMMENT_VERB],
+            target_object_id__in={key[2] for key in like_groups},
+            timestamp__gte=since,
+        ).order_by('timestamp')
+        merged_notifications = {}
+        for notification in notifications:
+            key = (
+                notification.recipient_id,
+                notification.target_content_type_id,
+                notification.target_object_id,
+                notification.verb,
+            )
+            # 锁住之后再看一次是不是未读, 等锁的时候被标记成已读了的话就不合并, 新的点赞单独建一条通知
+            # 按时间正序, 同一个 key 有多条的时候合并到最新的一条里
+            if key in like_groups and notification.unread:
+                merged_notifications[key] = notification
+        for key, notification in merged_notifications.items():
+            data = notification.data or {}
+            cls._set_likers(
+                notification,
+                like_groups[key],
+                # 之前没有记 actor_ids 的通知只有 actor 一个人
+                data.get('actor_ids', [int(notification.actor_object_id)]),
+                data.get('actors_count', 1),
+            )
+        return merged_notifications
+
+    @classmethod
+    def _set_likers(cls, notification, group, previous_actor_ids=(), previous_count=0):
+        # actor 是最后一个点赞的人, 最近点赞的人的 id 和一共有多少个不同的人点赞记在 data 里
+        # 同一个人取消点赞之后再点赞不会被算两次
+        # 只保留最近的 NOTIFICATION_ACTOR_IDS_LIMIT 个 id, 更早点赞的人再点一次的话还是会被多算一次
+        new_actor_ids = [
+            actor_id for actor_id in group['actor_ids']
+            if actor_id not in previous_actor_ids
+        ]
+        actor_ids = [
+            actor_id for actor_id in previous_actor_ids
+            if actor_id not in group['actor_ids']
+        ] + group['actor_ids']
+        notification.actor_object_id = group['actor_ids'][-1]
+        notification.data = {
+            'actor_ids': actor_ids[-settings.NOTIFICATION_ACTOR_IDS_LIMIT:],
+            'actors_count': previous_count + len(new_actor_ids),
+        }
+        notification.timestamp = group['timestamp']
+
+    @classmethod
+    def _set_descriptions(cls, notifications):
+        # 合并了多个人的通知写成 "A and 12 others liked your tweet"
+        merged = [
+            notification for notification in notifications
+            if (notification.data or {}).get('actors_count', 1) > 1
+        ]
+        if not merged:
+            return
+        usernames = dict(User.objects.filter(
+            id__in={int(notification.actor_object_id) for notification in merged},
+        ).values_list('id', 'username'))
+        for notification in merged:
+            notification.description = '{} and {} others {}'.format(
+                usernames.get(int(notification.actor_object_id), ''),
+                notification.data['actors_count'] - 1,
+                notification.verb,
+            )
+
+    @classmethod
+    def prefetch_generic_objects(cls, notifications, name):
+        # name 是 'actor' 或者 'target', 把一页通知的 actor 或者 target 按照 content type 分组
+        # 每种 content type 只取一次, 存到每个 notification 的 cached_actor 或者 cached_target 上
+        # user 和 tweet 在 memcached 里有 cache, 其他的 (比如 comment) 用一条 id__in 的 query 查出来
+        to_attr = 'cached_' + name
+        object_ids = defaultdict(set)
+        for notification in notifications:
+            content_type_id = getattr(notification, name + '_content_type_id')
+            object_id = getattr(notification, name + '_object_id')
+            if content_type_id is not None and object_id is not None:
+                object_ids[content_type_id].add(int(object_id))
+
+        id_to_object = {}
+        for content_type_id, ids in object_ids.items():
+            model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model_class in (User, Tweet):
+                objects = MemcachedHelper.get_objects_through_cache(model_class, ids)
+            else:
+                objects = model_class.objects.in_bulk(ids)
+            for object_id, obj in objects.items():
+                id_to_object[(content_type_id, object_id)] = obj
+
+        for notification in notifications:
+            object_id = getattr(notification, name + '_object_id')
+            # 已经被删掉了的 actor 或者 target 是 None
+            setattr(notification, to_attr, id_to_object.get((
+                getattr(notification, name + '_content_type_id'),
+                int(object_id) if object_id is not None else None,
+            )))
+
+    # 未读通知数
+    # 客户端会不停地轮询 unread-count, 每次都去数据库 COUNT(*) 压力很大
+    # 所以每个用户的未读数存在 redis 里, 发通知的时候 +1, 标记已读未读的时候相应地加减
+    # 加减的时候 key 不存在就不管, 等读的时候再从数据库里数一遍
+    # 各种并发的情况下计数器可能会有一点偏差, 由 celery 定时任务 reconcile_unread_counts 来修正
+    @classmethod
+    def get_unread_count_key(cls, user_id):
+        return UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_unread_count(cls, user_id):
+        conn = RedisClient.get_connection()
+        key = cls.get_unread_count_key(user_id)
+        count = conn.get(key)
+        if count is not None:
+            # 计数器出了偏差的时候也不要返回负数
+            return max(int(count), 0)
+
+        count = Notification.objects.filter(recipient_id=user_id, unread=True).count()
+        # 数的过程中别的请求可能已经把计数器建好并且加过了, 这种情况下以 redis 里的为准
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME, nx=True)
+        return count
+
+    @classmethod
+    def incr_unread_count(cls, user_id, delta=1):
+        if delta == 0:
             return
-        notify.send(
-            comment.user,
-            recipient=comment.tweet.user,
-            verb='liked your comment',
-            target=comment.tweet,
-        )
\ No newline at end of file
+        cls._get_script(INCR_IF_EXISTS_SCRIPT)(
+            keys=[cls.get_unread_count_key(user_id)],
+            args=[delta],
+        )
+
+    @classmethod
+    def reconcile_unread_counts(cls, batch_size=None):
+        # 把 redis 里所有的未读数和数据库对一遍, 返回修正了多少个计数器
+        if batch_size is None:
+            batch_size = settings.REDIS_PIPELINE_BATCH_SIZE
+        conn = RedisClient.get_connection()
+        pattern = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id='*')
+        keys = []
+        fixed_count = 0
+        for key in conn.scan_iter(match=pattern, count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                fixed_count += cls._reconcile_unread_count_batch(keys)
+                keys = []
+        if keys:
+            fixed_count += cls._reconcile_unread_count_batch(keys)
+        return fixed_count
+
+    @classmethod
+    def _reconcile_unread_count_batch(cls, keys):
+        conn = RedisClient.get_connection()
+        # 先读 redis 再数数据库, 这样对账期间的任何变化都会让 redis 里的值和读到的旧值不一样
+        cached_counts = conn.mget(keys)
+        user_ids = [int(key.decode().rsplit(':', 1)[1]) for key in keys]
+        rows = Notification.objects.filter(
+            recipient_id__in=user_ids,
+            unread=True,
+        ).values('recipient_id').annotate(count=Count('id'))
+        counts = {row['recipient_id']: row['count'] for row in rows}
+
+        fixed_keys, args = [], []
+        for key, user_id, cached_count in zip(keys, user_ids, cached_counts):
+            # 对账期间过期了的 key 就不用管了
+            if cached_count is None:
+                continue
+            fixed_keys.append(key)
+            args.extend([cached_count, counts.get(user_id, 0)])
+        if not fixed_keys:
+            return 0
+        return cls._get_script(RECONCILE_IF_NOT_CHANGED_SCRIPT)(
+            keys=fixed_keys,
+            args=args,
+        )
+
+    # 标记所有通知为已读
+    # 一个用户可能有几十万条未读通知, 一条 UPDATE ... WHERE recipient=? AND unread=1 会长时间锁住这些行
+    # 产生的大事务也会拖慢主从同步, 所以按照主键一段一段地 update
+    @classmethod
+    def mark_all_as_read(cls, user_id, batch_size=None, sleep=0, on_batch=None):
+        # 返回标记了多少条, on_batch(marked_count) 在每一批完成之后调用, 用来汇报进度
+        if batch_size is None:
+            batch_size = settings.NOTIFICATION_MARK_AS_READ_BATCH_SIZE
+        queryset = Notification.objects.filter(recipient_id=user_id, unread=True)
+        # 只标记开始的时候已经有的通知, 标记的过程中新来的通知还是未读的
+        max_id = queryset.aggregate(max_id=Max('id'))['max_id']
+        marked_count, last_id = 0, 0
+        while max_id is not None and last_id < max_id:
+            # (recipient, unread) 的索引里带着主键 id, 按照 id 取下一批不需要排序
+            ids = list(queryset.filter(
+                id__gt=last_id,
+                id__lte=max_id,
+            ).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            updated_count = queryset.filter(
+                id__gt=last_id,
+                id__lte=ids[-1],
+            ).update(unread=False)
+            cls.incr_unread_count(user_id, -updated_count)
+            marked_count += updated_count
+            last_id = ids[-1]
+            if on_batch is not None:
+                on_batch(marked_count)
+            # 最后一批就不用再等了
+            if sleep and len(ids) == batch_size:
+                time.sleep(sleep)
+        return marked_count
+
+    @classmethod
+    def init_mark_as_read_progress(cls, user_id):
+        # 任务进队列的时候就记录下来, worker 还没有开始执行的时候也能查到 pending 的状态
+        # total 用的是 redis 里的未读数, 不需要去数据库里 COUNT(*)
+        # 已经有任务在排队或者在执行的时候不会覆盖它的进度, 返回 False, 调用的地方不要再提交任务
+        return bool(cls._get_script(START_MARK_AS_READ_JOB_SCRIPT)(
+            keys=[MARK_AS_READ_PROGRESS_PATTERN.format(user_id=user_id)],
+            args=[
+                time.time(),
+                settings.NOTIFICATION_MARK_AS_READ_JOB_TIMEOUT,
+                cls.get_unread_count(user_id),
+                settings.NOTIFICATION_MARK_AS_READ_PROGRESS_EXPIRE_TIME,
+            ],
+        ))
+
+    @classmethod
+    def run_mark_as_read_job(cls, user_id, batch_size=None, sleep=None, on_batch=None):
+        # 由 celery 的 mark_all_as_read_task 和 mark_notifications_as_read 命令调用, 会把进度记到 redis 里
+        if sleep is None:
+            sleep = settings.NOTIFICATION_MARK_AS_READ_SLEEP
+        conn = RedisClient.get_connection()
+        key = MARK_AS_READ_PROGRESS_PATTERN.format(user_id=user_id)
+        if not conn.exists(key):
+            cls.init_mark_as_read_progress(user_id)
+        conn.hset(key, 'started_at', time.time())
+
+        def report(marked_count):
+            conn.hset(key, 'marked', marked_count)
+            if on_batch is not None:
+                on_batch(marked_count)
+
+        marked_count = cls.mark_all_as_read(user_id, batch_size, sleep, report)
+        conn.hset(key, mapping={'marked': marked_count, 'finished_at': time.time()})
+        conn.expire(key, settings.NOTIFICATION_MARK_AS_READ_PROGRESS_EXPIRE_TIME)
+        return marked_count
+
+    @classmethod
+    def get_mark_as_read_progress(cls, user_id):
+        conn = RedisClient.get_read_connection()
+        key = MARK_AS_READ_PROGRESS_PATTERN.format(user_id=user_id)
+        progress = {
+            field.decode(): float(value)
+            for field, value in conn.hgetall(key).items()
+        }
+        if not progress:
+            # 没有在后台标记过, 或者进度已经过期
+            return {'status': 'unknown'}
+        if 'finished_at' in progress:
+            status = 'finished'
+        else:
+            status = 'running' if 'started_at' in progress else 'pending'
+        return {
+            'status': status,
+            # total 是开始时 redis 里的未读数, 是一个估计值, 标记的过程中还会有新的通知
+            'total': int(progress.get('total', 0)),
+            'marked': int(progress.get('marked', 0)),
+        }
@@ -0,0 +1,26 @@
+from celery import shared_task
+from inbox.services import NotificationService
+
+ONE_HOUR = 60 * 60
+ONE_MINUTE = 60
+
+
+@shared_task(time_limit=ONE_MINUTE)
+def deliver_notifications_task():
+    # 把 redis 队列里的点赞评论通知批量写进数据库
+    delivered_count = NotificationService.deliver_pending_notifications()
+    return '{} notifications delivered.'.format(delivered_count)
+
+
+@shared_task(time_limit=ONE_HOUR)
+def reconcile_unread_counts_task():
+    # 由 celery beat 定时触发, 用数据库里的未读数修正 redis 里的计数器
+    fixed_count = NotificationService.reconcile_unread_counts()
+    return '{} unread counts fixed.'.format(fixed_count)
+
+
+@shared_task(time_limit=ONE_HOUR)
+def mark_all_as_read_task(user_id):
+    # 未读通知很多的时候, mark-all-as-read 的 api 把标记已读放到后台分批执行
+    marked_count = NotificationService.run_mark_as_read_job(user_id)
+    return '{} notifications marked as read.'.format(marked_count)
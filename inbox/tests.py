@@ -1,6 +1,18 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
 from testing.testcases import TestCase
+from inbox.models import NotificationDelivery
 from inbox.services import NotificationService
+from likes.models import Like
 from notifications.models import Notification  # 这是 notification库自己定义的 model
+from twitter.cache import (
+    DELIVERING_NOTIFICATIONS_ID_KEY,
+    DELIVERING_NOTIFICATIONS_KEY,
+    PENDING_NOTIFICATIONS_KEY,
+)
+from utils.redis_client import RedisClient
 
 
 class NotificationServiceTests(TestCase):
@@ -32,3 +44,151 @@ class NotificationServiceTests(TestCase):
         like = self.create_comment(self.dongxie, self.linghu_tweet)
         NotificationService.send_comment_notification(like)
         self.assertEqual(Notification.objects.count(), 1)
+
+    def test_reconcile_unread_counts(self):
+        comment = self.create_comment(self.dongxie, self.linghu_tweet)
+        NotificationService.send_comment_notification(comment)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 1)
+        self.assertEqual(NotificationService.get_unread_count(self.dongxie.id), 0)
+
+        # 计数器和数据库对不上的时候由对账来修正
+        conn = RedisClient.get_connection()
+        conn.set(NotificationService.get_unread_count_key(self.linghu.id), 5)
+        Notification.objects.create(
+            actor=self.linghu,
+            recipient=self.dongxie,
+            verb='liked your tweet',
+        )
+        self.assertEqual(NotificationService.reconcile_unread_counts(batch_size=1), 2)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 1)
+        self.assertEqual(NotificationService.get_unread_count(self.dongxie.id), 1)
+        self.assertEqual(NotificationService.reconcile_unread_counts(), 0)
+
+    def test_deliver_notifications_in_batch(self):
+        users = [self.create_user('user{}'.format(index)) for index in range(3)]
+        # 不让放进队列的时候马上投递, 模拟 worker 等一会儿再批量投递
+        with mock.patch('inbox.tasks.deliver_notifications_task.apply_async'):
+            for user in users:
+                NotificationService.send_like_notification(
+                    self.create_like(user, self.linghu_tweet),
+                )
+            NotificationService.send_like_notification(
+                self.create_like(self.linghu, self.linghu_tweet),
+            )
+            NotificationService.send_comment_notification(
+                self.create_comment(self.dongxie, self.linghu_tweet),
+            )
+            self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 0)
+
+        # 三个人的点赞合并成一条, 自己给自己点赞的不通知
+        self.assertEqual(NotificationService.deliver_pending_notifications(), 2)
+        self.assertEqual(NotificationService.deliver_pending_notifications(), 0)
+        self.assertEqual(Notification.objects.count(), 2)
+        notification = Notification.objects.get(verb='liked your tweet')
+        self.assertEqual(notification.actor, users[2])
+        self.assertEqual(notification.data, {
+            'actor_ids': [user.id for user in users],
+            'actors_count': 3,
+        })
+        self.assertEqual(notification.description, 'user2 and 2 others liked your tweet')
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 2)
+
+        # 还没读的时候再有人点赞, 合并到原来那条里
+        NotificationService.send_like_notification(
+            self.create_like(self.dongxie, self.linghu_tweet),
+        )
+        self.assertEqual(Notification.objects.count(), 2)
+        notification.refresh_from_db()
+        self.assertEqual(notification.actor, self.dongxie)
+        self.assertEqual(notification.data, {
+            'actor_ids': [user.id for user in users] + [self.dongxie.id],
+            'actors_count': 4,
+        })
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 2)
+
+        # 同一个人取消点赞之后再点赞, 不会被多算一次
+        Like.objects.filter(user=users[0]).delete()
+        NotificationService.send_like_notification(
+            self.create_like(users[0], self.linghu_tweet),
+        )
+        notification.refresh_from_db()
+        self.assertEqual(notification.actor, users[0])
+        self.assertEqual(notification.data, {
+            'actor_ids': [users[1].id, users[2].id, self.dongxie.id, users[0].id],
+            'actors_count': 4,
+        })
+
+        # 读过了之后再有人点赞, 就是一条新的通知了
+        notification.unread = False
+        notification.save()
+        NotificationService.incr_unread_count(self.linghu.id, -1)
+        like = self.create_like(self.create_user('user3'), self.linghu_tweet)
+        NotificationService.send_like_notification(like)
+        self.assertEqual(Notification.objects.count(), 3)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 2)
+
+    def test_deliver_notifications_is_idempotent(self):
+        users = [self.create_user('user{}'.format(index)) for index in range(3)]
+        with mock.patch('inbox.tasks.deliver_notifications_task.apply_async'):
+            for user in users:
+                NotificationService.send_comment_notification(
+                    self.create_comment(user, self.linghu_tweet),
+                )
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 0)
+        # 模拟上一次投递已经把前两个 event 和这一批的 id 写进了数据库, 还没来得及从队列里去掉就挂了
+        conn = RedisClient.get_connection()
+        conn.rename(PENDING_NOTIFICATIONS_KEY, DELIVERING_NOTIFICATIONS_KEY)
+        conn.hset(DELIVERING_NOTIFICATIONS_ID_KEY, mapping={'id': 'crashed', 'offset': 0})
+        NotificationDelivery.objects.create(batch_id='crashed:0', events_count=2)
+
+        # 前两个 event 不会再通知一次, 也不会再加未读数, 只有第三个会投递
+        self.assertEqual(NotificationService.deliver_pending_notifications(), 1)
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(Notification.objects.get().actor, users[2])
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 1)
+        self.assertTrue(NotificationDelivery.objects.filter(batch_id='crashed:2').exists())
+        self.assertFalse(conn.exists(DELIVERING_NOTIFICATIONS_KEY))
+        self.assertFalse(conn.exists(DELIVERING_NOTIFICATIONS_ID_KEY))
+
+        # 正常投递的时候每一批都会记下来
+        NotificationService.send_comment_notification(
+            self.create_comment(self.dongxie, self.linghu_tweet),
+        )
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertEqual(NotificationDelivery.objects.count(), 3)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 2)
+
+    def test_mark_all_as_read_in_batches(self):
+        for index in range(5):
+            user = self.create_user('user{}'.format(index))
+            tweet = self.create_tweet(self.linghu)
+            NotificationService.send_like_notification(self.create_like(user, tweet))
+        NotificationService.send_like_notification(
+            self.create_like(self.linghu, self.create_tweet(self.dongxie)),
+        )
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 5)
+
+        # 每批 2 条, 分 3 批标记完, 每批完成之后汇报一次进度
+        progress = []
+        marked_count = NotificationService.mark_all_as_read(
+            self.linghu.id,
+            batch_size=2,
+            on_batch=progress.append,
+        )
+        self.assertEqual(marked_count, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(self.linghu.notifications.filter(unread=True).count(), 0)
+        self.assertEqual(NotificationService.get_unread_count(self.linghu.id), 0)
+        # 别人的通知不受影响
+        self.assertEqual(NotificationService.get_unread_count(self.dongxie.id), 1)
+        self.assertEqual(NotificationService.mark_all_as_read(self.linghu.id), 0)
+
+        out = StringIO()
+        call_command('mark_notifications_as_read', 'dongxie', batch_size=2, stdout=out)
+        self.assertIn('done, 1 notifications marked as read', out.getvalue())
+        self.assertEqual(NotificationService.get_unread_count(self.dongxie.id), 0)
+        self.assertEqual(
+            NotificationService.get_mark_as_read_progress(self.dongxie.id),
+            {'status': 'finished', 'total': 1, 'marked': 1},
+        )
@@ -1,19 +1,55 @@
 from accounts.api.serializers import UserSerializerForLike
 from comments.models import Comment
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
+from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 from utils.decorators import required_params
+from utils.serializers import PrefetchListSerializer, PrefetchThroughCacheMixin
 
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(PrefetchThroughCacheMixin, serializers.ModelSerializer):
     user = UserSerializerForLike(source='cached_user')
 
     class Meta:
         model = Like
         fields = ('user', 'created_at')  # 为什么没有其他字段
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_user': (User, 'user_id')}
+
+
+class HasLikedMixin:
+    # 一页 tweets 或者 comments 的 has_liked 用一条 query 算出来, 存在 context 里
+    # 不然每渲染一个 object 都要去数据库里查一次
+
+    def prefetch_through_cache(self, objects):
+        super().prefetch_through_cache(objects)
+        has_liked = self.context.setdefault('has_liked', {})
+        # async view 里已经提前查好的就跳过
+        objects = [
+            obj for obj in objects
+            if (obj.__class__, obj.id) not in has_liked
+        ]
+        if not objects:
+            return
+        model_class = objects[0].__class__
+        liked_object_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            model_class,
+            [obj.id for obj in objects],
+        )
+        for obj in objects:
+            has_liked[(model_class, obj.id)] = obj.id in liked_object_ids
+
+    def get_has_liked(self, obj):
+        has_liked = self.context.get('has_liked', {})
+        if (obj.__class__, obj.id) in has_liked:
+            return has_liked[(obj.__class__, obj.id)]
+        # 单独渲染一个 object 的时候没有 prefetch
+        return LikeService.has_liked(self.context['request'].user, obj)
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -0,0 +1,14 @@
+def incr_likes_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from utils.redis_counters import RedisCounters
+    # 被点赞的可能是 tweet 也可能是 comment, 它们都有 likes_count 这个字段
+    model_class = instance.content_type.model_class()
+    RedisCounters.incr(model_class, instance.object_id, 'likes_count')
+
+
+def decr_likes_count(sender, instance, **kwargs):
+    from utils.redis_counters import RedisCounters
+    model_class = instance.content_type.model_class()
+    RedisCounters.decr(model_class, instance.object_id, 'likes_count')
@@ -1,3 +1,41 @@
-from django.test import TestCase
+from comments.models import Comment
+from django.contrib.auth.models import AnonymousUser
+from likes.services import LikeService
+from testing.testcases import TestCase
+from tweets.models import Tweet
 
-# Create your tests here.
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_get_liked_object_ids(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(3)]
+        comment = self.create_comment(self.linghu, tweets[0])
+        self.create_like(self.dongxie, tweets[0])
+        self.create_like(self.dongxie, tweets[2])
+        self.create_like(self.linghu, tweets[1])
+        self.create_like(self.dongxie, comment)
+
+        tweet_ids = [tweet.id for tweet in tweets]
+        with self.assertNumQueries(1):
+            liked_ids = LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {tweets[0].id, tweets[2].id})
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.dongxie, Comment, [comment.id]),
+            {comment.id},
+        )
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.linghu, Comment, [comment.id]),
+            set(),
+        )
+        with self.assertNumQueries(0):
+            liked_ids = LikeService.get_liked_object_ids(
+                AnonymousUser(),
+                Tweet,
+                tweet_ids,
+            )
+        self.assertEqual(liked_ids, set())
@@ -0,0 +1,40 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from newsfeeds.api.paginations import NewsFeedPagination
+from newsfeeds.api.serializers import NewsFeedSerializer
+from newsfeeds.api.views import get_newsfeeds_page
+from tweets.services import TweetService
+from utils.async_helpers import get_api_request
+
+
+# NewsFeedViewSet.list 的 async 版本, 参数和返回的数据都和 GET /api/newsfeeds/ 一样
+async def list_newsfeeds(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    request = await get_api_request(request)
+    if not request.user.is_authenticated:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'},
+            status=403,
+        )
+
+    paginator = NewsFeedPagination()
+    newsfeeds = await sync_to_async(get_newsfeeds_page)(
+        paginator,
+        request,
+        request.user.id,
+    )
+    # newsfeed 里只有 tweet_id, tweets 和渲染 tweets 需要的数据一起同时去取
+    id_to_tweet, has_liked = await TweetService.prefetch_tweets_async(
+        [newsfeed.tweet_id for newsfeed in newsfeeds],
+        request.user,
+    )
+    for newsfeed in newsfeeds:
+        if newsfeed.tweet_id in id_to_tweet:
+            newsfeed.cached_tweet = id_to_tweet[newsfeed.tweet_id]
+    data = await sync_to_async(lambda: NewsFeedSerializer(
+        newsfeeds,
+        context={'request': request, 'has_liked': has_liked},
+        many=True,
+    ).data)()
+    return JsonResponse(paginator.get_paginated_response(data).data)
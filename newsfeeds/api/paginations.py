@@ -0,0 +1,7 @@
+from utils.paginations import KeysetPagination
+
+
+class NewsFeedPagination(KeysetPagination):
+    # 从大 V 那里拉取过来的 newsfeed 并没有存在数据库里, 没有 id
+    # 同一个用户的 newsfeed 里 tweet_id 是唯一的, 所以用 tweet_id 来区分 created_at 相同的 newsfeed
+    tiebreaker = 'tweet_id'
@@ -1,14 +1,19 @@
 from rest_framework.serializers import ModelSerializer
+from tweets.models import Tweet
 
 from tweets.api.serializers import TweetSerializer
 from newsfeeds.models import NewsFeed
+from utils.serializers import PrefetchListSerializer, PrefetchThroughCacheMixin
 
 
-class NewsFeedSerializer(ModelSerializer):
+class NewsFeedSerializer(PrefetchThroughCacheMixin, ModelSerializer):
     # 如果这里不加这个, 会默认显示 tweet 的 id
     # 如果在NewsFeedSerializer 里面传入 context会向下传递到 TweetSerializer
     tweet = TweetSerializer(source='cached_tweet')
 
     class Meta:
         model = NewsFeed
-        fields = ('id', 'created_at', 'tweet', )
\ No newline at end of file
+        fields = ('id', 'created_at', 'tweet', )
+        # 先批量取出这一页的 tweets, 再通过嵌套的 TweetSerializer 批量取出 tweets 的 user
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_tweet': (Tweet, 'tweet_id')}
\ No newline at end of file
@@ -1,11 +1,15 @@
+from django.conf import settings
+from django.test import Client, override_settings
 from friendships.models import Friendship
 from newsfeeds.models import NewsFeed
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.models import Tweet, TweetPhoto
 from utils.paginations import EndlessPagination
 
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
+ASYNC_NEWSFEEDS_URL = '/api/async/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
 FOLLOW_URL = '/api/friendships/{}/follow/'
 
@@ -55,6 +59,47 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['tweet']['id'], posted_tweet_id)
 
+    def test_async_list(self):
+        # async view 不经过 DRF 的认证, 用 session 登录
+        client = Client()
+        response = client.get(ASYNC_NEWSFEEDS_URL)
+        self.assertEqual(response.status_code, 403)
+        client.force_login(self.linghu)
+        response = client.post(ASYNC_NEWSFEEDS_URL)
+        self.assertEqual(response.status_code, 405)
+        response = client.get(ASYNC_NEWSFEEDS_URL)
+        self.assertEqual(response.json()['results'], [])
+
+        self.linghu_client.post(FOLLOW_URL.format(self.dongxie.id))
+        for i in range(3):
+            response = self.dongxie_client.post(POST_TWEETS_URL, {
+                'content': 'Hello World {}'.format(i),
+            })
+        tweet_id = response.data['id']
+        self.create_like(self.linghu, Tweet.objects.get(id=tweet_id))
+        TweetPhoto.objects.create(tweet_id=tweet_id, user=self.dongxie, file='a.jpg')
+
+        # 返回的数据和同步的版本完全一样
+        sync_response = self.linghu_client.get(NEWSFEEDS_URL)
+        async_response = client.get(ASYNC_NEWSFEEDS_URL)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.json(), sync_response.json())
+        results = async_response.json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['tweet']['id'], tweet_id)
+        self.assertEqual(results[0]['tweet']['has_liked'], True)
+        self.assertEqual(results[0]['tweet']['likes_count'], 1)
+        self.assertEqual(len(results[0]['tweet']['photo_urls']), 1)
+        self.assertEqual(results[1]['tweet']['has_liked'], False)
+        self.assertEqual(results[0]['tweet']['user']['username'], 'dongxie')
+
+        # 翻页
+        cursor = async_response.json()['refresh_cursor']
+        sync_response = self.linghu_client.get(NEWSFEEDS_URL, {'cursor': cursor})
+        async_response = client.get(ASYNC_NEWSFEEDS_URL, {'cursor': cursor})
+        self.assertEqual(async_response.json(), sync_response.json())
+        self.assertEqual(len(async_response.json()['results']), 2)
+
     def test_pagination(self):
         page_size = EndlessPagination.page_size
         followed_user = self.create_user('followed')
@@ -111,6 +156,32 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_newsfeed.id)
 
+    @override_settings(CELEBRITY_FOLLOWERS_THRESHOLD=2)
+    def test_pagination_beyond_cache(self):
+        # linghu 关注了大 V dongxie, 同时还有一些 push 过来的 newsfeed
+        self.create_friendship(self.linghu, self.dongxie)
+        followed_user = self.create_user('followed')
+        tweet_ids = []
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT + 10):
+            if i % 2:
+                tweet = self.create_tweet(self.dongxie)
+            else:
+                tweet = self.create_tweet(followed_user)
+                self.create_newsfeed(user=self.linghu, tweet=tweet)
+            tweet_ids.append(tweet.id)
+
+        results, params = [], {}
+        while True:
+            response = self.linghu_client.get(NEWSFEEDS_URL, params)
+            results.extend(response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            params['created_at__lt'] = results[-1]['created_at']
+        self.assertEqual(
+            [result['tweet']['id'] for result in results],
+            tweet_ids[::-1],
+        )
+
     def test_user_cache(self):
         profile = self.dongxie.profile
         profile.nickname = 'huanglaoxie'
@@ -3,14 +3,33 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 
+from newsfeeds.api.paginations import NewsFeedPagination
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed
-from utils.paginations import EndlessPagination
 from newsfeeds.services import NewsFeedServices
 
+def get_newsfeeds_page(paginator, request, user_id):
+    # 只从 cache 里取当前这一页需要的 newsfeed
+    # async view 里也是用这个函数取一页 newsfeeds
+    page = paginator.paginate_cached_list(
+        lambda limit: NewsFeedServices.get_cached_newsfeeds(user_id, limit),
+        request,
+    )
+    # 翻到了 cache 之外的数据, 去数据库里查
+    if page is None:
+        _, older_than = paginator.get_bounds(request)
+        newsfeeds = NewsFeedServices.get_newsfeeds_from_db(
+            user_id,
+            older_than,
+            paginator.page_size + 1,
+        )
+        page = paginator.paginate_queryset(newsfeeds, request)
+    return page
+
+
 class NewsFeedViewSet(GenericViewSet):
     permission_classes = [IsAuthenticated]
-    pagination_class = EndlessPagination
+    pagination_class = NewsFeedPagination
 
     # def get_queryset(self):
     #     # 自定义 queryset，因为 newsfeed 的查看是有权限的
@@ -23,8 +42,7 @@ class NewsFeedViewSet(GenericViewSet):
 
     def list(self, request):  # list 默认是 GET 方法, 不需要特殊定义action
         # queryset = self.paginate_queryset(self.get_queryset())
-        newsfeeds = NewsFeedServices.get_cached_newsfeeds(request.user.id)
-        page = self.paginate_queryset(newsfeeds)
+        page = get_newsfeeds_page(self.paginator, request, request.user.id)
         serializer = NewsFeedSerializer(
             page,
             context={'request': request},
@@ -0,0 +1,7 @@
+from django.conf import settings
+
+# 每个 fanout 子任务最多处理多少个粉丝, 测试的时候设置得小一些才能覆盖到多个 batch 的情况
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# fanout 进度信息在 redis 里保存的时间, 过期之后查询进度会返回 unknown
+FANOUT_PROGRESS_EXPIRE_TIME = 86400  # in seconds
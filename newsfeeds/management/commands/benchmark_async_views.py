@@ -0,0 +1,145 @@
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from friendships.models import Friendship
+from likes.models import Like
+from newsfeeds.services import NewsFeedServices
+from rest_framework.test import APIClient
+from tweets.models import Tweet, TweetPhoto
+from twitter.celery import app as celery_app
+from utils.benchmark_helpers import percentile
+from utils.redis_client import RedisClient
+
+NEWSFEEDS_URL = '/api/newsfeeds/'
+ASYNC_NEWSFEEDS_URL = '/api/async/newsfeeds/'
+
+
+class Command(BaseCommand):
+    help = 'Compare throughput of the WSGI and ASGI newsfeed list endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--authors', type=int, default=10)
+        parser.add_argument('--tweets', type=int, default=5)
+
+    def handle(self, *args, **options):
+        # 会在数据库和 cache 里造很多数据, 只允许在开发环境里跑
+        if not settings.DEBUG:
+            raise CommandError('benchmark can only run when DEBUG = True')
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+        # 多个线程要同时读到这些数据, 不能放在一个回滚的事务里, 跑完之后再删掉
+        prefix = 'bench_{}'.format(uuid.uuid4().hex[:8])
+        reader = self._create_data(prefix, options)
+        # 测试用的 client 发出来的请求 host 都是 testserver
+        allowed_hosts = settings.ALLOWED_HOSTS + ['testserver']
+        try:
+            self.stdout.write('mode  workers  req/s    p50_ms  p95_ms')
+            for mode, run in [('wsgi', self._run_wsgi), ('asgi', self._run_asgi)]:
+                # 先读一次把 cache 建起来, 统计的是 cache 建好之后的情况
+                with override_settings(ALLOWED_HOSTS=allowed_hosts):
+                    run(reader, options['workers'], options['workers'])
+                    duration, latencies = run(
+                        reader,
+                        options['workers'],
+                        options['requests'],
+                    )
+                self.stdout.write('{:<4}  {:>7}  {:>6.1f}  {:>6.2f}  {:>6.2f}'.format(
+                    mode,
+                    options['workers'],
+                    options['requests'] / duration,
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 95) * 1000,
+                ))
+        finally:
+            self._clean(prefix)
+
+    def _create_data(self, prefix, options):
+        reader = User.objects.create_user(username='{}_reader'.format(prefix))
+        for index in range(options['authors']):
+            author = User.objects.create_user(
+                username='{}_author{}'.format(prefix, index),
+            )
+            Friendship.objects.create(from_user=reader, to_user=author)
+            for tweet_index in range(options['tweets']):
+                tweet = Tweet.objects.create(user=author, content=str(tweet_index))
+                NewsFeedServices.fanout_to_followers(tweet)
+                TweetPhoto.objects.create(tweet=tweet, user=author, file='bench.jpg')
+                if tweet_index % 2 == 0:
+                    Like.objects.create(user=reader, content_object=tweet)
+        return reader
+
+    def _run_wsgi(self, reader, workers, requests_count):
+        # WSGI 的每个 worker 线程同一时间只能处理一个请求
+        def run(count):
+            client = APIClient()
+            client.force_authenticate(reader)
+            latencies = []
+            for _ in range(count):
+                start = time.perf_counter()
+                response = client.get(NEWSFEEDS_URL)
+                latencies.append(time.perf_counter() - start)
+                self._check(response)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(run, self._split(requests_count, workers))
+            latencies = [latency for result in results for latency in result]
+        return time.perf_counter() - start, latencies
+
+    def _run_asgi(self, reader, workers, requests_count):
+        # ASGI 在一个 event loop 里同时处理 workers 个请求
+        client = AsyncClient()
+        client.force_login(reader)
+
+        async def run(count):
+            latencies = []
+            for _ in range(count):
+                start = time.perf_counter()
+                response = await client.get(ASYNC_NEWSFEEDS_URL)
+                latencies.append(time.perf_counter() - start)
+                self._check(response)
+            return latencies
+
+        async def main():
+            return await asyncio.gather(*[
+                run(count) for count in self._split(requests_count, workers)
+            ])
+
+        start = time.perf_counter()
+        results = asyncio.run(main())
+        latencies = [latency for result in results for latency in result]
+        return time.perf_counter() - start, latencies
+
+    def _check(self, response):
+        if response.status_code != 200:
+            raise CommandError('request failed with status {}'.format(
+                response.status_code,
+            ))
+
+    def _split(self, requests_count, workers):
+        return [
+            requests_count // workers + (1 if index < requests_count % workers else 0)
+            for index in range(workers)
+        ]
+
+    def _clean(self, prefix):
+        users = User.objects.filter(username__startswith='{}_'.format(prefix))
+        user_ids = list(users.values_list('id', flat=True))
+        TweetPhoto.objects.filter(user_id__in=user_ids).delete()
+        users.delete()
+        # 只需要清理 redis 里这些用户的 timeline, memcached 里的 object 会自己过期
+        conn = RedisClient.get_connection()
+        for key_pattern in ['user_tweets:{}', 'user_newsfeeds:{}']:
+            keys = [key_pattern.format(user_id) for user_id in user_ids]
+            if keys:
+                conn.delete(*keys)
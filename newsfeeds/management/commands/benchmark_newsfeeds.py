@@ -0,0 +1,151 @@
+import sys
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from friendships.models import Friendship
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedServices
+from newsfeeds.tasks import fanout_newsfeeds_main_task
+from tweets.models import Tweet
+from twitter.cache import (
+    FANOUT_PROGRESS_PATTERN,
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWERS_COUNT_PATTERN,
+    FOLLOWINGS_PATTERN,
+    USER_NEWSFEEDS_PATTERN,
+    USER_TWEETS_PATTERN,
+)
+from twitter.celery import app as celery_app
+from utils.benchmark_helpers import measure, percentile, rollback_atomic
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import get_timeline_helper
+
+cache = caches['testing'] if settings.TESTING else caches['default']
+
+
+class Command(BaseCommand):
+    help = 'Compare write cost and read latency of push and hybrid push/pull newsfeeds'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--followers',
+            default='10,100,1000,5000',
+            help='comma separated follower counts of the benchmark author',
+        )
+        parser.add_argument('--threshold', type=int, default=1000)
+        parser.add_argument('--tweets', type=int, default=10)
+        parser.add_argument('--readers', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # 会在数据库和 cache 里造很多数据, 只允许在开发环境里跑
+        if not settings.DEBUG:
+            raise CommandError('benchmark can only run when DEBUG = True')
+        # benchmark 需要在当前进程里把 fanout 跑完才能统计写入的代价
+        # 配置是从 django settings 里按 CELERY_ 前缀读出来的, 所以这里也要用带前缀的 key
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+        self.stdout.write(
+            'followers  mode    write_ms/tweet  sql/tweet  rows/tweet  '
+            'read_p50_ms  read_p95_ms'
+        )
+        for followers_count in options['followers'].split(','):
+            for mode in ('push', 'hybrid'):
+                threshold = options['threshold'] if mode == 'hybrid' else sys.maxsize
+                with override_settings(CELEBRITY_FOLLOWERS_THRESHOLD=threshold):
+                    result = self._run(
+                        int(followers_count),
+                        options['tweets'],
+                        options['readers'],
+                    )
+                self.stdout.write(
+                    '{:>9}  {:<6}  {:>14.2f}  {:>9.1f}  {:>10.1f}  '
+                    '{:>11.2f}  {:>11.2f}'.format(followers_count, mode, *result)
+                )
+
+    def _run(self, followers_count, tweets_count, readers_count):
+        prefix = 'bench_{}'.format(uuid.uuid4().hex[:8])
+        with rollback_atomic():
+            author = User.objects.create(username='{}_author'.format(prefix))
+            User.objects.bulk_create([
+                User(username='{}_{}'.format(prefix, index))
+                for index in range(followers_count)
+            ])
+            # mysql 的 bulk_create 不会回填 id, 这里重新查一次
+            follower_ids = list(User.objects.filter(
+                username__startswith='{}_'.format(prefix),
+            ).exclude(id=author.id).values_list('id', flat=True))
+            Friendship.objects.bulk_create([
+                Friendship(from_user_id=follower_id, to_user_id=author.id)
+                for follower_id in follower_ids
+            ])
+
+            write_durations, write_queries, tweet_ids = [], [], []
+            for index in range(tweets_count):
+                tweet = Tweet.objects.create(user=author, content=str(index))
+                tweet_ids.append(tweet.id)
+                duration, queries, _ = measure(
+                    fanout_newsfeeds_main_task,
+                    tweet.id,
+                    author.id,
+                )
+                write_durations.append(duration)
+                write_queries.append(queries)
+            rows_count = NewsFeed.objects.filter(tweet_id__in=tweet_ids).count()
+
+            read_durations = []
+            for follower_id in follower_ids[:readers_count]:
+                # 第一次读会把 cache 建起来, 统计的是 cache 建好之后的读延迟
+                NewsFeedServices.get_cached_newsfeeds(follower_id)
+                duration, _, _ = measure(
+                    NewsFeedServices.get_cached_newsfeeds,
+                    follower_id,
+                )
+                read_durations.append(duration)
+
+        self._clean_cache(author.id, follower_ids, tweet_ids)
+        return (
+            sum(write_durations) / tweets_count * 1000,
+            sum(write_queries) / tweets_count,
+            rows_count / tweets_count,
+            percentile(read_durations, 50) * 1000,
+            percentile(read_durations, 95) * 1000,
+        )
+
+    def _clean_cache(self, author_id, follower_ids, tweet_ids):
+        # 数据库已经回滚了, cache 里对应的 key 也要删掉
+        conn = RedisClient.get_connection()
+        user_ids = [author_id] + follower_ids
+        helper = get_timeline_helper()
+        redis_keys = [
+            helper.get_key(USER_TWEETS_PATTERN.format(user_id=author_id)),
+            FOLLOWER_IDS_PATTERN.format(user_id=author_id),
+        ]
+        redis_keys += [
+            helper.get_key(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+            for user_id in user_ids
+        ]
+        redis_keys += [
+            FOLLOWINGS_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        ]
+        redis_keys += [
+            FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+            for tweet_id in tweet_ids
+        ]
+        conn.delete(*redis_keys)
+
+        memcached_keys = [FOLLOWERS_COUNT_PATTERN.format(user_id=author_id)]
+        memcached_keys += [
+            MemcachedHelper.get_key(User, user_id)
+            for user_id in user_ids
+        ]
+        memcached_keys += [
+            MemcachedHelper.get_key(Tweet, tweet_id)
+            for tweet_id in tweet_ids
+        ]
+        cache.delete_many(memcached_keys)
@@ -0,0 +1,63 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from newsfeeds.models import NewsFeed
+from utils.benchmark_helpers import count_redis_round_trips
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+BENCHMARK_KEY_PATTERN = 'benchmark_newsfeeds:{user_id}'
+
+
+class Command(BaseCommand):
+    help = 'Compare redis round trips of push_object and push_objects_many during fanout'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--followers',
+            default='100,1000,10000',
+            help='comma separated follower counts to fanout to',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError('benchmark can only run when DEBUG = True')
+
+        self.stdout.write('followers  mode        round_trips  total_ms')
+        for followers_count in options['followers'].split(','):
+            followers_count = int(followers_count)
+            for mode in ('push_object', 'push_objects_many'):
+                round_trips, duration = self._run(followers_count, mode)
+                self.stdout.write('{:>9}  {:<17}  {:>11}  {:>8.2f}'.format(
+                    followers_count,
+                    mode,
+                    round_trips,
+                    duration * 1000,
+                ))
+
+    def _run(self, followers_count, mode):
+        conn = RedisClient.get_connection()
+        keys = [
+            BENCHMARK_KEY_PATTERN.format(user_id=user_id)
+            for user_id in range(followers_count)
+        ]
+        # 所有粉丝的 newsfeed 都已经在 cache 里了, 这样两种方式都只会写 redis 不会查数据库
+        pipeline = conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.rpush(key, 'placeholder')
+        pipeline.execute()
+
+        newsfeed = NewsFeed(id=1, user_id=1, tweet_id=1, created_at=timezone.now())
+        with count_redis_round_trips() as counter:
+            start = time.perf_counter()
+            if mode == 'push_object':
+                for key in keys:
+                    RedisHelper.push_object(key, newsfeed, NewsFeed.objects.none())
+            else:
+                RedisHelper.push_objects_many({key: newsfeed for key in keys})
+            duration = time.perf_counter() - start
+
+        conn.delete(*keys)
+        return counter['round_trips'], duration
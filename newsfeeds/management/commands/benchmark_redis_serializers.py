@@ -0,0 +1,46 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare size and speed of the serializers used for objects cached in redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        # 只是测试序列化的速度, 不需要把 object 存进数据库
+        objects = [
+            Tweet(id=1, user_id=1, content='x' * 140, created_at=timezone.now()),
+            NewsFeed(id=1, user_id=1, tweet_id=1, created_at=timezone.now()),
+        ]
+        serializers = [
+            ('json', DjangoModelSerializer),
+            ('compact', CompactModelSerializer),
+        ]
+        number = options['number']
+
+        self.stdout.write('model     serializer  bytes  encode_ops/s  decode_ops/s')
+        for obj in objects:
+            for name, serializer in serializers:
+                serialized_data = serializer.serialize(obj)
+                encode_seconds = timeit.timeit(
+                    lambda: serializer.serialize(obj),
+                    number=number,
+                )
+                decode_seconds = timeit.timeit(
+                    lambda: serializer.deserialize(serialized_data),
+                    number=number,
+                )
+                self.stdout.write('{:<8}  {:<10}  {:>5}  {:>12.0f}  {:>12.0f}'.format(
+                    obj._meta.model_name,
+                    name,
+                    len(serialized_data),
+                    number / encode_seconds,
+                    number / decode_seconds,
+                ))
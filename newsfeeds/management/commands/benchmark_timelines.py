@@ -0,0 +1,171 @@
+import random
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from friendships.models import Friendship
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedServices
+from newsfeeds.tasks import fanout_newsfeeds_main_task
+from tweets.models import Tweet
+from twitter.cache import (
+    FANOUT_PROGRESS_PATTERN,
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWERS_COUNT_PATTERN,
+    FOLLOWINGS_PATTERN,
+    USER_NEWSFEEDS_PATTERN,
+    USER_TWEETS_PATTERN,
+)
+from twitter.celery import app as celery_app
+from utils.benchmark_helpers import measure, percentile, rollback_atomic
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper, RedisSortedSetHelper, get_timeline_helper
+
+cache = caches['testing'] if settings.TESTING else caches['default']
+
+
+class Command(BaseCommand):
+    help = 'Compare redis memory and read latency of list and sorted set timelines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--authors', type=int, default=50)
+        parser.add_argument('--tweets', type=int, default=20)
+        parser.add_argument('--readers', type=int, default=100)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # 会在数据库和 cache 里造很多数据, 只允许在开发环境里跑
+        if not settings.DEBUG:
+            raise CommandError('benchmark can only run when DEBUG = True')
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+
+        self.stdout.write(
+            'backend  keys  redis_kb  bytes/entry  read_p50_ms  read_p95_ms'
+        )
+        for backend in ('list', 'zset'):
+            with override_settings(TIMELINE_BACKEND=backend):
+                result = self._run(options)
+            self.stdout.write(
+                '{:<7}  {:>4}  {:>8.1f}  {:>11.1f}  {:>11.2f}  {:>11.2f}'.format(
+                    backend,
+                    *result
+                )
+            )
+
+    def _build_graph(self, prefix, options):
+        User.objects.bulk_create([
+            User(username='{}_{}'.format(prefix, index))
+            for index in range(options['users'])
+        ])
+        user_ids = list(User.objects.filter(
+            username__startswith='{}_'.format(prefix),
+        ).order_by('id').values_list('id', flat=True))
+
+        # 粉丝数按照幂律分布, 少数作者有大量粉丝, 大部分作者只有很少的粉丝
+        rng = random.Random(options['seed'])
+        author_ids = user_ids[:options['authors']]
+        friendships = []
+        for rank, author_id in enumerate(author_ids, start=1):
+            followers_count = min(len(user_ids) - 1, len(user_ids) // rank)
+            for follower_id in rng.sample(user_ids, followers_count + 1):
+                if follower_id != author_id:
+                    friendships.append(Friendship(
+                        from_user_id=follower_id,
+                        to_user_id=author_id,
+                    ))
+        Friendship.objects.bulk_create(friendships, batch_size=1000)
+        return user_ids, author_ids
+
+    def _run(self, options):
+        prefix = 'bench_{}'.format(uuid.uuid4().hex[:8])
+        conn = RedisClient.get_connection()
+        with rollback_atomic():
+            user_ids, author_ids = self._build_graph(prefix, options)
+            tweet_ids = []
+            for index in range(options['tweets']):
+                for author_id in author_ids:
+                    tweet = Tweet.objects.create(
+                        user_id=author_id,
+                        content='{} {}'.format(prefix, index),
+                    )
+                    tweet_ids.append(tweet.id)
+                    fanout_newsfeeds_main_task(tweet.id, author_id)
+
+            readers = user_ids[-options['readers']:]
+            read_durations = []
+            for user_id in readers:
+                # 第一次读会把 cache 建起来, 统计的是 cache 建好之后读第一页的延迟
+                self._read_first_page(user_id, options['page_size'])
+                duration, _, _ = measure(
+                    self._read_first_page,
+                    user_id,
+                    options['page_size'],
+                )
+                read_durations.append(duration)
+
+            keys = [
+                get_timeline_helper().get_key(
+                    USER_NEWSFEEDS_PATTERN.format(user_id=user_id),
+                )
+                for user_id in readers
+            ]
+            memory = sum(conn.memory_usage(key) or 0 for key in keys)
+            entries = NewsFeed.objects.filter(user_id__in=readers).count()
+            newsfeed_ids = list(NewsFeed.objects.filter(
+                tweet_id__in=tweet_ids,
+            ).values_list('id', flat=True))
+
+        self._clean_cache(user_ids, tweet_ids, newsfeed_ids)
+        return (
+            len(keys),
+            memory / 1024,
+            memory / max(entries, 1),
+            percentile(read_durations, 50) * 1000,
+            percentile(read_durations, 95) * 1000,
+        )
+
+    def _read_first_page(self, user_id, page_size):
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(user_id, page_size + 1)
+        # 渲染的时候还需要 tweet 的内容, 两种 backend 都是从 memcached 里批量取出来
+        MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        return newsfeeds
+
+    def _clean_cache(self, user_ids, tweet_ids, newsfeed_ids):
+        # 数据库已经回滚了, cache 里对应的 key 也要删掉
+        conn = RedisClient.get_connection()
+        redis_keys = []
+        for user_id in user_ids:
+            # 两种 backend 的 key 都要删
+            for helper in [RedisHelper, RedisSortedSetHelper]:
+                redis_keys.append(helper.get_key(USER_TWEETS_PATTERN.format(user_id=user_id)))
+                redis_keys.append(helper.get_key(USER_NEWSFEEDS_PATTERN.format(user_id=user_id)))
+            redis_keys.append(FOLLOWER_IDS_PATTERN.format(user_id=user_id))
+            redis_keys.append(FOLLOWINGS_PATTERN.format(user_id=user_id))
+        redis_keys += [
+            FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+            for tweet_id in tweet_ids
+        ]
+        conn.delete(*redis_keys)
+
+        memcached_keys = []
+        for user_id in user_ids:
+            memcached_keys.append(FOLLOWERS_COUNT_PATTERN.format(user_id=user_id))
+            memcached_keys.append(MemcachedHelper.get_key(User, user_id))
+        memcached_keys += [
+            MemcachedHelper.get_key(Tweet, tweet_id)
+            for tweet_id in tweet_ids
+        ]
+        memcached_keys += [
+            MemcachedHelper.get_key(NewsFeed, newsfeed_id)
+            for newsfeed_id in newsfeed_ids
+        ]
+        cache.delete_many(memcached_keys)
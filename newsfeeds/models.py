@@ -3,6 +3,7 @@ from django.db import models
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
 from django.db.models.signals import post_save
+from django.utils.functional import cached_property
 from newsfeeds.listeners import push_newsfeed_to_cache
 
 class NewsFeed(models.Model):
@@ -19,7 +20,7 @@ class NewsFeed(models.Model):
         # 虽然这里默认了使用ordering的排序方法, 还是建议在 viewset 中取 queryset 的时候直接指定 order_by
         # 这样对看代码的人来说, 更直观. 不需要到深入一层到 model 中才能发现排序的逻辑
 
-    @property
+    @cached_property
     def cached_tweet(self):
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
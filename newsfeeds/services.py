@@ -1,7 +1,17 @@
-from newsfeeds.models import NewsFeed
+import heapq
+import time
+
+from django.conf import settings
 from friendships.services import FriendshipService
-from utils.redis_helper import RedisHelper
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from newsfeeds.constants import FANOUT_PROGRESS_EXPIRE_TIME
+from newsfeeds.models import NewsFeed
+from newsfeeds.tasks import fanout_newsfeeds_main_task
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import FANOUT_PROGRESS_PATTERN, USER_NEWSFEEDS_PATTERN
+from utils.paginations import KeysetPagination
+from utils.redis_client import RedisClient
+from utils.redis_helper import get_timeline_helper
 
 
 class NewsFeedServices(object):
@@ -16,28 +26,204 @@ class NewsFeedServices(object):
         #         tweet=tweet,
         #     )
 
+        # 粉丝很多的时候, 即使使用 bulk_create 也会让发 tweet 的请求卡很久
+        # 所以这里只是把 fanout 的任务放进消息队列里, 由 celery worker 异步执行
+        # 注意这里只能传 id 这种可以被序列化的参数, 不能直接把 tweet 传进去
+        cls.init_fanout_progress(tweet.id)
+        fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
+
+    @classmethod
+    def batch_create(cls, tweet_id, user_ids):
         # 正确的方法：使用 bulk_create，会把 insert 语句合成一条
         newsfeeds = [
-            NewsFeed(user=follower, tweet=tweet)
-            for follower in FriendshipService.get_followers(tweet.user)
+            NewsFeed(user_id=user_id, tweet_id=tweet_id)
+            for user_id in user_ids
         ]
-        # 加上自己可以看自己的 tweet
-        newsfeeds.append(NewsFeed(user=tweet.user, tweet=tweet))
-        NewsFeed.objects.bulk_create(newsfeeds)
+        # 粉丝的 id 是用 sscan 分批取的, 不同的 batch 里偶尔会有同一个粉丝, 已经创建过的 newsfeed 直接忽略
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+
         # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-        for newsfeed in newsfeeds:
-            cls.push_newsfeed_to_cache(newsfeed)
+        # mysql 下 bulk_create 也不会把 id 回填到 object 上, 所以重新查一次
+        # 用的是 (user, tweet) 的 unique index, 这样 cache 里的 newsfeed 才会有 id
+        newsfeeds = NewsFeed.objects.filter(
+            tweet_id=tweet_id,
+            user_id__in=user_ids,
+        )
+        cls.push_newsfeeds_to_cache(newsfeeds)
 
     @classmethod
-    def get_cached_newsfeeds(cls, user_id):
+    def get_cached_newsfeeds(cls, user_id, limit=None):
+        # limit 表示只需要最新的 limit 条 newsfeed, 每个来源最多也只需要取 limit 条
         queryset = NewsFeed.objects.filter(user_id=user_id).order_by(
-            '-created_at')
+            '-created_at', '-tweet_id')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        pushed_newsfeeds = get_timeline_helper().load_objects(key, queryset, limit)
+
+        celebrity_ids = cls.get_celebrity_ids(
+            FriendshipService.get_following_user_id_set(user_id),
+        )
+        if not celebrity_ids:
+            return pushed_newsfeeds
+
+        # 大 V 的 tweet 没有 fanout 过来, 读的时候从大 V 自己的 tweets cache 里拉取
+        pulled_newsfeeds = [
+            cls._tweets_to_newsfeeds(user_id, TweetService.get_cached_tweets(
+                celebrity_id,
+                limit,
+            ))
+            for celebrity_id in celebrity_ids
+        ]
+        return cls._merge_newsfeeds(pushed_newsfeeds, pulled_newsfeeds, limit)
+
+    @classmethod
+    def get_newsfeeds_from_db(cls, user_id, older_than=None, limit=None):
+        # cache 里只存了最新的 REDIS_LIST_LENGTH_LIMIT 条, 翻页翻到更后面的时候从数据库里读
+        # 和 cache 一样, 要把 push 的 newsfeed 和大 V 的 tweet 合并起来
+        # older_than 是翻页的 cursor, 即 (created_at, tweet_id)
+        newsfeeds = NewsFeed.objects.filter(user_id=user_id)
+        if older_than is not None:
+            newsfeeds = KeysetPagination.filter_older_than(
+                newsfeeds,
+                older_than,
+                'tweet_id',
+            )
+        pushed_newsfeeds = list(
+            newsfeeds.order_by('-created_at', '-tweet_id')[:limit],
+        )
+
+        celebrity_ids = cls.get_celebrity_ids(
+            FriendshipService.get_following_user_id_set(user_id),
+        )
+        if not celebrity_ids:
+            return pushed_newsfeeds
+
+        # 所有大 V 的 tweet 用一条 query 查出来, 用的是 (user, created_at) 的联合索引
+        tweets = Tweet.objects.filter(user_id__in=celebrity_ids)
+        if older_than is not None:
+            tweets = KeysetPagination.filter_older_than(tweets, older_than, 'id')
+        pulled_newsfeeds = cls._tweets_to_newsfeeds(
+            user_id,
+            tweets.order_by('-created_at', '-id')[:limit],
+        )
+        return cls._merge_newsfeeds(pushed_newsfeeds, [pulled_newsfeeds], limit)
+
+    @classmethod
+    def _merge_newsfeeds(cls, pushed_newsfeeds, pulled_newsfeeds, limit=None):
+        # 每一路都已经是按 (created_at, tweet_id) 倒序排好的, 用 heapq 做多路归并
+        merged_newsfeeds = heapq.merge(
+            pushed_newsfeeds,
+            *pulled_newsfeeds,
+            key=lambda newsfeed: (newsfeed.created_at, newsfeed.tweet_id),
+            reverse=True,
+        )
+
+        # 在成为大 V 之前发的 tweet 已经 push 过了, 这里要去重
+        newsfeeds, tweet_ids = [], set()
+        for newsfeed in merged_newsfeeds:
+            if newsfeed.tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(newsfeed.tweet_id)
+            newsfeeds.append(newsfeed)
+            if limit is not None and len(newsfeeds) >= limit:
+                break
+        return newsfeeds
+
+    @classmethod
+    def _tweets_to_newsfeeds(cls, user_id, tweets):
+        # 拉取过来的 newsfeed 并没有存在数据库里, 所以没有 id
+        return [
+            NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+            for tweet in tweets
+        ]
+
+    @classmethod
+    def get_celebrity_ids(cls, user_ids):
+        follower_counts = FriendshipService.get_follower_counts(list(user_ids))
+        return [
+            user_id
+            for user_id, count in follower_counts.items()
+            if count >= settings.CELEBRITY_FOLLOWERS_THRESHOLD
+        ]
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by(
-            '-created_at')
+            '-created_at', '-tweet_id')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        get_timeline_helper().push_object(key, newsfeed, queryset)
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # 批量版本的 push_newsfeed_to_cache, 用 pipeline 一次写很多个用户的 cache
+        get_timeline_helper().push_objects_many({
+            USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id): newsfeed
+            for newsfeed in newsfeeds
+        }, tiebreaker='tweet_id')
+
+    @classmethod
+    def init_fanout_progress(cls, tweet_id):
+        # 任务进队列的时候就记录下来, worker 还没有开始执行的时候也能查到 pending 的状态
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn.hset(key, mapping={'enqueued_at': time.time()})
+        conn.expire(key, FANOUT_PROGRESS_EXPIRE_TIME)
+
+    @classmethod
+    def start_fanout(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn.hset(key, 'started_at', time.time())
+        conn.expire(key, FANOUT_PROGRESS_EXPIRE_TIME)
+
+    @classmethod
+    def set_fanout_total(cls, tweet_id, followers_count, total_batches):
+        # 所有子任务都发出去之后才调用, 这时候可能已经有子任务执行完了
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn.hset(key, mapping={
+            'followers_count': followers_count,
+            'total_batches': total_batches,
+        })
+        # 和 finish_fanout_batch 一样, 先写自己的值再读对方的值
+        # 不管谁先谁后, 至少有一方能看到所有的 batch 都完成了
+        finished_batches = conn.hincrby(key, 'finished_batches', 0)
+        if finished_batches >= total_batches:
+            conn.hset(key, 'finished_at', time.time())
+
+    @classmethod
+    def finish_fanout_batch(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        # hincrby 是原子操作, 多个 worker 同时完成 batch 的时候也不会少算
+        finished_batches = conn.hincrby(key, 'finished_batches', 1)
+        total_batches = conn.hget(key, 'total_batches')
+        if total_batches is not None and finished_batches >= int(total_batches):
+            conn.hset(key, 'finished_at', time.time())
+
+    @classmethod
+    def get_fanout_progress(cls, tweet):
+        conn = RedisClient.get_read_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet.id)
+        progress = {
+            field.decode(): float(value)
+            for field, value in conn.hgetall(key).items()
+        }
+        if not progress:
+            # 进度已经过期, 或者是异步 fanout 上线之前发的 tweet
+            return {'tweet_id': tweet.id, 'status': 'unknown'}
+
+        if 'finished_at' in progress:
+            status = 'finished'
+            end_time = progress['finished_at']
+        else:
+            status = 'running' if 'started_at' in progress else 'pending'
+            end_time = time.time()
+        return {
+            'tweet_id': tweet.id,
+            'status': status,
+            'followers_count': int(progress.get('followers_count', 0)),
+            'total_batches': int(progress.get('total_batches', 0)),
+            'finished_batches': int(progress.get('finished_batches', 0)),
+            # lag 是从 tweet 创建到所有粉丝都能看到这条 tweet 之间的时间
+            'lag_seconds': round(end_time - tweet.created_at.timestamp(), 3),
+        }
@@ -0,0 +1,51 @@
+from celery import shared_task
+from django.conf import settings
+from friendships.services import FriendshipService
+from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.models import NewsFeed
+
+ONE_HOUR = 60 * 60
+
+
+@shared_task(queue='newsfeeds', time_limit=ONE_HOUR)
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedServices
+    NewsFeedServices.batch_create(tweet_id, follower_ids)
+    NewsFeedServices.finish_fanout_batch(tweet_id)
+    return '{} newsfeeds created'.format(len(follower_ids))
+
+
+@shared_task(queue='newsfeeds', time_limit=ONE_HOUR)
+def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
+    from newsfeeds.services import NewsFeedServices
+    # 先把自己的 newsfeed 创建出来, 确保自己能最快看到自己发的 tweet
+    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    NewsFeedServices.start_fanout(tweet_id)
+    # 大 V 的粉丝太多, 不做 fanout, 粉丝读 newsfeed 的时候再来拉取大 V 的 tweet
+    followers_count = FriendshipService.get_follower_count(tweet_user_id)
+    if followers_count >= settings.CELEBRITY_FOLLOWERS_THRESHOLD:
+        NewsFeedServices.set_fanout_total(tweet_id, followers_count, 0)
+        return 'celebrity with {} followers, fanout skipped.'.format(
+            followers_count,
+        )
+
+    # 粉丝可能非常多, 一个 task 里全部创建的话会占用 worker 很久
+    # 所以按照 FANOUT_BATCH_SIZE 拆成多个子任务, 可以分散到多个 worker 上并行执行
+    # 粉丝的 id 一批一批地从 redis 里取出来, 取出一批就发一个子任务
+    followers_count, batches_count = 0, 0
+    for follower_ids in FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+    ):
+        fanout_newsfeeds_batch_task.delay(tweet_id, follower_ids)
+        followers_count += len(follower_ids)
+        batches_count += 1
+    # 子任务可能已经执行完了一部分, 总数要等所有子任务都发出去之后才知道
+    NewsFeedServices.set_fanout_total(tweet_id, followers_count, batches_count)
+
+    return '{} newsfeeds going to fanout, {} batches created.'.format(
+        followers_count,
+        batches_count,
+    )
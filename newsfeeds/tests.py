@@ -1,7 +1,14 @@
+from unittest import mock
+
+from django.test import override_settings
+from friendships.services import FriendshipService
+from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedServices
+from newsfeeds.tasks import fanout_newsfeeds_main_task
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisSortedSetHelper
 
 
 class NewsFeedServiceTests(TestCase):
@@ -34,6 +41,37 @@ class NewsFeedServiceTests(TestCase):
         newsfeed_ids.insert(0, new_newsfeed.id)
         self.assertEqual([f.id for f in newsfeeds], newsfeed_ids)
 
+    @override_settings(CELEBRITY_FOLLOWERS_THRESHOLD=2)
+    def test_get_newsfeeds_with_celebrity(self):
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.dongxie, celebrity)
+        self.create_friendship(self.linghu, self.dongxie)
+
+        # 成为大 V 之前已经 push 过来的 tweet 不会重复出现
+        pushed_tweet = self.create_tweet(celebrity)
+        self.create_newsfeed(self.linghu, pushed_tweet)
+        celebrity_tweet1 = self.create_tweet(celebrity)
+        dongxie_tweet = self.create_tweet(self.dongxie)
+        dongxie_newsfeed = self.create_newsfeed(self.linghu, dongxie_tweet)
+        celebrity_tweet2 = self.create_tweet(celebrity)
+
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [celebrity_tweet2.id, dongxie_tweet.id, celebrity_tweet1.id, pushed_tweet.id],
+        )
+        self.assertEqual(newsfeeds[1].id, dongxie_newsfeed.id)
+        # 拉取过来的 newsfeed 没有存在数据库里
+        self.assertEqual(newsfeeds[0].id, None)
+        self.assertEqual(newsfeeds[0].user_id, self.linghu.id)
+
+        # 没有关注大 V 的用户不受影响
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual(len(newsfeeds), 3)
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(celebrity.id)
+        self.assertEqual(newsfeeds, [])
+
     def test_create_new_newsfeed_before_get_cached_newsfeeds(self):
         feed1 = self.create_newsfeed(self.linghu, self.create_tweet(self.linghu))
 
@@ -46,4 +84,153 @@ class NewsFeedServiceTests(TestCase):
         self.assertEqual(conn.exists(key), True)
 
         feeds = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
-        self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
\ No newline at end of file
+        self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
+
+    @override_settings(TIMELINE_BACKEND='zset')
+    def test_sorted_set_timeline(self):
+        conn = RedisClient.get_connection()
+        key = RedisSortedSetHelper.get_key(
+            USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id),
+        )
+        newsfeeds = [
+            self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+            for i in range(3)
+        ]
+        # created_at 相同的时候按照 tweet_id 倒序
+        NewsFeed.objects.filter(id=newsfeeds[0].id).update(
+            created_at=newsfeeds[1].created_at,
+        )
+
+        # cache miss, sorted set 里只存了 id
+        cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(conn.type(key), b'zset')
+        self.assertEqual(conn.zcard(key), 3)
+        expected_ids = [newsfeeds[2].id, newsfeeds[1].id, newsfeeds[0].id]
+        self.assertEqual([newsfeed.id for newsfeed in cached_list], expected_ids)
+
+        # cache hit, 从 memcached 里取出 newsfeed
+        cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id, 2)
+        self.assertEqual([newsfeed.id for newsfeed in cached_list], expected_ids[:2])
+        self.assertEqual(cached_list[0].tweet_id, newsfeeds[2].tweet_id)
+
+        # fanout 的时候批量 push
+        self.create_friendship(self.linghu, self.dongxie)
+        tweet = self.create_tweet(self.dongxie)
+        fanout_newsfeeds_main_task(tweet.id, self.dongxie.id)
+        cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(cached_list[0].tweet_id, tweet.id)
+        self.assertEqual(len(cached_list), 4)
+
+
+    def test_switch_timeline_backend(self):
+        # 切换 backend 的时候另一种 backend 的 key 还没有过期, 读写都不会报 WRONGTYPE
+        for old_backend, new_backend in [('list', 'zset'), ('zset', 'list')]:
+            self.clear_cache()
+            NewsFeed.objects.all().delete()
+            with override_settings(TIMELINE_BACKEND=old_backend):
+                feed1 = self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+                NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+            with override_settings(TIMELINE_BACKEND=new_backend):
+                cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+                self.assertEqual([f.id for f in cached_list], [feed1.id])
+                feed2 = self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+                cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+                self.assertEqual([f.id for f in cached_list], [feed2.id, feed1.id])
+
+
+class NewsFeedTaskTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_fanout_main_task(self):
+        tweet = self.create_tweet(self.linghu, 'tweet 1')
+        self.create_friendship(self.dongxie, self.linghu)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(1 + 1, NewsFeed.objects.count())
+        cached_list = NewsFeedServices.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(len(cached_list), 1)
+
+        # 粉丝数量超过 FANOUT_BATCH_SIZE 之后会被拆成多个 batch
+        for i in range(2):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu, 'tweet 2')
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, '3 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(4 + 2, NewsFeed.objects.count())
+
+        for i in range(2, 6):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu, 'tweet 3')
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, '7 newsfeeds going to fanout, 3 batches created.')
+        self.assertEqual(8 + 6, NewsFeed.objects.count())
+
+        # 从 cache 里读出来的 newsfeed 都是带 id 的
+        cached_list = NewsFeedServices.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual(len(cached_list), 3)
+        for newsfeed in cached_list:
+            self.assertNotEqual(newsfeed.id, None)
+
+        progress = NewsFeedServices.get_fanout_progress(tweet)
+        self.assertEqual(progress['status'], 'finished')
+        self.assertEqual(progress['followers_count'], 7)
+        self.assertEqual(progress['total_batches'], 3)
+        self.assertEqual(progress['finished_batches'], 3)
+
+    def test_fanout_with_duplicate_follower_ids(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            self.create_friendship(user, self.linghu)
+        # 先把粉丝的 set 建起来
+        list(FriendshipService.iter_follower_id_batches(self.linghu.id, 3))
+
+        # sscan 在 rehash 的时候可能返回重复的成员, 同一批里的会被去掉, 不同批之间的会留下来
+        member_ids = [users[0].id, users[1].id, users[0].id, users[2].id] + [users[0].id] * 3
+        conn = RedisClient.get_connection()
+        with mock.patch.object(
+            type(conn),
+            'sscan_iter',
+            return_value=iter(str(member_id).encode() for member_id in member_ids),
+        ):
+            self.assertEqual(
+                list(FriendshipService.iter_follower_id_batches(self.linghu.id, 3)),
+                [
+                    [users[0].id, users[1].id, users[2].id],
+                    [users[0].id],
+                ],
+            )
+
+        # fanout 的时候重复的粉丝也只会有一条 newsfeed
+        tweet = self.create_tweet(self.linghu)
+        member_ids = [users[0].id, users[1].id, users[2].id, users[0].id]
+        with mock.patch.object(
+            type(conn),
+            'sscan_iter',
+            return_value=iter(str(member_id).encode() for member_id in member_ids),
+        ):
+            fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        for user in users:
+            self.assertEqual(NewsFeed.objects.filter(user=user, tweet=tweet).count(), 1)
+            newsfeeds = NewsFeedServices.get_cached_newsfeeds(user.id)
+            self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweet.id])
+
+    @override_settings(CELEBRITY_FOLLOWERS_THRESHOLD=2)
+    def test_fanout_main_task_for_celebrity(self):
+        for i in range(2):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.linghu.id)
+        self.assertEqual(msg, 'celebrity with 2 followers, fanout skipped.')
+        # 只给自己创建了 newsfeed
+        self.assertEqual(NewsFeed.objects.count(), 1)
+        self.assertEqual(NewsFeed.objects.first().user_id, self.linghu.id)
+        progress = NewsFeedServices.get_fanout_progress(tweet)
+        self.assertEqual(progress['status'], 'finished')
+        self.assertEqual(progress['total_batches'], 0)
@@ -3,6 +3,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
 from django.test import TestCase as DjangoTestCase  # 把 django 自带的重命名
+from friendships.models import Friendship
 from likes.models import Like
 from rest_framework.test import APIClient
 from tweets.models import Tweet
@@ -73,4 +74,7 @@ class TestCase(DjangoTestCase):
         return user, client
 
     def create_newsfeed(self, user, tweet):
-        return NewsFeed.objects.create(user=user, tweet=tweet)
\ No newline at end of file
+        return NewsFeed.objects.create(user=user, tweet=tweet)
+
+    def create_friendship(self, from_user, to_user):
+        return Friendship.objects.create(from_user=from_user, to_user=to_user)
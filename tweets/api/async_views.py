@@ -0,0 +1,37 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from tweets.api.serializers import TweetSerializer
+from tweets.api.views import get_tweets_page
+from tweets.services import TweetService
+from utils.async_helpers import get_api_request
+from utils.paginations import KeysetPagination
+
+
+# DRF 的 view 还不支持 async, 这里用 django 的 async view 实现 TweetViewSet.list 的 async 版本
+# 参数和返回的数据都和 GET /api/tweets/ 一样, 需要用 ASGI 的方式部署才能发挥作用
+# 一页 tweets 的 user, profile, 计数器, 图片和 has_liked 是同时去取的, 而不是一个接一个地等
+async def list_tweets(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    request = await get_api_request(request)
+    if 'user_id' not in request.query_params:
+        return JsonResponse({'message': 'missing user_id in request.'}, status=400)
+
+    paginator = KeysetPagination()
+    tweets = await sync_to_async(get_tweets_page)(
+        paginator,
+        request,
+        request.query_params['user_id'],
+    )
+    _, has_liked = await TweetService.prefetch_tweets_async(
+        [tweet.id for tweet in tweets],
+        request.user,
+        tweets,
+    )
+    # 需要的数据都已经取好了, serializer 里不会再访问 cache 和数据库
+    data = await sync_to_async(lambda: TweetSerializer(
+        tweets,
+        context={'request': request, 'has_liked': has_liked},
+        many=True,
+    ).data)()
+    return JsonResponse(paginator.get_paginated_response(data).data)
@@ -1,15 +1,17 @@
 from accounts.api.serializers import UserSerializerForTweet
+from django.contrib.auth.models import User
 from comments.api.serializers import CommentSerializer
-from likes.api.serializers import LikeSerializer
-from likes.services import LikeService
+from likes.api.serializers import HasLikedMixin, LikeSerializer
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
+from tweets.constants import TWEET_DETAIL_PREVIEW_LIMIT, TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
+from utils.redis_counters import RedisCounters
+from utils.serializers import PrefetchListSerializer, PrefetchThroughCacheMixin
 
 # 这个 Serializer 是用来做展示的. 基本上每个 action 都需要创建一个 Serialzier.
-class TweetSerializer(serializers.ModelSerializer):
+class TweetSerializer(HasLikedMixin, PrefetchThroughCacheMixin, serializers.ModelSerializer):
     # 如果不写, 则默认返回 user_id, 不是一个 user 对象
     # 如果我对于 UserSerializer返回的字段不满意, 比如不想暴露太多的信息, 可以重新定义一个专门的 Serializer
     # 这里没有定义 id, created_at, content字段是因为这里是展示用, rest_framework会替我们做, 也无需对字段加限制条件做检验
@@ -36,17 +38,26 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        # 序列化一页 tweets 的时候, 先把所有 tweet 的 user 一次性从 memcached 里取出来
+        list_serializer_class = PrefetchListSerializer
+        cached_objects = {'cached_user': (User, 'user_id')}
+        cached_counts = ('likes_count', 'comments_count')
 
+    # 不再每个 tweet 都去 like_set.count(), 而是读 redis 里的计数器
     def get_likes_count(self, obj):  # 这里的 obj 是 Tweet 的实例
-        return obj.like_set.count()
+        return RedisCounters.get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return obj.comment_set.count()
+        return RedisCounters.get_count(obj, 'comments_count')
 
-    def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+    def prefetch_through_cache(self, tweets):
+        super().prefetch_through_cache(tweets)
+        # 一页 tweets 的图片用一条 query 查出来
+        TweetService.prefetch_photo_urls(tweets)
 
     def get_photo_urls(self, obj):
+        if hasattr(obj, '_cached_photo_urls'):
+            return obj._cached_photo_urls
         photo_urls = []
         for photo in obj.tweetphoto_set.all().order_by('order'):
             photo_urls.append(photo.file.url)
@@ -55,8 +66,11 @@ class TweetSerializer(serializers.ModelSerializer):
 class TweetSerializerForDetail(TweetSerializer):
     # 这里要获取到 comments
     # 首次会在 tweet的model 里去找, 接着会到 TweetSerializer 中去找
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
+    # 热门 tweet 可能有几万个赞, 全部序列化出来详情页会非常慢
+    # 所以只带最新的 TWEET_DETAIL_PREVIEW_LIMIT 个, 总数看 likes_count 和 comments_count
+    # 完整的列表用 /api/tweets/{id}/likes/ 和 /api/tweets/{id}/comments/ 翻页去取
+    comments = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
@@ -73,10 +87,18 @@ class TweetSerializerForDetail(TweetSerializer):
             'photo_urls',
         )
 
-    # 也可实现 serializerMethodField 方式来实现
-    # comments = serializers.SerializerMethodField()
-    # def get_comments(self, obj):
-    #     return CommentSerializer(obj.comment_set.all(), many=True).data
+    def get_comments(self, obj):
+        # 取最新的几个 comments, 展示的时候还是按照时间正序
+        comments = list(obj.comment_set.order_by(
+            '-created_at',
+            '-id',
+        )[:TWEET_DETAIL_PREVIEW_LIMIT])
+        comments.reverse()
+        return CommentSerializer(comments, many=True, context=self.context).data
+
+    def get_likes(self, obj):
+        likes = obj.like_set[:TWEET_DETAIL_PREVIEW_LIMIT]
+        return LikeSerializer(likes, many=True, context=self.context).data
 
 
 # 如果有获取用户的输入, 比如创建这个动作, 就需要创建一个新的Serializer, 带有校验功能
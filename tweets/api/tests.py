@@ -1,13 +1,23 @@
+from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.api.serializers import TweetSerializer
+from tweets.constants import TWEET_DETAIL_PREVIEW_LIMIT
 from tweets.models import Tweet, TweetPhoto
 from utils.paginations import EndlessPagination
 
 # 注意这里 url 是一样的, 只是方法不一样
 TWEET_LIST_URL = '/api/tweets/'  # 用 get 方法
+ASYNC_TWEET_LIST_URL = '/api/async/tweets/'
 TWEET_CREATE_URL = '/api/tweets/'  # 用 post 方法
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_FANOUT_STATUS_API = '/api/tweets/{}/fanout-status/'
+TWEET_LIKES_API = '/api/tweets/{}/likes/'
+TWEET_COMMENTS_API = '/api/tweets/{}/comments/'
 
 
 class TweetApiTests(TestCase):
@@ -59,6 +69,70 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['results'][0]['id'], self.tweets2[1].id)
         self.assertEqual(response.data['results'][1]['id'], self.tweets2[0].id)
 
+    def test_async_list_api(self):
+        client = Client()
+        response = client.get(ASYNC_TWEET_LIST_URL)
+        self.assertEqual(response.status_code, 400)
+
+        self.create_like(self.user2, self.tweets1[0])
+        # 匿名用户和登录用户看到的都和同步的版本一样
+        for api_client in [self.anonymous_client, self.user2_client]:
+            if api_client is self.user2_client:
+                client.force_login(self.user2)
+            sync_response = api_client.get(TWEET_LIST_URL, {'user_id': self.user1.id})
+            async_response = client.get(ASYNC_TWEET_LIST_URL, {'user_id': self.user1.id})
+            self.assertEqual(async_response.status_code, 200)
+            self.assertEqual(async_response.json(), sync_response.json())
+        results = async_response.json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[2]['id'], self.tweets1[0].id)
+        self.assertEqual(results[2]['has_liked'], True)
+        self.assertEqual(results[2]['likes_count'], 1)
+
+    def test_serializer_queries(self):
+        # 一页 tweets 不管有多少条, 渲染的时候查数据库的次数都是固定的
+        def create_tweets(count):
+            tweets = []
+            for i in range(count):
+                # 每个 tweet 都是不同的用户发的, 而且用户都还没有 profile
+                user = self.create_user('author{}_{}'.format(count, i))
+                tweet = self.create_tweet(user)
+                TweetPhoto.objects.create(tweet=tweet, user=user, file='a.jpg', order=1)
+                TweetPhoto.objects.create(tweet=tweet, user=user, file='b.jpg', order=0)
+                self.create_like(self.user1, tweet)
+                self.create_comment(self.user2, tweet)
+                tweets.append(tweet)
+            return tweets
+
+        def render(tweets):
+            tweets = list(Tweet.objects.filter(id__in=[tweet.id for tweet in tweets]))
+            request = RequestFactory().get(TWEET_LIST_URL)
+            request.user = self.user1
+            with CaptureQueriesContext(connection) as queries:
+                data = TweetSerializer(tweets, context={'request': request}, many=True).data
+            return data, len(queries)
+
+        self.clear_cache()
+        small_data, small_queries = render(create_tweets(2))
+        large_tweets = create_tweets(6)
+        large_data, large_queries = render(large_tweets)
+        self.assertEqual(small_queries, large_queries)
+        self.assertEqual(len(large_data), 6)
+        for tweet_data in large_data:
+            self.assertEqual(tweet_data['likes_count'], 1)
+            self.assertEqual(tweet_data['comments_count'], 1)
+            self.assertEqual(tweet_data['has_liked'], True)
+            self.assertEqual(tweet_data['user']['nickname'], None)
+            self.assertEqual(
+                [url.split('/')[-1] for url in tweet_data['photo_urls']],
+                ['b.jpg', 'a.jpg'],
+            )
+
+        # user, profile 和计数器都 cache 住之后, 只剩下图片和 has_liked 两条 query
+        data, queries_count = render(large_tweets)
+        self.assertEqual(queries_count, 2)
+        self.assertEqual(data, large_data)
+
     def test_create_api(self):
         # 匿名创建
         response = self.anonymous_client.post(TWEET_CREATE_URL,
@@ -111,6 +185,113 @@ class TweetApiTests(TestCase):
         response = self.anonymous_client.get(url)
         self.assertEqual(len(response.data['comments']), 2)
 
+    def test_retrieve_with_many_comments_and_likes(self):
+        tweet = self.create_tweet(self.user1)
+        comments = [
+            self.create_comment(self.user2, tweet, 'comment{}'.format(i))
+            for i in range(TWEET_DETAIL_PREVIEW_LIMIT + 3)
+        ]
+        users = [
+            self.create_user('liker{}'.format(i))
+            for i in range(TWEET_DETAIL_PREVIEW_LIMIT + 3)
+        ]
+        likes = [self.create_like(user, tweet) for user in users]
+
+        # 详情页只带最新的几个, 总数还是全部的
+        response = self.anonymous_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['comments_count'], len(comments))
+        self.assertEqual(response.data['likes_count'], len(likes))
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[-TWEET_DETAIL_PREVIEW_LIMIT:]],
+        )
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['likes']],
+            [user.id for user in reversed(users[-TWEET_DETAIL_PREVIEW_LIMIT:])],
+        )
+
+    def test_likes_and_comments_api(self):
+        tweet = self.create_tweet(self.user1)
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.user2, tweet, 'comment{}'.format(i))
+            for i in range(page_size + 3)
+        ]
+        users = [self.create_user('liker{}'.format(i)) for i in range(page_size + 3)]
+        for user in users:
+            self.create_like(user, tweet)
+        # 别的 tweet 的评论和点赞不会出现
+        other_tweet = self.create_tweet(self.user2)
+        self.create_comment(self.user1, other_tweet)
+        self.create_like(self.user1, other_tweet)
+
+        response = self.anonymous_client.get(TWEET_COMMENTS_API.format(-1))
+        self.assertEqual(response.status_code, 404)
+
+        # 评论和 /api/comments/?tweet_id= 一样是正序的, 点赞是倒序的
+        for url, results_key, expected_ids, get_id in [
+            (
+                TWEET_COMMENTS_API,
+                'comments',
+                [comment.id for comment in comments],
+                lambda data: data['id'],
+            ),
+            (
+                TWEET_LIKES_API,
+                'results',
+                [user.id for user in reversed(users)],
+                lambda data: data['user']['id'],
+            ),
+        ]:
+            url = url.format(tweet.id)
+            response = self.anonymous_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['has_next_page'], True)
+            results = list(response.data[results_key])
+            self.assertEqual(len(results), page_size)
+            response = self.anonymous_client.get(url, {
+                'cursor': response.data['next_cursor'],
+            })
+            self.assertEqual(response.data['has_next_page'], False)
+            results.extend(response.data[results_key])
+            self.assertEqual([get_id(data) for data in results], expected_ids)
+
+        response = self.user2_client.get(TWEET_COMMENTS_API.format(tweet.id))
+        self.assertEqual(response.data['comments'][0]['has_liked'], False)
+        # 和 /api/comments/?tweet_id= 返回的是同一个列表
+        self.assertEqual(
+            response.data,
+            self.user2_client.get('/api/comments/', {'tweet_id': tweet.id}).data,
+        )
+
+    def test_fanout_status(self):
+        for i in range(4):
+            follower = self.create_user('user1_follower{}'.format(i))
+            self.create_friendship(follower, self.user1)
+        response = self.user1_client.post(TWEET_CREATE_URL, {
+            'content': 'Hello this is my first tweet',
+        })
+        url = TWEET_FANOUT_STATUS_API.format(response.data['id'])
+
+        # 需要登录
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        # 测试环境下 celery task 是同步执行的, 所以请求返回的时候 fanout 已经完成了
+        response = self.user2_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'finished')
+        self.assertEqual(response.data['followers_count'], 4)
+        self.assertEqual(response.data['total_batches'], 2)
+        self.assertEqual(response.data['finished_batches'], 2)
+        self.assertEqual(response.data['lag_seconds'] >= 0, True)
+
+        # 不是通过 api 发的 tweet 没有 fanout 的记录
+        tweet = self.create_tweet(self.user1)
+        response = self.user1_client.get(TWEET_FANOUT_STATUS_API.format(tweet.id))
+        self.assertEqual(response.data['status'], 'unknown')
+
     def test_create_with_files(self):
         # 还可以做的测试: 比如上传的 data没有 files, 兼容旧的 api
         # 还可以做的测试: 从 list api 中看有没有这些图片
@@ -229,4 +410,68 @@ class TweetApiTests(TestCase):
         })
         self.assertEqual(response.data['has_next_page'], False)
         self.assertEqual(len(response.data['results']), 1)
-        self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
\ No newline at end of file
+        self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    def test_pagination_beyond_cache(self):
+        page_size = EndlessPagination.page_size
+        # 总数超过 REDIS_LIST_LENGTH_LIMIT, 后面的页需要从数据库里读
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT + page_size):
+            self.create_tweet(self.user2, 'tweet{}'.format(i))
+        tweets = list(Tweet.objects.filter(
+            user=self.user2,
+        ).order_by('-created_at'))
+
+        results, params = [], {'user_id': self.user2.id}
+        while True:
+            response = self.anonymous_client.get(TWEET_LIST_URL, params)
+            results.extend(response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            params['created_at__lt'] = results[-1]['created_at']
+        self.assertEqual(
+            [result['id'] for result in results],
+            [tweet.id for tweet in tweets],
+        )
+
+    def test_cursor_pagination_with_same_created_at(self):
+        page_size = EndlessPagination.page_size
+        for i in range(page_size * 2 + 5):
+            self.create_tweet(self.user2, 'tweet{}'.format(i))
+        # 所有 tweet 的 created_at 都一样, 只用 created_at 翻页的话会漏掉数据
+        Tweet.objects.filter(user=self.user2).update(
+            created_at=self.tweets2[0].created_at,
+        )
+        self.clear_cache()
+        tweet_ids = list(Tweet.objects.filter(
+            user=self.user2,
+        ).order_by('-id').values_list('id', flat=True))
+
+        results, params = [], {'user_id': self.user2.id}
+        response = self.anonymous_client.get(TWEET_LIST_URL, params)
+        refresh_cursor = response.data['refresh_cursor']
+        while True:
+            results.extend(response.data['results'])
+            if not response.data['has_next_page']:
+                self.assertEqual(response.data['next_cursor'], None)
+                break
+            params['cursor'] = response.data['next_cursor']
+            response = self.anonymous_client.get(TWEET_LIST_URL, params)
+        self.assertEqual([result['id'] for result in results], tweet_ids)
+
+        # 下拉刷新
+        new_tweet = self.create_tweet(self.user2, 'a new tweet comes in')
+        response = self.anonymous_client.get(TWEET_LIST_URL, {
+            'user_id': self.user2.id,
+            'newer_than': refresh_cursor,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [new_tweet.id],
+        )
+
+        response = self.anonymous_client.get(TWEET_LIST_URL, {
+            'user_id': self.user2.id,
+            'cursor': 'invalid cursor',
+        })
+        self.assertEqual(response.status_code, 404)
@@ -1,4 +1,9 @@
+from comments.api.paginations import CommentPagination
+from comments.api.serializers import CommentSerializer
+from comments.api.views import get_comments_page
+from likes.api.serializers import LikeSerializer
 from newsfeeds.services import NewsFeedServices
+from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
@@ -10,7 +15,20 @@ from tweets.api.serializers import (
 )
 from tweets.services import TweetService
 from utils.decorators import required_params
-from utils.paginations import EndlessPagination
+from utils.paginations import KeysetPagination
+
+
+def get_tweets_page(paginator, request, user_id):
+    # 只从 cache 里取当前这一页需要的 tweets, 翻到 cache 之外的时候再去数据库里查
+    # async view 里也是用这个函数取一页 tweets
+    tweets = paginator.paginate_cached_list(
+        lambda limit: TweetService.get_cached_tweets(user_id, limit),
+        request,
+    )
+    if tweets is None:
+        queryset = Tweet.objects.filter(user_id=user_id)
+        tweets = paginator.paginate_queryset(queryset, request)
+    return tweets
 
 
 # 一般不用 ModelViewSet, 因为 ModelViewSet 默认你增删查改都可以做, 我们不打算开放这些接口
@@ -19,14 +37,14 @@ class TweetViewSet(GenericViewSet):
     # 指定默认的 queryset, serializers,
     queryset = Tweet.objects.all()  # 这里可以不需要, 因为 list方法已经返回了一个 queryset
     serializer_class = TweetSerializerForCreate
-    pagination_class = EndlessPagination
+    pagination_class = KeysetPagination
     # 默认的 serializer_class django 会提供一个创建时用的表单
 
     # 权限检测有两种方法
     # 方法一: 重写 get_permissions函数. 这种写法的好处时, 如果你有多个 action 但是共享同一种 permission 时可以节省代码
     # 方法二: 用 action 装饰器, 定义 permissions 参数.
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:  # 通过 self.action来看请求的动作
+        if self.action in ['list', 'retrieve', 'likes', 'comments']:  # 通过 self.action来看请求的动作
             return [AllowAny(), ]  # 默认是 AllowAny, 即使不写也可以
         return [IsAuthenticated(), ]
 
@@ -38,9 +56,11 @@ class TweetViewSet(GenericViewSet):
         #     user_id=request.query_params['user_id']
         # ).order_by('-created_at')  # 这里需要建立联合索引, 在 model 中配置
         # 这里优化了从 cache 中获取 tweet
-        tweets = TweetService.get_cached_tweets(user_id=request.query_params['user_id'])
-
-        tweets = self.paginate_queryset(tweets)
+        tweets = get_tweets_page(
+            self.paginator,
+            request,
+            request.query_params['user_id'],
+        )
         serializer = TweetSerializer(
             tweets,
             context={'request': request},
@@ -59,6 +79,30 @@ class TweetViewSet(GenericViewSet):
         )
         return Response(serializer.data)
 
+    # GET /api/tweets/1/fanout-status/ 查看这条 tweet 异步 fanout 的进度和延迟
+    @action(methods=['GET'], detail=True, url_path='fanout-status')
+    def fanout_status(self, request, *args, **kwargs):
+        tweet = self.get_object()
+        return Response(NewsFeedServices.get_fanout_progress(tweet))
+
+    # GET /api/tweets/1/likes/ 按照时间倒序翻页查看所有的点赞
+    # 用的是 Like 上 (content_type, object_id, created_at) 的联合索引
+    @action(methods=['GET'], detail=True)
+    def likes(self, request, *args, **kwargs):
+        tweet = self.get_object()
+        likes = self.paginate_queryset(tweet.like_set)
+        serializer = LikeSerializer(likes, context={'request': request}, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    # GET /api/tweets/1/comments/ 和 /api/comments/?tweet_id=1 返回的是同一个列表
+    # 一样按照时间正序翻页, 前几页从 redis 里取
+    @action(methods=['GET'], detail=True, pagination_class=CommentPagination)
+    def comments(self, request, *args, **kwargs):
+        tweet = self.get_object()
+        comments = get_comments_page(self.paginator, request, tweet.id)
+        serializer = CommentSerializer(comments, context={'request': request}, many=True)
+        return self.get_paginated_response(serializer.data)
+
     def create(self, request):
         # 提取用户提交的数据
         # 初始化一个 serializer, 传入用户输入和 request.user
@@ -82,6 +126,7 @@ class TweetViewSet(GenericViewSet):
         # 注意: 这个实例不能直接给 respose 返回, 需要序列化后才能返回
         tweet = serializer.save()
         # 这里增加一个 newsfeed的 service, fanout newsfeed to followers
+        # fanout 是异步执行的, tweet 写入数据库之后请求就可以直接返回了
         NewsFeedServices.fanout_to_followers(tweet)
         # 返回 Response
         # 这里我们用 TweetSerializer对实例进行序列化
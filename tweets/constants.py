@@ -11,3 +11,6 @@ TWEET_PHOTO_STATUS_CHOICES = (
 )
 
 TWEET_PHOTOS_UPLOAD_LIMIT = 9
+
+# tweet 详情页里只带最新的这么多个 comments 和 likes, 完整的列表用单独的翻页接口去取
+TWEET_DETAIL_PREVIEW_LIMIT = 20
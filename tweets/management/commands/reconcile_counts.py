@@ -0,0 +1,125 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from likes.models import Like
+from tweets.models import Tweet
+from twitter.cache import FLUSHING_COUNTS_KEY, PENDING_COUNTS_KEY
+from utils.redis_client import RedisClient
+from utils.redis_counters import RedisCounters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild denormalized likes_count and comments_count from the Like and Comment tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # 先把 redis 里积攒的增量写回去, 减少需要修正的数量
+        RedisCounters.flush()
+
+        tweet_likes = self._count_subquery(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Tweet),
+            object_id=OuterRef('id'),
+        ), 'object_id')
+        comment_likes = self._count_subquery(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Comment),
+            object_id=OuterRef('id'),
+        ), 'object_id')
+        tweet_comments = self._count_subquery(Comment.objects.filter(
+            tweet_id=OuterRef('id'),
+        ), 'tweet_id')
+
+        for model_class, field, subquery in [
+            (Tweet, 'likes_count', tweet_likes),
+            (Tweet, 'comments_count', tweet_comments),
+            (Comment, 'likes_count', comment_likes),
+        ]:
+            fixed_count = self._reconcile(
+                model_class,
+                field,
+                subquery,
+                options['batch_size'],
+            )
+            self.stdout.write('{}.{}: {} fixed'.format(
+                model_class._meta.label_lower,
+                field,
+                fixed_count,
+            ))
+
+    def _count_subquery(self, queryset, group_by):
+        return Coalesce(Subquery(
+            queryset.order_by().values(group_by).annotate(
+                count=Count('id'),
+            ).values('count'),
+        ), 0)
+
+    def _reconcile(self, model_class, field, subquery, batch_size):
+        # 按照主键分批处理, 每次只扫一小段, 不会长时间占用数据库
+        fixed_count, last_id = 0, 0
+        while True:
+            # 每一批都拿着 flush 的锁做, 读增量和改数据库的过程中不会有 flush 插进来
+            # 只在一批里拿着锁, 不会让 flush 等整个命令跑完
+            token = RedisCounters.acquire_flush_lock(
+                wait_timeout=settings.COUNTS_FLUSH_LOCK_TIMEOUT,
+            )
+            if token is None:
+                raise CommandError('Could not acquire the counts flush lock')
+            try:
+                rows, fixed_ids = self._reconcile_batch(
+                    model_class,
+                    field,
+                    subquery,
+                    last_id,
+                    batch_size,
+                )
+            finally:
+                RedisCounters.release_flush_lock(token)
+            if not rows:
+                return fixed_count
+            last_id = rows[-1][0]
+            fixed_count += len(fixed_ids)
+
+    def _reconcile_batch(self, model_class, field, subquery, last_id, batch_size):
+        conn = RedisClient.get_connection()
+        label = model_class._meta.label_lower
+        rows = list(model_class.objects.filter(
+            id__gt=last_id,
+        ).order_by('id').annotate(
+            real_count=subquery,
+        ).values_list('id', field, 'real_count')[:batch_size])
+        if not rows:
+            return rows, []
+
+        # 数出来的真实数量里已经包括了还没有写回数据库的增量
+        # 这部分增量之后 flush 的时候还会再加一次, 所以数据库里应该存的是减掉增量之后的值
+        delta_fields = [
+            RedisCounters.get_delta_field(label, object_id, field)
+            for object_id, _, _ in rows
+        ]
+        pipeline = conn.pipeline()
+        pipeline.hmget(PENDING_COUNTS_KEY, delta_fields)
+        pipeline.hmget(FLUSHING_COUNTS_KEY, delta_fields)
+        pending_deltas, flushing_deltas = pipeline.execute()
+
+        fixed_ids = []
+        for (object_id, count, real_count), pending, flushing in zip(
+            rows,
+            pending_deltas,
+            flushing_deltas,
+        ):
+            expected_count = real_count - int(pending or 0) - int(flushing or 0)
+            if count == expected_count:
+                continue
+            # 只有数据库里还是刚才读到的值才改, 锁过期了被 flush 加过增量的话就留给下一次再修
+            updated = model_class.objects.filter(
+                id=object_id,
+                **{field: count},
+            ).update(**{field: expected_count})
+            if updated:
+                fixed_ids.append(object_id)
+        RedisCounters.invalidate_counts(model_class, fixed_ids, field)
+        return rows, fixed_ids
@@ -0,0 +1,66 @@
+# Generated by Django 3.2 on 2026-10-18 19:00
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# 0005 加上 likes_count 和 comments_count 的时候默认值是 0, 已经有的 tweet 需要从 Like 和 Comment 表里数一遍
+# 否则上线之后所有旧的 tweet 都显示 0 个赞 0 条评论
+# 按照主键分批 update, 每次只锁一小段, 不会长时间锁住整张表
+# 这个 migration 要在新代码开始写 redis 计数器之前跑完, 之后如果还有偏差可以再跑 reconcile_counts 修正
+BATCH_SIZE = 1000
+
+
+def count_subquery(queryset, group_by):
+    return Coalesce(Subquery(
+        queryset.order_by().values(group_by).annotate(
+            count=Count('id'),
+        ).values('count'),
+    ), 0)
+
+
+def backfill_counts(apps, schema_editor):
+    Tweet = apps.get_model('tweets', 'Tweet')
+    Comment = apps.get_model('comments', 'Comment')
+    Like = apps.get_model('likes', 'Like')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    content_type = ContentType.objects.filter(app_label='tweets', model='tweet').first()
+    counts = {
+        'comments_count': count_subquery(
+            Comment.objects.filter(tweet_id=OuterRef('id')),
+            'tweet_id',
+        ),
+    }
+    # 新建的数据库里 content type 还没有创建, 也就不会有点赞
+    if content_type is not None:
+        counts['likes_count'] = count_subquery(
+            Like.objects.filter(
+                content_type_id=content_type.id,
+                object_id=OuterRef('id'),
+            ),
+            'object_id',
+        )
+
+    last_id = 0
+    while True:
+        tweet_ids = list(Tweet.objects.filter(
+            id__gt=last_id,
+        ).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+        if not tweet_ids:
+            return
+        Tweet.objects.filter(id__in=tweet_ids).update(**counts)
+        last_id = tweet_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0006_countsflush'),
+        ('comments', '0004_comment_likes_count'),
+        ('likes', '0003_alter_like_id'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
+from django.utils.functional import cached_property
 from likes.models import Like
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
 from tweets.listeners import push_tweet_to_cache
@@ -22,6 +23,12 @@ class Tweet(models.Model):
     content = models.CharField(max_length=255)
     created_at = models.DateTimeField(
         auto_now_add=True)  # 只有在创建的时候插入, django会加上utc时区信息
+
+    # 反范式化(denormalize)存储的点赞数和评论数, 展示的时候不用每个 tweet 都去 count 一次
+    # 点赞和评论的时候先加在 redis 的计数器上, 再由 celery 定时批量写回数据库
+    # null=True 是因为给一张很大的表加一个 default=0 的字段, mysql 会把整张表都刷一遍, 会锁表
+    likes_count = models.IntegerField(default=0, null=True)
+    comments_count = models.IntegerField(default=0, null=True)
     # updated_at = models.DateField(auto_now=True) # 每次修改都会更新
 
     @property
@@ -36,7 +43,8 @@ class Tweet(models.Model):
             object_id=self.id,
         ).order_by('-created_at')
 
-    @property
+    # 用 cached_property 而不是 property, 这样可以通过 MemcachedHelper 批量 prefetch 进来
+    @cached_property
     def cached_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
@@ -92,6 +100,17 @@ class TweetPhoto(models.Model):
         return f'{self.tweet_id}: {self.file}'
 
 
+class CountsFlush(models.Model):
+    # 已经写回数据库的一批计数器增量的 id, 和增量在同一个事务里写入
+    # flush 写完数据库之后还没来得及删掉 redis 里的 flushing 就挂了的话
+    # 下一次 flush 看到这个 id 已经存在, 就知道这批增量已经写过了, 不会再加一次
+    flush_id = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.flush_id} {self.created_at}'
+
+
 post_save.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(push_tweet_to_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
\ No newline at end of file
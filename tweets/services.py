@@ -1,7 +1,15 @@
+import asyncio
+
+from accounts.services import UserService
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from likes.services import LikeService
 from tweets.models import TweetPhoto
 from tweets.models import Tweet
 from twitter.cache import USER_TWEETS_PATTERN
-from utils.redis_helper import RedisHelper
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_counters import RedisCounters
+from utils.redis_helper import get_timeline_helper
 
 class TweetService(object):
 
@@ -19,18 +27,90 @@ class TweetService(object):
         TweetPhoto.objects.bulk_create(photos)
 
     @classmethod
-    def get_cached_tweets(cls, user_id):
+    def get_cached_tweets(cls, user_id, limit=None):
         # 注意这里 django 的 queryset 是懒惰加载的方式, 在下面这句语句中, 并没有触发数据库查询.
         # 只有在真实访问 queryset时, 比如使用 for 循环访问, 类型转化list(queryset), 才会真正触发数据库查询
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
         # 构建 redis 需要的 key 值
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         # 从 redis 中取出值
-        return RedisHelper.load_objects(key, queryset)
+        return get_timeline_helper().load_objects(key, queryset, limit)
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by(
-            '-created_at')
+            '-created_at', '-id')
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
+        get_timeline_helper().push_object(key, tweet, queryset)
+
+    @classmethod
+    def get_photo_urls(cls, tweet_ids):
+        # 一页 tweets 的图片用一条 query 查出来, 返回 {tweet_id: [url, ...]}
+        photo_urls = {tweet_id: [] for tweet_id in tweet_ids}
+        photos = TweetPhoto.objects.filter(tweet_id__in=tweet_ids).order_by('order')
+        for photo in photos:
+            photo_urls[photo.tweet_id].append(photo.file.url)
+        return photo_urls
+
+    @classmethod
+    def prefetch_photo_urls(cls, tweets):
+        tweets = [tweet for tweet in tweets if not hasattr(tweet, '_cached_photo_urls')]
+        if not tweets:
+            return
+        photo_urls = cls.get_photo_urls([tweet.id for tweet in tweets])
+        for tweet in tweets:
+            tweet._cached_photo_urls = photo_urls[tweet.id]
+
+    @classmethod
+    async def prefetch_tweets_async(cls, tweet_ids, viewer, tweets=None):
+        # async view 渲染一页 tweets 之前, 把需要的数据全部准备好
+        # user 和 profile, 计数器, 图片, has_liked 之间互相没有依赖, 用 asyncio.gather 同时去取
+        # tweets 是已经取出来的 tweets, 其他的 (比如 newsfeed 里的) 先从 memcached 里取出来
+        # 返回 ({tweet_id: tweet}, has_liked), has_liked 的格式和 HasLikedMixin 放在 context 里的一样
+        if not tweet_ids:
+            return {}, {}
+
+        async def load_tweets():
+            id_to_tweet = {tweet.id: tweet for tweet in tweets or []}
+            missing_ids = [
+                tweet_id for tweet_id in tweet_ids if tweet_id not in id_to_tweet
+            ]
+            if missing_ids:
+                id_to_tweet.update(
+                    await MemcachedHelper.get_objects_through_cache_async(
+                        Tweet,
+                        missing_ids,
+                    ),
+                )
+            await MemcachedHelper.prefetch_objects_through_cache_async(
+                list(id_to_tweet.values()),
+                User,
+                'user_id',
+                'cached_user',
+            )
+            await UserService.prefetch_profiles_through_cache_async([
+                tweet.cached_user
+                for tweet in id_to_tweet.values()
+                if 'cached_user' in tweet.__dict__
+            ])
+            return id_to_tweet
+
+        # 数据库的查询都要在 django 的同步线程里执行, 图片和 has_liked 之间还是串行的
+        # 但是和读 memcached, redis 是同时进行的
+        id_to_tweet, likes_counts, comments_counts, photo_urls, liked_ids = await asyncio.gather(
+            load_tweets(),
+            RedisCounters.get_counts_async(Tweet, tweet_ids, 'likes_count'),
+            RedisCounters.get_counts_async(Tweet, tweet_ids, 'comments_count'),
+            sync_to_async(cls.get_photo_urls)(tweet_ids),
+            sync_to_async(LikeService.get_liked_object_ids)(viewer, Tweet, tweet_ids),
+        )
+        loaded_tweets = list(id_to_tweet.values())
+        RedisCounters.set_prefetched_counts(loaded_tweets, 'likes_count', likes_counts)
+        RedisCounters.set_prefetched_counts(loaded_tweets, 'comments_count', comments_counts)
+        for tweet in loaded_tweets:
+            tweet._cached_photo_urls = photo_urls[tweet.id]
+        has_liked = {
+            (Tweet, tweet_id): tweet_id in liked_ids
+            for tweet_id in tweet_ids
+        }
+        return id_to_tweet, has_liked
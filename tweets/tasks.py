@@ -0,0 +1,11 @@
+from celery import shared_task
+from utils.redis_counters import RedisCounters
+
+ONE_MINUTE = 60
+
+
+@shared_task(time_limit=ONE_MINUTE)
+def flush_counts_task():
+    # 由 celery beat 定时触发, 把 redis 里累积的点赞数评论数的增量批量写回数据库
+    flushed_count = RedisCounters.flush()
+    return '{} counters flushed.'.format(flushed_count)
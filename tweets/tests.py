@@ -1,11 +1,22 @@
 from datetime import timedelta
+from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
+from io import StringIO
+from likes.models import Like
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import TweetPhoto
+from tweets.models import CountsFlush, Tweet, TweetPhoto
 from tweets.services import TweetService
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import (
+    FLUSHING_COUNTS_ID_KEY,
+    FLUSHING_COUNTS_KEY,
+    PENDING_COUNTS_KEY,
+    USER_TWEETS_PATTERN,
+)
 from utils.time_helpers import utc_now
 from utils.redis_client import RedisClient
+from utils.redis_counters import RedisCounters
 from utils.redis_serializers import DjangoModelSerializer
 
 
@@ -101,4 +112,119 @@ class TweetServiceTests(TestCase):
         self.assertEqual(conn.exists(key), True)
 
         tweets = TweetService.get_cached_tweets(self.linghu.id)
-        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
\ No newline at end of file
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_cache_limit(self):
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id=self.linghu.id)
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        tweet_ids = [
+            self.create_tweet(self.linghu, 'tweet{}'.format(i)).id
+            for i in range(limit + 5)
+        ][::-1]
+
+        # cache miss 的时候只 cache 最新的 limit 个
+        tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual([t.id for t in tweets], tweet_ids[:limit])
+        self.assertEqual(conn.llen(key), limit)
+
+        # 只取最新的几个
+        tweets = TweetService.get_cached_tweets(self.linghu.id, 3)
+        self.assertEqual([t.id for t in tweets], tweet_ids[:3])
+
+        # push 之后会被 trim 到 limit 的长度
+        new_tweet = self.create_tweet(self.linghu, 'new tweet')
+        self.assertEqual(conn.llen(key), limit)
+        tweets = TweetService.get_cached_tweets(self.linghu.id, 2)
+        self.assertEqual([t.id for t in tweets], [new_tweet.id, tweet_ids[0]])
+
+
+class TweetCountsTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+        self.tweet = self.create_tweet(self.linghu)
+
+    def test_counts(self):
+        self.create_like(self.linghu, self.tweet)
+        self.create_like(self.dongxie, self.tweet)
+        comment = self.create_comment(self.dongxie, self.tweet)
+        self.create_like(self.linghu, comment)
+
+        # 先记在 redis 里, 还没有写回数据库
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'likes_count'), 2)
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'comments_count'), 1)
+        self.assertEqual(RedisCounters.get_count(comment, 'likes_count'), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+
+        # 批量写回数据库
+        self.assertEqual(RedisCounters.flush(), 3)
+        self.tweet.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(comment.likes_count, 1)
+        self.assertEqual(RedisCounters.flush(), 0)
+
+        # 计数器不在 redis 里的时候, 用数据库里的值加上还没有写回的增量
+        Like.objects.filter(user=self.dongxie).delete()
+        RedisCounters.invalidate_counts(Tweet, [self.tweet.id], 'likes_count')
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'likes_count'), 1)
+        RedisCounters.flush()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+    def test_reconcile_counts(self):
+        self.create_like(self.linghu, self.tweet)
+        RedisCounters.flush()
+        # 数据库里的计数和真实的数量不一致, 并且还有没写回的增量
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=10)
+        self.create_like(self.dongxie, self.tweet)
+
+        out = StringIO()
+        call_command('reconcile_counts', batch_size=1, stdout=out)
+        self.assertIn('tweets.tweet.likes_count: 1 fixed', out.getvalue())
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'likes_count'), 2)
+
+    def test_flush_is_idempotent(self):
+        self.create_like(self.linghu, self.tweet)
+        # 模拟上一次 flush 已经把增量和 id 写进了数据库, 还没来得及删掉 flushing 就挂了
+        conn = RedisClient.get_connection()
+        conn.rename(PENDING_COUNTS_KEY, FLUSHING_COUNTS_KEY)
+        conn.set(FLUSHING_COUNTS_ID_KEY, 'crashed')
+        CountsFlush.objects.create(flush_id='crashed')
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=1)
+
+        # 这一批增量不会再加一次, 只是把 flushing 清掉
+        self.assertEqual(RedisCounters.flush(), 0)
+        self.assertFalse(conn.exists(FLUSHING_COUNTS_KEY))
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+    @override_settings(CACHE_REBUILD_WAIT_TIMEOUT=0)
+    def test_flush_lock(self):
+        self.create_like(self.linghu, self.tweet)
+        token = RedisCounters.acquire_flush_lock()
+        self.assertIsNotNone(token)
+        # 别人拿着锁的时候不 flush
+        self.assertEqual(RedisCounters.flush(), 0)
+
+        # 拿着锁的时候数据库里的计数随时可能被改, 算出来的计数不写进 redis
+        RedisCounters.invalidate_counts(Tweet, [self.tweet.id], 'likes_count')
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'likes_count'), 1)
+        conn = RedisClient.get_connection()
+        key = RedisCounters.get_key('tweets.tweet', self.tweet.id, 'likes_count')
+        self.assertFalse(conn.exists(key))
+
+        RedisCounters.release_flush_lock(token)
+        self.assertEqual(RedisCounters.get_count(self.tweet, 'likes_count'), 1)
+        self.assertTrue(conn.exists(key))
+        self.assertEqual(RedisCounters.flush(), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
@@ -1,3 +1,8 @@
 import pymysql
 
-pymysql.install_as_MySQLdb()
\ No newline at end of file
+# 保证 django 启动的时候 celery app 也会被加载, 这样 shared_task 才能注册到这个 app 上
+from .celery import app as celery_app
+
+pymysql.install_as_MySQLdb()
+
+__all__ = ('celery_app',)
@@ -1,9 +1,31 @@
 
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
+FOLLOWERS_COUNT_PATTERN = 'followers_count:{user_id}'  # 粉丝数, 用来判断是不是大 V
 # USER_PATTERN = 'user:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}' # 注意这里也是用 user_id 而不是用 userprofile的 id
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'  # 查询某个用户发的 tweet 
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'  # 某个 tweet 最早的一批评论, 按照时间正序
+FOLLOWER_IDS_PATTERN = 'follower_ids:{user_id}'  # 某个用户所有粉丝的 id, 是一个 redis set
+FOLLOWINGS_PATTERN = 'followings:{user_id}'  # 某个用户关注的所有人的 id, 是一个 redis set
+REDIS_SET_CHANGED_PATTERN = 'set_changed:{key}'  # set 不在 redis 里的时候变化了几次, 在这之前开始的重建作废
+CACHE_REBUILD_LOCK_PATTERN = 'rebuild_lock:{key}'  # 重建某个 cache 的时候要先拿到这个锁
+CACHE_REBUILD_COST_PATTERN = 'rebuild_cost:{key}'  # 上次重建这个 cache 花了多少毫秒
+CACHE_REBUILD_TEMP_PATTERN = 'rebuild_temp:{key}:{token}'  # 重建的时候先写到这个临时的 key 里
+TIMELINE_HEAD_PATTERN = 'timeline_head:{key}'  # timeline 里最新的 object 的排序值
+CACHE_INVALIDATED_PATTERN = 'invalidated:{key}'  # cache 被作废过几次, 作废之前就开始的重建不会写进去
+FANOUT_PROGRESS_PATTERN = 'fanout_progress:{tweet_id}'  # 某个 tweet 异步 fanout 的进度
+OBJECT_COUNT_PATTERN = 'count:{label}:{object_id}:{field}'  # 点赞数评论数之类的计数器, 比如 count:tweets.tweet:1:likes_count
+UNREAD_NOTIFICATIONS_COUNT_PATTERN = 'unread_notifications:{user_id}'  # 某个用户的未读通知数
+MARK_AS_READ_PROGRESS_PATTERN = 'mark_as_read_progress:{user_id}'  # 某个用户后台分批标记已读的进度
+PENDING_NOTIFICATIONS_KEY = 'pending_notifications'  # 还没有写进数据库的点赞评论通知
+DELIVERING_NOTIFICATIONS_KEY = 'delivering_notifications'  # 正在写进数据库的点赞评论通知
+DELIVERING_NOTIFICATIONS_ID_KEY = 'delivering_notifications_id'  # 正在投递的这些通知的 id 和已经投递了多少个, 用来保证同一批通知只写一次
+NOTIFICATION_DELIVERY_LOCK_KEY = 'notification_delivery_lock'  # 同一时间只有一个 worker 在投递通知
+PENDING_COUNTS_KEY = 'pending_counts'  # 还没有写回数据库的计数器增量
+FLUSHING_COUNTS_KEY = 'flushing_counts'  # 正在写回数据库的计数器增量
+FLUSHING_COUNTS_ID_KEY = 'flushing_counts_id'  # 正在写回数据库的这批增量的 id, 用来保证同一批增量只写一次
+COUNTS_FLUSH_LOCK_KEY = 'counts_flush_lock'  # 同一时间只有一个 worker 在改数据库里的计数
+COUNTS_FLUSH_VERSION_KEY = 'counts_flush_version'  # 每次拿到上面的锁都加一, 读计数的时候用来判断数据库里的计数有没有被改过
@@ -0,0 +1,14 @@
+import os
+
+from celery import Celery
+
+# 给 celery 程序设置默认的 django settings
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'twitter.settings')
+
+app = Celery('twitter')
+
+# 所有 celery 相关的配置都写在 django settings 里, 并且以 CELERY_ 开头
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# 自动到每个 django app 下面去加载 tasks.py 里定义的 task
+app.autodiscover_tasks()
@@ -66,6 +66,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "utils.middlewares.IdentityMapMiddleware",
 ]
 
 ROOT_URLCONF = "twitter.urls"
@@ -202,7 +203,105 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# connection pool 的配置, 多线程的 worker 里所有线程共用一个 pool
+# pool 里最多有多少个 connection, 都被借走的时候最多等多少秒
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5
+# 单条命令和建立连接的超时时间 (秒), redis 挂了的时候请求不会一直卡住
+REDIS_SOCKET_TIMEOUT = 1
+REDIS_SOCKET_CONNECT_TIMEOUT = 1
+# 打开 TCP keepalive, 中间的防火墙/NAT 不会因为连接空闲太久把它悄悄断掉
+REDIS_SOCKET_KEEPALIVE = True
+# connection 空闲超过这么多秒之后再用之前先 ping 一下, 避免用到已经被断开的连接
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# 超时或者连接断开的时候要不要重试, 最多重试几次
+REDIS_RETRY_ON_TIMEOUT = True
+REDIS_RETRIES = 3
+# 只读的 replica, 比如 [('10.0.0.2', 6379)], 读 timeline 和计数器的时候会随机选一个
+# 不配置的话读写都走主库
+REDIS_REPLICAS = []
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
+# 批量写 redis 的时候, 一个 pipeline 里最多放多少个 key 的命令
+REDIS_PIPELINE_BATCH_SIZE = 1000
+# redis 里每个 list 最多 cache 多少个 objects, 测试的时候设置得小一些才能覆盖到从数据库读取的情况
+REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# 写入 redis 的 object 用什么格式序列化, 'compact' 是 msgpack 的紧凑格式, 'json' 是 django 自带的格式
+REDIS_SERIALIZER = 'compact'
+# timeline (用户的 tweets 和 newsfeeds) 在 redis 里的存储方式
+# 'list': list 里存序列化之后的整个 object
+# 'zset': sorted set 里只存 id, score 是 created_at, 读的时候再通过 memcached 取出 object
+# 两种方式的 key 是分开的, 切换之后从数据库里重建. 切回原来的方式之前要先删掉旧的 key, 否则会读到切换期间没有更新的旧数据
+TIMELINE_BACKEND = 'list'
+# cache miss 的时候只有拿到锁的请求去数据库里重建 cache, 锁最多持有多少秒
+CACHE_REBUILD_LOCK_TIMEOUT = 3
+# 没拿到锁的请求每隔多少秒看一下 cache 建好了没有, 最多等多少秒, 等不到就直接查数据库
+CACHE_REBUILD_POLL_INTERVAL = 0.01
+CACHE_REBUILD_WAIT_TIMEOUT = 0.5
+# 提前 refresh 的力度, 越大越早 refresh, 1.0 是 XFetch 论文里的默认值
+CACHE_EARLY_REFRESH_BETA = 1.0
+
+# 是否在 response header 里返回这个请求 identity map 的命中次数 (X-Identity-Map-Hits/Misses)
+IDENTITY_MAP_STATS_HEADERS = DEBUG
+
+# 粉丝数达到这个阈值的用户 (大 V) 发 tweet 的时候不再 fanout 给所有粉丝 (push)
+# 而是在粉丝读 newsfeed 的时候再把大 V 的 tweet 合并进来 (pull)
+CELEBRITY_FOLLOWERS_THRESHOLD = 10000
+
+# 计数器的增量写回数据库的锁最多持有多少秒
+COUNTS_FLUSH_LOCK_TIMEOUT = 60
+
+# 点赞和评论的通知先放进 redis 的队列里, 由 celery 异步地批量写进数据库
+# 队列从空变成非空之后等多少秒再投递, 这段时间里的通知会一起写
+NOTIFICATION_DELIVERY_DELAY = 5
+# 每次从队列里取多少个 event 写进数据库
+NOTIFICATION_DELIVERY_BATCH_SIZE = 500
+# 投递的锁最多持有多少秒
+NOTIFICATION_DELIVERY_LOCK_TIMEOUT = 60
+# 同一个 tweet/comment 的点赞, 这么多秒之内还没读的通知会合并成一条 "A and 12 others liked your tweet"
+NOTIFICATION_COALESCE_WINDOW = 3600
+# 合并之后的通知里最多记住最近多少个点赞的人, 用来去掉同一个人重复的点赞
+NOTIFICATION_ACTOR_IDS_LIMIT = 100
+# 把所有通知标记为已读的时候按照主键分批 update, 每批多少条, 每批之间 sleep 多少秒
+# 避免一条 update 语句长时间锁住大量的行, 产生很大的事务拖慢主从同步
+NOTIFICATION_MARK_AS_READ_BATCH_SIZE = 1000 if not TESTING else 2
+NOTIFICATION_MARK_AS_READ_SLEEP = 0.05 if not TESTING else 0
+# 未读的通知超过这么多条的时候 mark-all-as-read 不在请求里做, 放到 celery 里后台执行
+NOTIFICATION_MARK_AS_READ_SYNC_LIMIT = 1000 if not TESTING else 3
+# 后台标记已读的进度在 redis 里保存多少秒
+NOTIFICATION_MARK_AS_READ_PROGRESS_EXPIRE_TIME = 86400
+# 后台标记已读的任务多少秒没有完成就当作 worker 已经挂了, 允许再提交一次
+# 和 mark_all_as_read_task 的 time_limit 一样
+NOTIFICATION_MARK_AS_READ_JOB_TIMEOUT = 3600
+
+# Celery Configuration Options
+# 启动 worker: celery -A twitter worker -l INFO -Q default,newsfeeds
+# broker 是可以替换的, 线上用 redis 做消息队列, 测试的时候用进程内的 memory broker
+# 并且让 task 直接在当前进程里同步执行 (eager), 单元测试就不需要启动 worker 了
+CELERY_BROKER_URL = 'memory://' if TESTING else 'redis://{}:{}/2'.format(
+    REDIS_HOST,
+    REDIS_PORT,
+)
+CELERY_TIMEZONE = 'UTC'
+CELERY_TASK_ALWAYS_EAGER = TESTING
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+# 定时任务, 需要另外启动 beat: celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    # 点赞数评论数先记在 redis 里, 每隔 10 秒批量写回一次数据库
+    'flush-counts': {
+        'task': 'tweets.tasks.flush_counts_task',
+        'schedule': 10.0,
+    },
+    # 通知一般在放进队列的时候就安排了投递, 这里每分钟再检查一次, 防止安排的投递丢了
+    'deliver-notifications': {
+        'task': 'inbox.tasks.deliver_notifications_task',
+        'schedule': 60.0,
+    },
+    # redis 里的未读通知数每隔 10 分钟和数据库对一次账, 修正并发造成的偏差
+    'reconcile-unread-counts': {
+        'task': 'inbox.tasks.reconcile_unread_counts_task',
+        'schedule': 600.0,
+    },
+}
 
 
 try:
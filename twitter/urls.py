@@ -18,7 +18,9 @@ from django.urls import path, include
 from rest_framework import routers
 from accounts.api.views import UserViewSet, AccountViewSet, UserProfileViewSet
 from friendships.api.views import FriendshipViewSet
+from newsfeeds.api.async_views import list_newsfeeds
 from newsfeeds.api.views import NewsFeedViewSet
+from tweets.api.async_views import list_tweets
 from tweets.api.views import TweetViewSet
 from comments.api.views import CommentsViewSet
 from likes.api.views import LikeViewSet
@@ -40,6 +42,9 @@ router.register(r'api/profiles', UserProfileViewSet, basename='profiles')
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls',  namespace='rest_framework')),
+    # async 版本的 tweets 和 newsfeeds 列表, 需要用 ASGI 部署
+    path('api/async/tweets/', list_tweets),
+    path('api/async/newsfeeds/', list_newsfeeds),
     path('', include(router.urls))
 
 ]
@@ -0,0 +1,12 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user
+from rest_framework.request import Request
+
+
+async def get_api_request(request):
+    # async view 不经过 DRF 的 APIView, 自己把 django 的 request 包装成 DRF 的 Request
+    # 这样分页和 serializer 里还是可以用 request.query_params 和 request.user
+    # 从 session 里读出登录的用户需要访问数据库, 要放到 django 的同步线程里
+    api_request = Request(request)
+    api_request.user = await sync_to_async(get_user)(request)
+    return api_request
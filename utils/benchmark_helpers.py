@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from redis.connection import Connection
+from django.test.utils import CaptureQueriesContext
+
+
+def measure(func, *args, **kwargs):
+    # 返回 (耗时秒数, 执行了多少条 sql, func 的返回值)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+    return duration, len(queries), result
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+@contextmanager
+def count_redis_round_trips():
+    # 每次把命令发给 redis 都要走一次 send_packed_command, pipeline 里的命令是一起发的
+    # 所以统计这个函数被调用了多少次, 就是和 redis 之间 round trip 的次数
+    counter = {'round_trips': 0}
+    send_packed_command = Connection.send_packed_command
+
+    def counting_send_packed_command(self, *args, **kwargs):
+        counter['round_trips'] += 1
+        return send_packed_command(self, *args, **kwargs)
+
+    Connection.send_packed_command = counting_send_packed_command
+    try:
+        yield counter
+    finally:
+        Connection.send_packed_command = send_packed_command
+
+
+@contextmanager
+def rollback_atomic():
+    # benchmark 造的数据都放在一个事务里面, 跑完之后整体回滚, 不会污染数据库
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
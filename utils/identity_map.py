@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 当前请求的 identity map, 由 IdentityMapMiddleware 在每个请求开始的时候创建
+# 用 contextvar 而不是 threading.local, async view 里同一个线程会交替处理很多个请求
+# sync_to_async 也会把 context 带到执行同步代码的线程里
+_current_identity_map = ContextVar('identity_map', default=None)
+
+
+class IdentityMap:
+    # 一个请求里同一个 User/UserProfile 只从 memcached 里取一次, 之后都返回同一个 object
+    # 比如一页 newsfeeds 里同一个作者出现了很多次, tweet, comment, like 里又各自引用了这个用户
+    # memcached 每次返回的都是重新 unpickle 出来的新 object, 每个 object 上都要再取一次 profile
+    # key 是 (model label, id), UserProfile 和 memcached 里的 key 一样用的是 user_id
+    # 不在请求里的时候 (celery task, 管理命令) 没有 identity map, 下面的方法什么都不做
+
+    def __init__(self):
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    @contextmanager
+    def activate(cls):
+        identity_map = cls()
+        token = _current_identity_map.set(identity_map)
+        try:
+            yield identity_map
+        finally:
+            _current_identity_map.reset(token)
+
+    @classmethod
+    def current(cls):
+        return _current_identity_map.get()
+
+    @classmethod
+    def get_key(cls, model_class, object_id):
+        return model_class._meta.label_lower, object_id
+
+    @classmethod
+    def get(cls, model_class, object_id):
+        identity_map = cls.current()
+        if identity_map is None:
+            return None
+        obj = identity_map.objects.get(cls.get_key(model_class, object_id))
+        if obj is None:
+            identity_map.misses += 1
+        else:
+            identity_map.hits += 1
+        return obj
+
+    @classmethod
+    def get_many(cls, model_class, object_ids):
+        # 返回 {id: object}, 不在 identity map 里的不在返回结果里
+        identity_map = cls.current()
+        if identity_map is None:
+            return {}
+        id_to_object = {}
+        for object_id in set(object_ids):
+            if object_id is None:
+                continue
+            obj = identity_map.objects.get(cls.get_key(model_class, object_id))
+            if obj is None:
+                identity_map.misses += 1
+            else:
+                identity_map.hits += 1
+                id_to_object[object_id] = obj
+        return id_to_object
+
+    @classmethod
+    def add(cls, model_class, object_id, obj):
+        return cls.add_many(model_class, {object_id: obj}).get(object_id)
+
+    @classmethod
+    def add_many(cls, model_class, id_to_object):
+        # 返回 {id: identity map 里的 object}, 调用者要用返回的 object 而不是自己传进来的那个
+        # 比如 async 的请求里两个协程同时取同一个 user, 后加进来的那个会被丢掉
+        identity_map = cls.current()
+        if identity_map is None:
+            return id_to_object
+        mapped_objects = {}
+        for object_id, obj in id_to_object.items():
+            if obj is None:
+                continue
+            # 已经有了的话保留原来的那个, 保证同一个 id 在整个请求里都是同一个 object
+            mapped_objects[object_id] = identity_map.objects.setdefault(
+                cls.get_key(model_class, object_id),
+                obj,
+            )
+        return mapped_objects
+
+    @classmethod
+    def discard(cls, model_class, object_id):
+        # object 被修改或者删除的时候和 memcached 里的 cache 一起作废
+        identity_map = cls.current()
+        if identity_map is None:
+            return
+        identity_map.objects.pop(cls.get_key(model_class, object_id), None)
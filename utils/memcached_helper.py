@@ -1,5 +1,10 @@
+import time
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.cache import caches
+from utils.identity_map import IdentityMap
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -12,19 +17,167 @@ class MemcachedHelper:
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
+        # 同一个请求里已经取过的 user 直接从 identity map 里拿, 不用再访问 memcached
+        if cls.is_identity_mapped(model_class):
+            obj = IdentityMap.get(model_class, object_id)
+            if obj is None:
+                obj = IdentityMap.add(
+                    model_class,
+                    object_id,
+                    cls._get_object_through_cache(model_class, object_id),
+                )
+            return obj
+        return cls._get_object_through_cache(model_class, object_id)
+
+    @classmethod
+    def is_identity_mapped(cls, model_class):
+        # 只有 User 会在一个请求里被很多地方重复引用, tweet 之类的 object 不放进 identity map
+        return model_class is User
+
+    @classmethod
+    def _get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
         # cache hit
         obj = cache.get(key)
         if obj:
             return obj
 
-        # cache miss 这里不用 try catch 是假设用户应该存在的, 如果有问题, 就应该把问题暴露出来, 让运维和开发明白
-        obj = model_class.objects.get(id=object_id)
-        # using default expire time
-        cache.set(key, obj)
-        return obj
+        # cache miss 的时候只让拿到锁的请求去查数据库, 比如热门 tweet 被 invalidate 之后
+        # 同时有很多请求进来, 不希望每个请求都去查一次数据库
+        # memcached 的 add 只有在 key 不存在的时候才会成功, 可以用来当锁
+        lock_key = 'lock:{}'.format(key)
+        if cache.add(lock_key, 1, settings.CACHE_REBUILD_LOCK_TIMEOUT):
+            try:
+                # 这里不用 try catch 是假设用户应该存在的, 如果有问题, 就应该把问题暴露出来, 让运维和开发明白
+                obj = model_class.objects.get(id=object_id)
+                # using default expire time
+                cache.set(key, obj)
+            finally:
+                cache.delete(lock_key)
+            return obj
+
+        # 别人正在查, 等一小会儿再从 cache 里取, 等不到就自己去数据库里查
+        deadline = time.monotonic() + settings.CACHE_REBUILD_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+            obj = cache.get(key)
+            if obj:
+                return obj
+        return model_class.objects.get(id=object_id)
+
+    @classmethod
+    def get_cached_objects(cls, model_class, object_ids):
+        # 只读 memcached, 返回 {id: object}, cache miss 的不在返回结果里
+        keys = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in set(object_ids)
+            if object_id is not None
+        }
+        return {
+            keys[key]: obj
+            for key, obj in cache.get_many(keys.keys()).items()
+        }
+
+    @classmethod
+    def load_objects_to_cache(cls, model_class, object_ids):
+        # cache miss 的 object 用一条 id__in 的 query 一起查出来, 再用 set_many 写回去
+        # 数据库里已经不存在的 object 不会出现在返回结果里
+        id_to_object = {
+            obj.id: obj
+            for obj in model_class.objects.filter(id__in=object_ids)
+        }
+        cache.set_many({
+            cls.get_key(model_class, object_id): obj
+            for object_id, obj in id_to_object.items()
+        })
+        return id_to_object
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        # 批量版本的 get_object_through_cache, 返回 {id: object}
+        # 一次 get_many 从 memcached 里取出所有的 object, 而不是每个 object 各 get 一次
+        id_to_object = {}
+        if cls.is_identity_mapped(model_class):
+            id_to_object = IdentityMap.get_many(model_class, object_ids)
+            object_ids = [
+                object_id for object_id in object_ids
+                if object_id not in id_to_object
+            ]
+        loaded_objects = cls.get_cached_objects(model_class, object_ids)
+        missing_ids = [
+            object_id for object_id in set(object_ids)
+            if object_id is not None and object_id not in loaded_objects
+        ]
+        if missing_ids:
+            loaded_objects.update(cls.load_objects_to_cache(model_class, missing_ids))
+        if cls.is_identity_mapped(model_class):
+            loaded_objects = IdentityMap.add_many(model_class, loaded_objects)
+        id_to_object.update(loaded_objects)
+        return id_to_object
+
+    @classmethod
+    async def get_objects_through_cache_async(cls, model_class, object_ids):
+        # async 版本, memcached 的 client 是同步的, 放到线程池里去读, 不会卡住 event loop
+        # 数据库只能在 django 的同步线程里访问, 所以 cache miss 的部分还是用 thread_sensitive 的方式去查
+        id_to_object = {}
+        if cls.is_identity_mapped(model_class):
+            id_to_object = IdentityMap.get_many(model_class, object_ids)
+            object_ids = [
+                object_id for object_id in object_ids
+                if object_id not in id_to_object
+            ]
+        loaded_objects = await sync_to_async(
+            cls.get_cached_objects,
+            thread_sensitive=False,
+        )(model_class, object_ids)
+        missing_ids = [
+            object_id for object_id in set(object_ids)
+            if object_id is not None and object_id not in loaded_objects
+        ]
+        if missing_ids:
+            loaded_objects.update(await sync_to_async(cls.load_objects_to_cache)(
+                model_class,
+                missing_ids,
+            ))
+        if cls.is_identity_mapped(model_class):
+            loaded_objects = IdentityMap.add_many(model_class, loaded_objects)
+        id_to_object.update(loaded_objects)
+        return id_to_object
+
+    @classmethod
+    def _set_prefetched_objects(cls, objects, id_to_object, id_attname, to_attr):
+        for obj in objects:
+            object_id = getattr(obj, id_attname)
+            if object_id in id_to_object:
+                setattr(obj, to_attr, id_to_object[object_id])
+
+    @classmethod
+    def prefetch_objects_through_cache(cls, objects, model_class, id_attname, to_attr):
+        # 比如 objects 是一页 tweets, 把所有 tweet 的 user 一次性取出来
+        # 存到每个 tweet 的 cached_user 上, 之后渲染的时候就不需要再访问 memcached 了
+        # 已经 prefetch 过的 object 就跳过
+        objects = [obj for obj in objects if to_attr not in obj.__dict__]
+        if not objects:
+            return
+        id_to_object = cls.get_objects_through_cache(
+            model_class,
+            [getattr(obj, id_attname) for obj in objects],
+        )
+        cls._set_prefetched_objects(objects, id_to_object, id_attname, to_attr)
+
+    @classmethod
+    async def prefetch_objects_through_cache_async(cls, objects, model_class, id_attname, to_attr):
+        objects = [obj for obj in objects if to_attr not in obj.__dict__]
+        if not objects:
+            return
+        id_to_object = await cls.get_objects_through_cache_async(
+            model_class,
+            [getattr(obj, id_attname) for obj in objects],
+        )
+        cls._set_prefetched_objects(objects, id_to_object, id_attname, to_attr)
 
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        IdentityMap.discard(model_class, object_id)
\ No newline at end of file
@@ -0,0 +1,36 @@
+import asyncio
+
+from django.conf import settings
+from utils.identity_map import IdentityMap
+
+
+class IdentityMapMiddleware:
+    # 每个请求创建一个新的 identity map, 请求结束之后就丢掉
+    # 同时支持 sync 和 async, async view 的请求不需要在这里切换到同步线程
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # 告诉 django 这是一个 async 的 middleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        with IdentityMap.activate() as identity_map:
+            response = self.get_response(request)
+        return self.add_stats_headers(response, identity_map)
+
+    async def __acall__(self, request):
+        with IdentityMap.activate() as identity_map:
+            response = await self.get_response(request)
+        return self.add_stats_headers(response, identity_map)
+
+    def add_stats_headers(self, response, identity_map):
+        # 开发的时候可以在 response header 里看到这个请求的 identity map 命中了多少次
+        if settings.IDENTITY_MAP_STATS_HEADERS:
+            response['X-Identity-Map-Hits'] = identity_map.hits
+            response['X-Identity-Map-Misses'] = identity_map.misses
+        return response
@@ -1,7 +1,16 @@
+import base64
+import datetime
+from bisect import bisect_left
+
 from dateutil import parser
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
 
 class EndlessPagination(BasePagination):
     page_size = 20
@@ -41,6 +50,40 @@ class EndlessPagination(BasePagination):
                 reverse_ordered_list = []
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
         return reverse_ordered_list[index: index + self.page_size]
+
+    def paginate_cached_list(self, loader, request):
+        # loader(limit) 返回 cache 里最新的 limit 个 objects
+        # 先只取一页多一个, 不够的话 (比如 created_at__lt 翻到了比较后面的页) 再翻倍去取
+        # 这样大部分请求只需要从 redis 里 lrange 出一页的数据来反序列化
+        limit = self.page_size + 1
+        while True:
+            cached_list = loader(limit)
+            paginated_list = self.paginate_ordered_list(cached_list, request)
+            # 还有下一页, 说明 cached_list 里已经有这一页需要的所有数据
+            if self.has_next_page:
+                return paginated_list
+            # 下拉刷新的时候如果还有更多新的数据, 最多也就加载到 cache 的上限
+            # 很久没有刷新的话客户端会重新加载最新的数据, 不需要去数据库里查
+            if self.is_refreshing(request):
+                if len(paginated_list) < len(cached_list) \
+                        or len(cached_list) < limit \
+                        or limit >= settings.REDIS_LIST_LENGTH_LIMIT:
+                    return paginated_list
+            # cache 里的 list 已经取完了
+            elif len(cached_list) < limit:
+                # 长度不足最大限制, 说明 cache 里已经是所有的数据了
+                if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+                    return paginated_list
+                # 否则数据库里可能还有没 cache 的数据, 返回 None 让调用者去数据库里查
+                return None
+            elif limit >= settings.REDIS_LIST_LENGTH_LIMIT:
+                return None
+            limit = min(limit * 2, settings.REDIS_LIST_LENGTH_LIMIT)
+
+    def is_refreshing(self, request):
+        # 是不是下拉刷新, 下拉刷新会加载所有更新的数据
+        return 'created_at__gt' in request.query_params
+
     def paginate_queryset(self, queryset, request, view=None):
         if type(queryset) == list:
             return self.paginate_ordered_list(queryset, request)
@@ -75,4 +118,166 @@ class EndlessPagination(BasePagination):
         return Response({
             'has_next_page': self.has_next_page,
             'results': data,
-        })
\ No newline at end of file
+        })
+
+
+class KeysetPagination(EndlessPagination):
+    # 按照 (created_at, tiebreaker) 倒序排列, 用 cursor 来翻页
+    # 只用 created_at 翻页的话, 如果有多个 object 的 created_at 相同, 并且刚好落在两页的边界上
+    # 用 created_at__lt 翻到下一页的时候就会把它们漏掉, 所以需要再加一个唯一的字段来区分
+    # cursor 是 (created_at, tiebreaker) 编码之后的字符串, 客户端不需要关心里面是什么
+    # 向下翻页用 ?cursor=<next_cursor>, 下拉刷新用 ?newer_than=<refresh_cursor>
+    # 仍然兼容 created_at__lt 和 created_at__gt 两个参数
+    # 排序的时间字段不叫 created_at 的 model (比如 Notification 的 timestamp) 可以在子类里改 ordering_field
+    ordering_field = 'created_at'
+    tiebreaker = 'id'
+
+    def __init__(self):
+        super(KeysetPagination, self).__init__()
+        self.next_cursor = None
+        self.refresh_cursor = None
+
+    @classmethod
+    def encode_cursor(cls, created_at, tiebreaker_value):
+        delta = created_at - EPOCH
+        microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        raw = '{}:{}'.format(microseconds, tiebreaker_value)
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        try:
+            padding = '=' * (-len(cursor) % 4)
+            raw = base64.urlsafe_b64decode(cursor + padding).decode()
+            microseconds, tiebreaker_value = raw.split(':')
+            created_at = EPOCH + datetime.timedelta(microseconds=int(microseconds))
+            return created_at, int(tiebreaker_value)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def get_bounds(self, request):
+        # 返回 (newer_than, older_than), 都是 (created_at, tiebreaker) 或者 None
+        # tiebreaker 是 None 表示只比较 created_at, 用于兼容 created_at__gt 和 created_at__lt
+        params = request.query_params
+        newer_than, older_than = None, None
+        if 'newer_than' in params:
+            newer_than = self.decode_cursor(params['newer_than'])
+        elif 'created_at__gt' in params:
+            newer_than = (parser.isoparse(params['created_at__gt']), None)
+        if 'cursor' in params:
+            older_than = self.decode_cursor(params['cursor'])
+        elif 'created_at__lt' in params:
+            older_than = (parser.isoparse(params['created_at__lt']), None)
+        return newer_than, older_than
+
+    def is_refreshing(self, request):
+        return 'newer_than' in request.query_params \
+            or super(KeysetPagination, self).is_refreshing(request)
+
+    @classmethod
+    def is_older(cls, obj, bound, tiebreaker='id'):
+        created_at, tiebreaker_value = bound
+        value = getattr(obj, cls.ordering_field)
+        if value != created_at:
+            return value < created_at
+        return tiebreaker_value is not None \
+            and getattr(obj, tiebreaker) < tiebreaker_value
+
+    @classmethod
+    def is_newer(cls, obj, bound, tiebreaker='id'):
+        created_at, tiebreaker_value = bound
+        value = getattr(obj, cls.ordering_field)
+        if value != created_at:
+            return value > created_at
+        return tiebreaker_value is not None \
+            and getattr(obj, tiebreaker) > tiebreaker_value
+
+    @classmethod
+    def filter_older_than(cls, queryset, bound, tiebreaker='id'):
+        # (created_at, id) < (c, i) 展开成 created_at < c OR (created_at = c AND id < i)
+        # mysql 对 row constructor 的比较不一定能用上索引, 展开之后可以用上 (user, created_at) 的联合索引
+        created_at, tiebreaker_value = bound
+        condition = Q(**{cls.ordering_field + '__lt': created_at})
+        if tiebreaker_value is not None:
+            condition |= Q(**{
+                cls.ordering_field: created_at,
+                tiebreaker + '__lt': tiebreaker_value,
+            })
+        return queryset.filter(condition)
+
+    @classmethod
+    def filter_newer_than(cls, queryset, bound, tiebreaker='id'):
+        created_at, tiebreaker_value = bound
+        condition = Q(**{cls.ordering_field + '__gt': created_at})
+        if tiebreaker_value is not None:
+            condition |= Q(**{
+                cls.ordering_field: created_at,
+                tiebreaker + '__gt': tiebreaker_value,
+            })
+        return queryset.filter(condition)
+
+    def paginate_ordered_list(self, reverse_ordered_list, request):
+        # list 是按照 (created_at, tiebreaker) 倒序排好的, 用二分查找找到翻页的边界
+        newer_than, older_than = self.get_bounds(request)
+        if newer_than is not None:
+            # 比 newer_than 更新的 objects 都在 list 的最前面
+            end = bisect_left(
+                reverse_ordered_list,
+                True,
+                key=lambda obj: not self.is_newer(obj, newer_than, self.tiebreaker),
+            )
+            self.has_next_page = False
+            return self._set_cursors(reverse_ordered_list[:end])
+
+        start = 0
+        if older_than is not None:
+            start = bisect_left(
+                reverse_ordered_list,
+                True,
+                key=lambda obj: self.is_older(obj, older_than, self.tiebreaker),
+            )
+        self.has_next_page = len(reverse_ordered_list) > start + self.page_size
+        return self._set_cursors(
+            reverse_ordered_list[start: start + self.page_size],
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if type(queryset) == list:
+            return self.paginate_ordered_list(queryset, request)
+
+        newer_than, older_than = self.get_bounds(request)
+        queryset = queryset.order_by('-' + self.ordering_field, '-' + self.tiebreaker)
+        if newer_than is not None:
+            self.has_next_page = False
+            return self._set_cursors(list(self.filter_newer_than(
+                queryset,
+                newer_than,
+                self.tiebreaker,
+            )))
+
+        if older_than is not None:
+            queryset = self.filter_older_than(queryset, older_than, self.tiebreaker)
+        # 多取一个用来判断是否还有下一页
+        objects = list(queryset[:self.page_size + 1])
+        self.has_next_page = len(objects) > self.page_size
+        return self._set_cursors(objects[:self.page_size])
+
+    def _set_cursors(self, objects):
+        if objects:
+            self.refresh_cursor = self.encode_cursor(
+                getattr(objects[0], self.ordering_field),
+                getattr(objects[0], self.tiebreaker),
+            )
+            self.next_cursor = self.encode_cursor(
+                getattr(objects[-1], self.ordering_field),
+                getattr(objects[-1], self.tiebreaker),
+            )
+        return objects
+
+    def get_paginated_response(self, data):
+        return Response({
+            'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor if self.has_next_page else None,
+            'refresh_cursor': self.refresh_cursor,
+            'results': data,
+        })
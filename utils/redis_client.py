@@ -1,26 +1,116 @@
+import asyncio
+import random
+import threading
+import weakref
+
 from django.conf import settings
 import redis
+import redis.asyncio
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
 
 
 class RedisClient:
     conn = None
+    replica_conns = None
+    # async 的 connection 只能在创建它的 event loop 里用, 每个 event loop 各有一个
+    async_conns = weakref.WeakKeyDictionary()
+    # 多线程的 worker 里可能有好几个线程同时第一次调用 get_connection, 加锁保证只创建一次
+    lock = threading.Lock()
+
+    @classmethod
+    def _create_connection(cls, host, port):
+        # redis.Redis 本身是线程安全的, 每条命令执行的时候从 pool 里借一个 connection, 执行完再还回去
+        # 用 BlockingConnectionPool, connection 都被借走的时候等一会儿, 而不是直接报错
+        pool = redis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+            retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+            # 重试的间隔从 10ms 开始指数增长, 最多等 0.5 秒
+            retry=Retry(ExponentialBackoff(cap=0.5, base=0.01), settings.REDIS_RETRIES),
+        )
+        return redis.Redis(connection_pool=pool)
 
     @classmethod
     def get_connection(cls):
-        # 使用 singleton 模式，全局只创建一个 connection
+        # 使用 singleton 模式，全局只创建一个 connection pool
         if cls.conn:
             return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
+        with cls.lock:
+            if cls.conn is None:
+                cls.conn = cls._create_connection(
+                    settings.REDIS_HOST,
+                    settings.REDIS_PORT,
+                )
         return cls.conn
 
+    @classmethod
+    def get_async_connection(cls):
+        # 给 async view 用的 redis.asyncio client, 连接池的配置和同步的一样
+        loop = asyncio.get_running_loop()
+        if loop not in cls.async_conns:
+            pool = redis.asyncio.BlockingConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+                health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+                retry=AsyncRetry(ExponentialBackoff(cap=0.5, base=0.01), settings.REDIS_RETRIES),
+            )
+            cls.async_conns[loop] = redis.asyncio.Redis(connection_pool=pool)
+        return cls.async_conns[loop]
+
+    @classmethod
+    def get_read_connection(cls):
+        # 只读的请求可以发到 replica 上, 没有配置 replica 的话还是用主库
+        # replica 的数据会有一点延迟, 刚写进去就要读到的地方不能用
+        if not settings.REDIS_REPLICAS:
+            return cls.get_connection()
+        if cls.replica_conns is None:
+            with cls.lock:
+                if cls.replica_conns is None:
+                    cls.replica_conns = [
+                        cls._create_connection(host, port)
+                        for host, port in settings.REDIS_REPLICAS
+                    ]
+        return random.choice(cls.replica_conns)
+
+    @classmethod
+    def get_pool_stats(cls):
+        # 每个 pool 最多能有多少个 connection, 已经创建了多少个, 正在被使用的有多少个
+        conns = [cls.get_connection()] + (cls.replica_conns or [])
+        stats = []
+        for conn in conns:
+            pool = conn.connection_pool
+            created = len(pool._connections)
+            # BlockingConnectionPool 的 queue 里放的是空闲的 connection, 还没有创建的位置是 None
+            idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+            stats.append({
+                'host': pool.connection_kwargs['host'],
+                'port': pool.connection_kwargs['port'],
+                'max_connections': pool.max_connections,
+                'created_connections': created,
+                'in_use_connections': created - idle,
+            })
+        return stats
+
     @classmethod
     def clear(cls):
         # clear all keys in redis, for testing purpose
         if not settings.TESTING:
             raise Exception("You can not flush redis in production environment")
         conn = cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        conn.flushdb()
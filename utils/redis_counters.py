@@ -0,0 +1,309 @@
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from twitter.cache import (
+    COUNTS_FLUSH_LOCK_KEY,
+    COUNTS_FLUSH_VERSION_KEY,
+    FLUSHING_COUNTS_ID_KEY,
+    FLUSHING_COUNTS_KEY,
+    OBJECT_COUNT_PATTERN,
+    PENDING_COUNTS_KEY,
+)
+from utils.redis_client import RedisClient
+from utils.redis_lock import RedisLock
+from utils.time_helpers import utc_now
+
+# 只有 key 存在的时候才加, key 不存在的时候等读的时候再从数据库里算出来
+# 如果先 exists 再 incrby, 两条命令之间 key 过期了的话, 会创建出一个从 0 开始的错误计数器
+INCR_IF_EXISTS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+class RedisCounters:
+    # 点赞数, 评论数这种写得非常频繁的计数器
+    # 每次点赞如果都去 update 数据库的同一行, 热门 tweet 的那一行会有很严重的锁竞争
+    # 所以先在 redis 里计数, 同时把增量记录在 PENDING_COUNTS_KEY 这个 hash 里
+    # 再由 celery 定时任务 flush 批量写回数据库
+    incr_if_exists = None
+
+    @classmethod
+    def get_key(cls, label, object_id, field):
+        return OBJECT_COUNT_PATTERN.format(
+            label=label,
+            object_id=object_id,
+            field=field,
+        )
+
+    @classmethod
+    def get_delta_field(cls, label, object_id, field):
+        # pending hash 里的 field, 比如 tweets.tweet:1:likes_count
+        return '{}:{}:{}'.format(label, object_id, field)
+
+    @classmethod
+    def incr(cls, model_class, object_id, field, delta=1):
+        conn = RedisClient.get_connection()
+        if cls.incr_if_exists is None:
+            cls.incr_if_exists = conn.register_script(INCR_IF_EXISTS_SCRIPT)
+        label = model_class._meta.label_lower
+
+        pipeline = conn.pipeline()
+        cls.incr_if_exists(
+            keys=[cls.get_key(label, object_id, field)],
+            args=[delta],
+            client=pipeline,
+        )
+        pipeline.hincrby(
+            PENDING_COUNTS_KEY,
+            cls.get_delta_field(label, object_id, field),
+            delta,
+        )
+        pipeline.execute()
+
+    @classmethod
+    def decr(cls, model_class, object_id, field):
+        cls.incr(model_class, object_id, field, -1)
+
+    @classmethod
+    def get_count(cls, obj, field):
+        if hasattr(obj, '_cached_counts') and field in obj._cached_counts:
+            return obj._cached_counts[field]
+        return cls.get_counts(obj.__class__, [obj.id], field)[obj.id]
+
+    @classmethod
+    def prefetch_counts(cls, objects, fields):
+        # 一页 tweets 的所有计数器用一次 mget 取出来, 存在每个 object 的 _cached_counts 上
+        if not objects:
+            return
+        model_class = objects[0].__class__
+        for field in fields:
+            # 已经 prefetch 过的 object 就跳过
+            missing_objects = [
+                obj for obj in objects
+                if field not in getattr(obj, '_cached_counts', {})
+            ]
+            if not missing_objects:
+                continue
+            counts = cls.get_counts(
+                model_class,
+                [obj.id for obj in missing_objects],
+                field,
+            )
+            cls.set_prefetched_counts(missing_objects, field, counts)
+
+    @classmethod
+    def set_prefetched_counts(cls, objects, field, counts):
+        for obj in objects:
+            if not hasattr(obj, '_cached_counts'):
+                obj._cached_counts = {}
+            obj._cached_counts[field] = counts[obj.id]
+
+    @classmethod
+    def get_counts(cls, model_class, object_ids, field):
+        conn = RedisClient.get_connection()
+        label = model_class._meta.label_lower
+        keys = [cls.get_key(label, object_id, field) for object_id in object_ids]
+        # 计数器读 replica 就够了, 晚一点点看到别人的点赞没有关系
+        cached_counts = RedisClient.get_read_connection().mget(keys)
+        counts = {
+            object_id: int(count)
+            for object_id, count in zip(object_ids, cached_counts)
+            if count is not None
+        }
+
+        missing_ids = [
+            object_id for object_id in object_ids if object_id not in counts
+        ]
+        if not missing_ids:
+            return counts
+
+        # cache miss 的计数器 = 数据库里的值 + 还没有写回数据库的增量
+        # 数据库和两个 hash 不是同一时刻读的, 中间如果有 flush 把 flushing 写进了数据库, 同一份增量会被算两次
+        # 所以像 seqlock 一样, 读之前和读之后各看一次 flush 的 version, 读的过程中数据库被改过就重新读
+        # 一直读不到一致的结果就直接返回算出来的值, 但是不写进 redis, 留给下一次读再算
+        deadline = time.monotonic() + settings.CACHE_REBUILD_WAIT_TIMEOUT
+        while True:
+            missing_counts, consistent = cls._read_missing_counts(
+                conn,
+                model_class,
+                missing_ids,
+                field,
+            )
+            if consistent or time.monotonic() >= deadline:
+                break
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+        counts.update(missing_counts)
+        if not consistent:
+            return counts
+
+        pipeline = conn.pipeline()
+        for object_id, count in missing_counts.items():
+            # nx: 读的过程中如果有人点赞已经建好了计数器, 就不要覆盖
+            pipeline.set(
+                cls.get_key(label, object_id, field),
+                count,
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+                nx=True,
+            )
+        pipeline.execute()
+        return counts
+
+    @classmethod
+    def _read_missing_counts(cls, conn, model_class, object_ids, field):
+        # 返回 (计数, 读的过程中数据库里的计数有没有可能被改过)
+        label = model_class._meta.label_lower
+        delta_fields = [
+            cls.get_delta_field(label, object_id, field)
+            for object_id in object_ids
+        ]
+        # pipeline 默认是 MULTI/EXEC, version, 锁和两个 hash 是同一时刻的
+        pipeline = conn.pipeline()
+        pipeline.get(COUNTS_FLUSH_VERSION_KEY)
+        pipeline.exists(COUNTS_FLUSH_LOCK_KEY)
+        pipeline.hmget(PENDING_COUNTS_KEY, delta_fields)
+        pipeline.hmget(FLUSHING_COUNTS_KEY, delta_fields)
+        version, locked, pending_deltas, flushing_deltas = pipeline.execute()
+
+        # 这里要从数据库里重新读, 因为 cache 在 redis/memcached 里的 object 上的计数可能已经过期了
+        db_counts = dict(model_class.objects.filter(
+            id__in=object_ids,
+        ).values_list('id', field))
+        counts = {
+            object_id: (db_counts.get(object_id) or 0)
+            + int(pending or 0) + int(flushing or 0)
+            for object_id, pending, flushing in zip(
+                object_ids,
+                pending_deltas,
+                flushing_deltas,
+            )
+        }
+        # 读 hash 的时候有人拿着锁 (可能正在写数据库), 或者之后有人拿过锁, 都算不一致
+        consistent = not locked and conn.get(COUNTS_FLUSH_VERSION_KEY) == version
+        return counts, consistent
+
+    @classmethod
+    async def get_counts_async(cls, model_class, object_ids, field):
+        # async 版本, 用 redis.asyncio 读计数器, cache miss 的计数器很少, 还是交给同步的版本去重建
+        conn = RedisClient.get_async_connection()
+        label = model_class._meta.label_lower
+        keys = [cls.get_key(label, object_id, field) for object_id in object_ids]
+        counts = {
+            object_id: int(count)
+            for object_id, count in zip(object_ids, await conn.mget(keys))
+            if count is not None
+        }
+        missing_ids = [
+            object_id for object_id in object_ids if object_id not in counts
+        ]
+        if missing_ids:
+            counts.update(await sync_to_async(cls.get_counts)(
+                model_class,
+                missing_ids,
+                field,
+            ))
+        return counts
+
+    @classmethod
+    def acquire_flush_lock(cls, wait_timeout=0):
+        # 改数据库里的计数之前都要先拿到这个锁 (flush 和 reconcile_counts), 没拿到返回 None
+        # 拿到锁之后把 version 加一, get_counts 就知道它读数据库的过程中计数可能被改过
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            token = RedisLock.acquire(
+                COUNTS_FLUSH_LOCK_KEY,
+                settings.COUNTS_FLUSH_LOCK_TIMEOUT * 1000,
+            )
+            if token is not None:
+                RedisClient.get_connection().incr(COUNTS_FLUSH_VERSION_KEY)
+                return token
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+
+    @classmethod
+    def release_flush_lock(cls, token):
+        RedisLock.release(COUNTS_FLUSH_LOCK_KEY, token)
+
+    @classmethod
+    def flush(cls):
+        # 同一时间只有一个 worker 在 flush, 两个 flush 同时写同一份 flushing 的话增量会被加两次
+        token = cls.acquire_flush_lock()
+        if token is None:
+            return 0
+        try:
+            return cls._flush()
+        finally:
+            cls.release_flush_lock(token)
+
+    @classmethod
+    def _flush(cls):
+        # 把 pending 的增量 rename 成 flushing 之后再写数据库, 写的过程中新的增量会记到新的 pending 里
+        # 如果上一次 flush 中途失败了, flushing 还在, 先把它写完
+        conn = RedisClient.get_connection()
+        if not conn.exists(FLUSHING_COUNTS_KEY):
+            if not conn.exists(PENDING_COUNTS_KEY):
+                return 0
+            # 每一批增量有一个 id, 和 rename 放在同一个事务里
+            pipeline = conn.pipeline()
+            pipeline.rename(PENDING_COUNTS_KEY, FLUSHING_COUNTS_KEY)
+            pipeline.set(FLUSHING_COUNTS_ID_KEY, uuid.uuid4().hex)
+            pipeline.execute()
+        flush_id = conn.get(FLUSHING_COUNTS_ID_KEY)
+        if flush_id is None:
+            # 加 id 之前留下来的 flushing, 给它补一个
+            flush_id = uuid.uuid4().hex.encode()
+            conn.set(FLUSHING_COUNTS_ID_KEY, flush_id)
+
+        # 同一个 model 同一个字段增量相同的 object 可以用一条 update 语句一起更新
+        # 比如 {(Tweet, 'likes_count', 1): [1, 2, 3]}
+        updates = defaultdict(list)
+        for delta_field, delta in conn.hgetall(FLUSHING_COUNTS_KEY).items():
+            label, object_id, field = delta_field.decode().split(':')
+            if int(delta) != 0:
+                updates[(label, field, int(delta))].append(int(object_id))
+
+        # 增量和这批增量的 id 在同一个事务里写进数据库
+        # 事务提交之后, 删掉 flushing 之前挂了的话, 下一次 flush 看到 id 已经在了就不会再写一次
+        CountsFlush = apps.get_model('tweets', 'CountsFlush')
+        with transaction.atomic():
+            _, created = CountsFlush.objects.get_or_create(
+                flush_id=flush_id.decode(),
+            )
+            if created:
+                for (label, field, delta), object_ids in updates.items():
+                    model_class = apps.get_model(label)
+                    # 加字段之前创建的 object 计数可能是 null
+                    model_class.objects.filter(id__in=object_ids).update(**{
+                        field: Coalesce(F(field), 0) + delta,
+                    })
+            # id 只是用来判断挂掉之前的那次 flush 有没有写完, 不需要一直留着
+            CountsFlush.objects.filter(
+                created_at__lt=utc_now() - timedelta(days=1),
+            ).delete()
+        conn.delete(FLUSHING_COUNTS_KEY, FLUSHING_COUNTS_ID_KEY)
+        if not created:
+            return 0
+        return sum(len(object_ids) for object_ids in updates.values())
+
+    @classmethod
+    def invalidate_counts(cls, model_class, object_ids, field):
+        # 数据库里的计数被重新计算之后, redis 里的计数器也要删掉重新算
+        if not object_ids:
+            return
+        conn = RedisClient.get_connection()
+        label = model_class._meta.label_lower
+        conn.delete(*[
+            cls.get_key(label, object_id, field)
+            for object_id in object_ids
+        ])
@@ -1,49 +1,389 @@
+import datetime
+import math
+import random
+import time
+import uuid
+
 from django.conf import settings
+from twitter.cache import (
+    CACHE_INVALIDATED_PATTERN,
+    CACHE_REBUILD_COST_PATTERN,
+    CACHE_REBUILD_LOCK_PATTERN,
+    CACHE_REBUILD_TEMP_PATTERN,
+    TIMELINE_HEAD_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_lock import RedisLock
+from utils.redis_serializers import RedisModelSerializer, SchemaMismatchError
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# 下面几个脚本里 KEYS[2] 都是 timeline 的 head, 记录 cache 里最新的 object 的排序值
+# 排序值是 {created_at 微秒数:017d}:{tiebreaker:020d}, 补齐之后可以直接按字符串比较大小
+# timeline 的 key 不存在的时候 push 也会把 head 记下来, 保留一小段时间
+# 这样正在重建的请求就能知道自己从数据库里读出来的数据是不是已经旧了
+
+# 重建好的临时 key 原子地 rename 成 timeline 的 key
+# KEYS[1] 是临时 key, KEYS[2] 是 head, KEYS[3] 是 timeline 的 key, KEYS[4] 是 cache 被作废过几次
+# ARGV[1] 是重建的数据里最新的 object 的排序值, ARGV[2] 是过期时间, ARGV[3] 是读数据库之前 cache 被作废过几次
+# 如果重建期间有更新的 object push 进来了, 或者 cache 被作废了, 说明读数据库之后又有新的写入, 重建的数据是旧的
+# 这时候不能写进去, 而是把 cache 整个删掉, 下次读的时候再从数据库里重建
+REPLACE_IF_NOT_STALE_SCRIPT = """
+local head = redis.call('get', KEYS[2])
+local invalidated = redis.call('get', KEYS[4]) or ''
+if invalidated ~= ARGV[3] or (head and head > ARGV[1]) then
+    redis.call('del', KEYS[1], KEYS[2], KEYS[3])
+    return 0
+end
+redis.call('rename', KEYS[1], KEYS[3])
+redis.call('expire', KEYS[3], ARGV[2])
+redis.call('set', KEYS[2], ARGV[1], 'ex', ARGV[2])
+return 1
+"""
+
+# ARGV[1] 是 object 的排序值, ARGV[2] 是最多保留多少个 object
+# ARGV[3] 是 key 不存在的时候 head 保留多少毫秒, 后面的参数是写入 timeline 的内容
+# 返回 0 表示 key 不存在没有 push, 1 表示 push 成功, 2 表示已经在 cache 里了, 3 表示顺序乱了 cache 被删掉了
+PUSH_HEAD_LUA = """
+local head = redis.call('get', KEYS[2])
+if redis.call('exists', KEYS[1]) == 0 then
+    if not head or ARGV[1] > head then
+        redis.call('set', KEYS[2], ARGV[1], 'px', ARGV[3])
+    end
+    return 0
+end
+"""
+SET_HEAD_LUA = """
+if not head or ARGV[1] > head then
+    redis.call('set', KEYS[2], ARGV[1])
+    local ttl = redis.call('pttl', KEYS[1])
+    if ttl > 0 then
+        redis.call('pexpire', KEYS[2], ttl)
+    end
+end
+"""
+
+# list 只能从头部 push, 只有比 head 更新的 object 才能 push 进去
+# 和 head 一样说明重建的时候已经从数据库里读到了, 再 push 就重复了
+# 比 head 还旧说明两个 push 的先后顺序乱了, list 里没办法插到中间去, 只能删掉等下次读的时候重建
+LPUSH_IF_NEWER_SCRIPT = PUSH_HEAD_LUA + """
+if head and ARGV[1] == head then
+    return 2
+end
+if head and ARGV[1] < head then
+    redis.call('del', KEYS[1], KEYS[2])
+    return 3
+end
+redis.call('lpush', KEYS[1], ARGV[4])
+redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+""" + SET_HEAD_LUA + """
+return 1
+"""
+
+# sorted set 本身就是有序和去重的, 旧的 object 也可以直接 zadd 到正确的位置
+# 只保留分数最高的 REDIS_LIST_LENGTH_LIMIT 个, ARGV[4] 是 score, ARGV[5] 是 member
+ZADD_IF_EXISTS_SCRIPT = PUSH_HEAD_LUA + """
+if redis.call('zadd', KEYS[1], ARGV[4], ARGV[5]) == 0 then
+    return 2
+end
+redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+""" + SET_HEAD_LUA + """
+return 1
+"""
 
 
 class RedisHelper:
+    push_script = LPUSH_IF_NEWER_SCRIPT
+    # 不同的存储方式用不同的 key, 传进来的 key 前面加上这个前缀
+    # 切换 TIMELINE_BACKEND 的时候还没过期的 key 是另一种类型, 共用一个 key 的话所有的读写都会报 WRONGTYPE
+    key_prefix = ''
+    # 注册过的 lua 脚本, 之后用 evalsha 执行
+    scripts = {}
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
+    def _get_script(cls, source):
+        if source not in cls.scripts:
+            conn = RedisClient.get_connection()
+            cls.scripts[source] = conn.register_script(source)
+        return cls.scripts[source]
 
-        conn = RedisClient.get_connection()
+    @classmethod
+    def get_key(cls, key):
+        return cls.key_prefix + key
+
+    @classmethod
+    def _get_tiebreaker(cls, queryset):
+        # queryset 都是按照 ('-created_at', '-id') 或者 ('-created_at', '-tweet_id') 排序的
+        return queryset.query.order_by[-1].lstrip('-')
+
+    @classmethod
+    def _get_score(cls, obj):
+        delta = obj.created_at - EPOCH
+        # 微秒数在 2^53 以内, 用 double 存也不会丢失精度
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    @classmethod
+    def _get_sort_key(cls, obj, tiebreaker):
+        return '{:017d}:{:020d}'.format(cls._get_score(obj), getattr(obj, tiebreaker))
+
+    @classmethod
+    def _get_push_args(cls, obj, tiebreaker):
+        return [RedisModelSerializer.serialize(obj)]
 
+    @classmethod
+    def _push(cls, client, key, obj, tiebreaker):
+        # 检查 key 是否存在和 push 在同一个 lua 脚本里, 中间不会被别的请求插进来
+        return cls._get_script(cls.push_script)(
+            keys=[key, TIMELINE_HEAD_PATTERN.format(key=key)],
+            args=[
+                cls._get_sort_key(obj, tiebreaker),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                settings.CACHE_REBUILD_LOCK_TIMEOUT * 1000,
+            ] + cls._get_push_args(obj, tiebreaker),
+            client=client,
+        )
+
+    @classmethod
+    def _write_objects(cls, pipeline, key, objects, queryset):
         serialized_list = []
-        for obj in objects:  # 因为传入的是 queryset, 在这里用了 for 循环才是真正触发了数据库的访问
-            serialized_data = DjangoModelSerializer.serialize(obj) # 拿到数据库数据后进行序列化
+        for obj in objects:
+            serialized_data = RedisModelSerializer.serialize(obj) # 拿到数据库数据后进行序列化
             serialized_list.append(serialized_data)
+        # rpush 保证原来的序列顺序, 那么序列也是降序排列
+        pipeline.rpush(key, *serialized_list)  # 把序列化后的数据放入内存
+
+    @classmethod
+    def _read_objects(cls, pipeline, key, limit):
+        pipeline.lrange(key, 0, -1 if limit is None else limit - 1)
 
-        if serialized_list: # rpush 保证原来的序列顺序, 那么序列也是降序排列
-            conn.rpush(key, *serialized_list)  # 把序列化后的数据放入内存
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)  # 这个过期时间如果设置得短, 数据库压力会打一点, 取决于产品
+    @classmethod
+    def _deserialize_objects(cls, serialized_list, queryset):
+        objects = []
+        for serialized_data in serialized_list:
+            deserialized_obj = RedisModelSerializer.deserialize(serialized_data)
+            objects.append(deserialized_obj)
+        return objects
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def _load_objects_to_cache(cls, key, objects, queryset, invalidated, rebuild_ms=None):
+        # invalidated 是开始读数据库之前 cache 被作废过几次
+        # 最多只 cache REDIS_LIST_LENGTH_LIMIT 个 objects
+        # 超过这个限制的 objects, 需要去数据库里读取. 一般这个限制会比较大, 比如 200
+        # 因此翻页翻到 200 的用户访问量会比较少, 从数据库读取也不是大问题
+        objects = objects[:settings.REDIS_LIST_LENGTH_LIMIT]
         conn = RedisClient.get_connection()
+        # 先写到一个临时的 key 里, 再 rename 成真正的 key, 整个过程放在一个 MULTI/EXEC 里
+        # 别人要么读到旧的 list 要么读到新的 list, 不会读到写了一半的, 也不会和别人写的混在一起
+        pipeline = conn.pipeline()
+        if objects:
+            temp_key = CACHE_REBUILD_TEMP_PATTERN.format(
+                key=key,
+                token=uuid.uuid4().hex,
+            )
+            cls._write_objects(pipeline, temp_key, objects, queryset)
+            cls._get_script(REPLACE_IF_NOT_STALE_SCRIPT)(
+                keys=[
+                    temp_key,
+                    TIMELINE_HEAD_PATTERN.format(key=key),
+                    key,
+                    CACHE_INVALIDATED_PATTERN.format(key=key),
+                ],
+                args=[
+                    cls._get_sort_key(objects[0], cls._get_tiebreaker(queryset)),
+                    settings.REDIS_KEY_EXPIRE_TIME,  # 这个过期时间如果设置得短, 数据库压力会打一点, 取决于产品
+                    invalidated or b'',
+                ],
+                client=pipeline,
+            )
+        else:
+            pipeline.delete(key)
+        if rebuild_ms is not None:
+            # 记下这次重建花了多久, 用来决定提前多久 refresh
+            pipeline.set(
+                CACHE_REBUILD_COST_PATTERN.format(key=key),
+                rebuild_ms,
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+        pipeline.execute()
+
+    @classmethod
+    def _rebuild_cache(cls, key, queryset):
+        # single flight: 同一个 key 同一时间只有拿到锁的请求去数据库里重建
+        # 没拿到锁返回 None, 由调用者决定是等一会儿还是直接用旧的数据
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        token = RedisLock.acquire(lock_key, settings.CACHE_REBUILD_LOCK_TIMEOUT * 1000)
+        if token is None:
+            return None
+        try:
+            # 读数据库之前先记下 cache 被作废过几次, 写回去的时候变了就说明读到的数据可能已经旧了
+            invalidated = RedisClient.get_connection().get(
+                CACHE_INVALIDATED_PATTERN.format(key=key),
+            )
+            start = time.perf_counter()
+            # 因为传入的是 queryset, 在这里转成 list 才是真正触发了数据库的访问
+            objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+            rebuild_ms = int((time.perf_counter() - start) * 1000) + 1
+            cls._load_objects_to_cache(key, objects, queryset, invalidated, rebuild_ms)
+        finally:
+            RedisLock.release(lock_key, token)
+        return objects
+
+    @classmethod
+    def _should_refresh_early(cls, ttl_ms, rebuild_ms):
+        # XFetch 算法: 越接近过期, 重建越慢, 提前 refresh 的概率越大
+        # 这样热门的 key 在过期之前就会被某一个请求重建好, 不会在过期的瞬间所有请求一起打到数据库
+        # 1 - random() 的范围是 (0, 1], 避免 log(0)
+        if ttl_ms < 0 or rebuild_ms is None:
+            return False
+        gap = -int(rebuild_ms) * settings.CACHE_EARLY_REFRESH_BETA * math.log(1 - random.random())
+        return gap >= ttl_ms
+
+    @classmethod
+    def _wait_for_rebuild(cls, key, queryset, limit):
+        # 别的请求正在重建, 每隔一小段时间看一下 cache 建好了没有
+        # 等太久的话就直接查数据库, 但是不写 cache, 避免和正在重建的请求写出重复的数据
+        conn = RedisClient.get_connection()
+        deadline = time.monotonic() + settings.CACHE_REBUILD_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+            pipeline = conn.pipeline(transaction=False)
+            pipeline.exists(key)
+            cls._read_objects(pipeline, key, limit)
+            exists, cached = pipeline.execute()
+            if exists:
+                try:
+                    return cls._deserialize_objects(cached, queryset)
+                except SchemaMismatchError:
+                    break
+        objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+        return objects if limit is None else objects[:limit]
+
+    @classmethod
+    def load_objects(cls, key, queryset, limit=None):
+        # limit 表示只取最新的 limit 个 objects, 翻页的时候不需要把整个 list 都反序列化出来
+        # 读 cache 可以走 replica, 重建 cache 还是写到主库
+        key = cls.get_key(key)
+        conn = RedisClient.get_read_connection()
+
+        # 剩余的过期时间, cache 的内容和上次重建花的时间在一次 round trip 里一起取出来
+        # key 不存在的时候 pttl 返回 -2
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.pttl(key)
+        cls._read_objects(pipeline, key, limit)
+        pipeline.get(CACHE_REBUILD_COST_PATTERN.format(key=key))
+        ttl_ms, cached, rebuild_ms = pipeline.execute()
 
         # 如果 cache hit，则直接拿出来，然后返回
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
-        # cache miss
-        cls._load_objects_to_cache(key, queryset) # 从数据库中取出来存取 cache
+        if ttl_ms != -2:
+            if cls._should_refresh_early(ttl_ms, rebuild_ms):
+                objects = cls._rebuild_cache(key, queryset)
+                # 别人已经在 refresh 了, 先用旧的数据
+                if objects is not None:
+                    return objects if limit is None else objects[:limit]
+            try:
+                return cls._deserialize_objects(cached, queryset)
+            except SchemaMismatchError:
+                # model 的字段改过了, cache 里的数据已经读不出来了, 当成 cache miss 重建
+                pass
 
+        # cache miss
         # 转换为 list 的原因是保持返回类型的统一，因为存在 redis 里的数据是 list 的形式
-        return list(queryset)
+        # 同时先转成 list 也可以让写 cache 和返回结果共用同一次数据库查询
+        objects = cls._rebuild_cache(key, queryset)
+        if objects is None:
+            return cls._wait_for_rebuild(key, queryset, limit)
+        return objects if limit is None else objects[:limit]
 
     @classmethod
     def push_object(cls, key, obj, queryset):
+        key = cls.get_key(key)
         conn = RedisClient.get_connection()
-        if not conn.exists(key):
+        result = cls._push(conn, key, obj, cls._get_tiebreaker(queryset))
+        if result in (0, 3):
             # 如果在 cache 中 key 不存在，直接从数据库里 load
             # 就不走单个 push 的方式加到 cache 里了
-            cls._load_objects_to_cache(key, queryset)
-            return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)  # 新的数据使用 lpush, 保证序列是降序排列
\ No newline at end of file
+            cls._rebuild_cache(key, queryset)
+
+    @classmethod
+    def invalidate(cls, key):
+        # 不方便 push 的 cache (比如按时间正序的 list, 或者 object 被修改了) 直接删掉, 下次读的时候重建
+        # 只删掉 key 的话, 删之前已经读了数据库的重建请求还是会把旧的数据写回来
+        # 所以同时把作废的次数加一, 在这之前开始的重建都会被当成旧的数据丢掉, 之后开始的重建不受影响
+        # head 也一起删掉, object 被删除之后新建出来的 cache 里最新的 object 可能比原来的 head 旧
+        key = cls.get_key(key)
+        conn = RedisClient.get_connection()
+        invalidated_key = CACHE_INVALIDATED_PATTERN.format(key=key)
+        pipeline = conn.pipeline()
+        pipeline.delete(key, TIMELINE_HEAD_PATTERN.format(key=key))
+        pipeline.incr(invalidated_key)
+        pipeline.expire(invalidated_key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def push_objects_many(cls, key_to_obj, tiebreaker='id'):
+        # fanout 的时候要给成千上万个 key 各 push 一个 object
+        # 一个一个 push_object 的话每个 key 都要单独和 redis 交互一次
+        # 这里用 pipeline 把命令攒起来, 每 REDIS_PIPELINE_BATCH_SIZE 个 key 才和 redis 交互一次
+        # key 不存在的就直接跳过, 下次读的时候 load_objects 会从数据库里把整个 list 建起来
+        # newsfeed 的 fanout 调用的时候 tiebreaker 是 tweet_id
+        conn = RedisClient.get_connection()
+        items = [(cls.get_key(key), obj) for key, obj in key_to_obj.items()]
+        pushed_count = 0
+        for index in range(0, len(items), settings.REDIS_PIPELINE_BATCH_SIZE):
+            pipeline = conn.pipeline(transaction=False)
+            for key, obj in items[index: index + settings.REDIS_PIPELINE_BATCH_SIZE]:
+                cls._push(pipeline, key, obj, tiebreaker)
+            pushed_count += sum(1 for result in pipeline.execute() if result == 1)
+        return pushed_count
+
+
+class RedisSortedSetHelper(RedisHelper):
+    # 另一种 timeline 的存储方式, 读写 cache 的流程和 RedisHelper 一样, 通过 settings.TIMELINE_BACKEND 选择
+    # list 里存的是整个序列化之后的 object, 同一条 tweet 会在每个粉丝的 newsfeed list 里都存一份
+    # 这里的 sorted set 只存 object 的 id, score 是 created_at 的微秒数
+    # 读的时候再通过 memcached 批量取出 object, 所有人共享同一份 object 的 cache
+    # member 的格式是 {tiebreaker:020d}:{id}, score 相同的时候按照 member 的字典序排
+    # 补齐到 20 位之后字典序就和 tiebreaker 的大小顺序一致了, 和翻页用的 (created_at, tiebreaker) 的顺序相同
+    push_script = ZADD_IF_EXISTS_SCRIPT
+    key_prefix = 'zset:'
+
+    @classmethod
+    def _get_member(cls, obj, tiebreaker):
+        return '{:020d}:{}'.format(getattr(obj, tiebreaker), obj.id)
+
+    @classmethod
+    def _get_push_args(cls, obj, tiebreaker):
+        return [cls._get_score(obj), cls._get_member(obj, tiebreaker)]
+
+    @classmethod
+    def _write_objects(cls, pipeline, key, objects, queryset):
+        tiebreaker = cls._get_tiebreaker(queryset)
+        pipeline.zadd(key, {
+            cls._get_member(obj, tiebreaker): cls._get_score(obj)
+            for obj in objects
+        })
+
+    @classmethod
+    def _read_objects(cls, pipeline, key, limit):
+        pipeline.zrevrange(key, 0, -1 if limit is None else limit - 1)
+
+    @classmethod
+    def _deserialize_objects(cls, members, queryset):
+        object_ids = [int(member.split(b':')[1]) for member in members]
+        id_to_object = MemcachedHelper.get_objects_through_cache(
+            queryset.model,
+            object_ids,
+        )
+        # 已经被删除的 object 不返回
+        return [
+            id_to_object[object_id]
+            for object_id in object_ids
+            if object_id in id_to_object
+        ]
+
+
+def get_timeline_helper():
+    if settings.TIMELINE_BACKEND == 'zset':
+        return RedisSortedSetHelper
+    return RedisHelper
@@ -0,0 +1,34 @@
+import uuid
+
+from utils.redis_client import RedisClient
+
+# 只有 value 还是自己的 token 的时候才删除
+# 如果持有锁的时间超过了 timeout, 锁已经被别人拿走了, 这时候不能把别人的锁删掉
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLock:
+    # 用 SET NX PX 实现的租约锁, 用来保证同一时间只有一个请求去重建同一个 cache
+    # 拿到锁的进程挂掉的话, 锁也会在 timeout 之后自动释放, 不会死锁
+    release_if_owner = None
+
+    @classmethod
+    def acquire(cls, key, timeout_ms):
+        # 拿到锁返回 token, 释放的时候需要用这个 token, 没拿到返回 None
+        conn = RedisClient.get_connection()
+        token = uuid.uuid4().hex
+        if conn.set(key, token, nx=True, px=timeout_ms):
+            return token
+        return None
+
+    @classmethod
+    def release(cls, key, token):
+        conn = RedisClient.get_connection()
+        if cls.release_if_owner is None:
+            cls.release_if_owner = conn.register_script(RELEASE_SCRIPT)
+        return bool(cls.release_if_owner(keys=[key], args=[token]))
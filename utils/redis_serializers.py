@@ -1,6 +1,17 @@
+import datetime
+import zlib
+from functools import lru_cache
+
+import msgpack
+from django.apps import apps
+from django.conf import settings
 from django.core import serializers
+from django.db import models
+from django.utils import timezone
 from utils.json_encoder import JSONEncoder
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
 
 class DjangoModelSerializer:
 
@@ -15,4 +26,103 @@ class DjangoModelSerializer:
     def deserialize(cls, serialized_data):
         # 需要加 .object 来得到原始的 model 类型的 object 数据，要不然得到的数据并不是一个
         # ORM 的 object，而是一个 DeserializedObject 的类型
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class SchemaMismatchError(Exception):
+    # cache 里的数据是按照另一个版本的字段列表序列化的, 读的时候当成 cache miss 重建
+    pass
+
+
+class CompactModelSerializer:
+    # 格式: 1 个字节的版本号 + msgpack 编码的 [app_label.model_name, 字段列表的指纹, 字段值...]
+    # 字段的顺序就是 model 的 concrete_fields 的顺序, 所以不需要像 json 一样把字段名也存下来
+    # 但是加字段, 删字段, 调整字段顺序之后, 旧的 cache 里的值就对不上字段了
+    # 所以同时存一个字段列表的指纹 (attname 列表的 crc32), 对不上的时候抛 SchemaMismatchError
+    # datetime 存成从 1970 年开始的微秒数, 不用每次都去 parse 一个 ISO 格式的字符串
+    # json 格式一定是以 '[' 开头的, 所以版本号不会和已经在 cache 里的 json 数据冲突
+    VERSION = 2
+    HEADER = bytes([VERSION])
+    # 没有指纹的旧版本, 不知道是按照哪个字段列表写的, 也当成 cache miss
+    LEGACY_HEADERS = (bytes([1]),)
+
+    @classmethod
+    def serialize(cls, instance):
+        _, _, _, fingerprint = cls._get_schema(instance._meta.label_lower)
+        values = [instance._meta.label_lower, fingerprint]
+        for field in instance._meta.concrete_fields:
+            values.append(cls._to_primitive(field, getattr(instance, field.attname)))
+        return cls.HEADER + msgpack.packb(values)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if serialized_data[:1] in cls.LEGACY_HEADERS:
+            raise SchemaMismatchError('legacy compact format')
+        label, fingerprint, *values = msgpack.unpackb(serialized_data[1:])
+        model, fields, attnames, schema_fingerprint = cls._get_schema(label)
+        if fingerprint != schema_fingerprint or len(values) != len(fields):
+            raise SchemaMismatchError('fields of {} have changed'.format(label))
+        return model.from_db(
+            None,
+            attnames,
+            [cls._from_primitive(field, value) for field, value in zip(fields, values)],
+        )
+
+    @classmethod
+    def is_compact(cls, serialized_data):
+        return serialized_data[:1] == cls.HEADER \
+            or serialized_data[:1] in cls.LEGACY_HEADERS
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _get_schema(cls, label):
+        # 每个 model 的字段列表是固定的, 算一次之后缓存起来
+        model = apps.get_model(label)
+        fields = model._meta.concrete_fields
+        attnames = [field.attname for field in fields]
+        fingerprint = zlib.crc32(','.join(attnames).encode())
+        return model, fields, attnames, fingerprint
+
+    @classmethod
+    def _to_primitive(cls, field, value):
+        if value is None:
+            return None
+        if isinstance(field, models.DateTimeField):
+            # 整数运算, 不经过 float, 不会丢失微秒的精度
+            delta = value - EPOCH
+            return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        if isinstance(field, models.DateField):
+            return value.toordinal()
+        return value
+
+    @classmethod
+    def _from_primitive(cls, field, value):
+        if value is None:
+            return None
+        if isinstance(field, models.DateTimeField):
+            value = EPOCH + datetime.timedelta(microseconds=value)
+            return value if settings.USE_TZ else timezone.make_naive(value)
+        if isinstance(field, models.DateField):
+            return datetime.date.fromordinal(value)
+        return value
+
+
+class RedisModelSerializer:
+    # 写 cache 用的格式由 settings.REDIS_SERIALIZER 决定, 可以随时切换
+    # 读的时候根据第一个字节判断是哪一种格式, 切换之前写进 cache 的数据也可以正常读出来
+    SERIALIZERS = {
+        'json': DjangoModelSerializer,
+        'compact': CompactModelSerializer,
+    }
+
+    @classmethod
+    def serialize(cls, instance):
+        return cls.SERIALIZERS[settings.REDIS_SERIALIZER].serialize(instance)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode()
+        if CompactModelSerializer.is_compact(serialized_data):
+            return CompactModelSerializer.deserialize(serialized_data)
+        return DjangoModelSerializer.deserialize(serialized_data)
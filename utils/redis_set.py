@@ -0,0 +1,178 @@
+import uuid
+
+from django.conf import settings
+from twitter.cache import (
+    CACHE_REBUILD_LOCK_PATTERN,
+    CACHE_REBUILD_TEMP_PATTERN,
+    REDIS_SET_CHANGED_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.redis_lock import RedisLock
+
+# 空的 set 在 redis 里是存不下来的, 所以每个 set 里都多放一个 0 (id 不会是 0)
+# 这样 key 存在就说明整个 set 已经从数据库里加载进来了
+EMPTY_MEMBER = 0
+
+# set 在 redis 里的时候直接 sadd/srem, ARGV[1] 是 'sadd' 或者 'srem'
+# 不在的时候把变化的次数加一, 正在重建的请求写回去的时候发现次数变了, 就知道自己从数据库里读出来的数据已经旧了
+# 和 RedisHelper.invalidate 一样, 只有在变化之前开始的重建会被丢掉, 之后开始的重建不受影响
+UPDATE_IF_EXISTS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+return -1
+"""
+
+# 重建好的临时 key 原子地 rename 成真正的 key, 重建期间有过变化的话就丢掉
+# KEYS[1] 是临时 key, KEYS[2] 是变化的次数, KEYS[3] 是真正的 key
+# ARGV[2] 是开始读数据库之前变化的次数
+REPLACE_IF_NOT_CHANGED_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '') ~= ARGV[2] then
+    redis.call('del', KEYS[1])
+    return 0
+end
+redis.call('rename', KEYS[1], KEYS[3])
+redis.call('expire', KEYS[3], ARGV[1])
+return 1
+"""
+
+
+class RedisSet:
+    # 把一组 id (比如某个用户所有粉丝的 id) 存成 redis 的 set
+    # 关注和取关的时候用 sadd/srem 增量维护, 不用每次都把整个 set 删掉再从数据库里重建
+    # queryset 是 values_list(..., flat=True) 的 queryset, 只有 set 不在 redis 里的时候才会用到
+    scripts = {}
+
+    @classmethod
+    def _get_script(cls, source):
+        if source not in cls.scripts:
+            conn = RedisClient.get_connection()
+            cls.scripts[source] = conn.register_script(source)
+        return cls.scripts[source]
+
+    @classmethod
+    def _load(cls, key, queryset):
+        # 同一个 key 同一时间只有一个请求去数据库里重建, 没拿到锁的返回 False
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        token = RedisLock.acquire(lock_key, settings.CACHE_REBUILD_LOCK_TIMEOUT * 1000)
+        if token is None:
+            return False
+        try:
+            conn = RedisClient.get_connection()
+            changed_key = REDIS_SET_CHANGED_PATTERN.format(key=key)
+            # 读数据库之前先记下变化的次数
+            changed = conn.get(changed_key) or b''
+            temp_key = CACHE_REBUILD_TEMP_PATTERN.format(key=key, token=uuid.uuid4().hex)
+            # 一批一批地从数据库里读出来写进 redis, 不会一次把所有的 id 都放在内存里
+            members = [EMPTY_MEMBER]
+            for member in queryset.iterator(chunk_size=settings.REDIS_PIPELINE_BATCH_SIZE):
+                members.append(member)
+                if len(members) >= settings.REDIS_PIPELINE_BATCH_SIZE:
+                    conn.sadd(temp_key, *members)
+                    members = []
+            if members:
+                conn.sadd(temp_key, *members)
+            return bool(cls._get_script(REPLACE_IF_NOT_CHANGED_SCRIPT)(
+                keys=[temp_key, changed_key, key],
+                args=[settings.REDIS_KEY_EXPIRE_TIME, changed],
+            ))
+        finally:
+            RedisLock.release(lock_key, token)
+
+    @classmethod
+    def ensure_loaded(cls, key, queryset):
+        # set 在 redis 里的话顺便延长过期时间, 避免 sscan 扫到一半 key 过期了
+        conn = RedisClient.get_connection()
+        if conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME):
+            return True
+        return cls._load(key, queryset)
+
+    @classmethod
+    def _update(cls, command, key, member):
+        return cls._get_script(UPDATE_IF_EXISTS_SCRIPT)(
+            keys=[key, REDIS_SET_CHANGED_PATTERN.format(key=key)],
+            args=[command, member, settings.REDIS_KEY_EXPIRE_TIME],
+        )
+
+    @classmethod
+    def add(cls, key, member):
+        cls._update('sadd', key, member)
+
+    @classmethod
+    def remove(cls, key, member):
+        cls._update('srem', key, member)
+
+    @classmethod
+    def get_members(cls, key, queryset):
+        # 返回整个 set, 延长过期时间和读 set 在一次 round trip 里完成
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.smembers(key)
+        exists, members = pipeline.execute()
+        if not exists:
+            if not cls._load(key, queryset):
+                return set(queryset)
+            members = conn.smembers(key)
+        members = {int(member) for member in members}
+        members.discard(EMPTY_MEMBER)
+        return members
+
+    @classmethod
+    def contains_many(cls, key, members, queryset, member_field):
+        # 返回 members 里在 set 里的那些, smismember 只传这几个成员, 不用把整个 set 读出来
+        # member_field 是 queryset 里成员的字段名, set 没建好的时候只从数据库里查这几个
+        members = [member for member in set(members) if member is not None]
+        if not members:
+            return set()
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.smismember(key, members)
+        exists, flags = pipeline.execute()
+        if not exists:
+            if not cls._load(key, queryset):
+                return set(queryset.filter(**{member_field + '__in': members}))
+            flags = conn.smismember(key, members)
+        return {member for member, flag in zip(members, flags) if flag}
+
+    @classmethod
+    def count(cls, key, queryset):
+        # scard 是 O(1) 的, 不用把整个 set 读出来, 减掉占位的 EMPTY_MEMBER
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.scard(key)
+        exists, size = pipeline.execute()
+        if not exists:
+            if not cls._load(key, queryset):
+                return queryset.count()
+            size = conn.scard(key)
+        return size - 1
+
+    @classmethod
+    def scan_batches(cls, key, queryset, batch_size):
+        # 每次返回 batch_size 个成员, 用 sscan 分批从 redis 里取, 不会一次把整个 set 读出来
+        # set 还没建好 (别人正在建, 或者建的时候有变化) 的时候直接从数据库里分批读
+        if not cls.ensure_loaded(key, queryset):
+            members = queryset.iterator(chunk_size=batch_size)
+        else:
+            conn = RedisClient.get_connection()
+            members = (int(member) for member in conn.sscan_iter(key, count=batch_size))
+
+        # sscan 在 redis rehash 的时候可能会返回重复的成员
+        # 只在同一批里去重, 不能把几百万个粉丝的 id 都记在内存里
+        # 不同批之间偶尔还是会有重复的成员, 调用的地方要能处理 (比如 fanout 的 bulk_create 会忽略已经存在的 newsfeed)
+        batch, batch_members = [], set()
+        for member in members:
+            if member == EMPTY_MEMBER or member in batch_members:
+                continue
+            batch_members.add(member)
+            batch.append(member)
+            if len(batch) >= batch_size:
+                yield batch
+                batch, batch_members = [], set()
+        if batch:
+            yield batch
@@ -0,0 +1,46 @@
+from rest_framework import serializers
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_counters import RedisCounters
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    # 渲染一页 objects 之前, 先让 child serializer 把需要的 cache 数据批量取出来
+    # 使用方法: 在 serializer 的 Meta 里设置 list_serializer_class = PrefetchListSerializer
+
+    def to_representation(self, data):
+        # data 可能是一个 related manager, 比如 source='comment_set' 的情况
+        objects = list(data.all() if hasattr(data, 'all') else data)
+        self.child.prefetch_through_cache(objects)
+        return super().to_representation(objects)
+
+
+class PrefetchThroughCacheMixin:
+    # Meta.cached_objects 描述这个 serializer 需要用到哪些通过 memcached 访问的 object
+    # 比如 {'cached_user': (User, 'user_id')}, 表示用 user_id 取出 User 存到 cached_user 上
+    # 嵌套的 serializer 如果 source 是其中之一, 会继续对下一层的 objects 做 prefetch
+    # Meta.cached_counts 是需要从 redis 计数器里读的字段, 比如 ('likes_count', 'comments_count')
+
+    def prefetch_through_cache(self, objects):
+        cached_objects = getattr(self.Meta, 'cached_objects', {})
+        for to_attr, (model_class, id_attname) in cached_objects.items():
+            MemcachedHelper.prefetch_objects_through_cache(
+                objects,
+                model_class,
+                id_attname,
+                to_attr,
+            )
+
+        RedisCounters.prefetch_counts(
+            objects,
+            getattr(self.Meta, 'cached_counts', ()),
+        )
+
+        for field in self.fields.values():
+            if field.source not in cached_objects:
+                continue
+            if not hasattr(field, 'prefetch_through_cache'):
+                continue
+            field.prefetch_through_cache([
+                getattr(obj, field.source)
+                for obj in objects
+            ])
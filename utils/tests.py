@@ -1,5 +1,90 @@
+import random
+import threading
+import time
+from unittest import mock
+
+import msgpack
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.test import override_settings
+from newsfeeds.models import NewsFeed
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.identity_map import IdentityMap
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
+from twitter.cache import CACHE_REBUILD_COST_PATTERN
+from utils.redis_helper import RedisHelper, RedisSortedSetHelper
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    RedisModelSerializer,
+    SchemaMismatchError,
+)
+
+
+class SlowQuerySet(list):
+    # 模拟一个很慢的数据库查询, 记录一共查了多少次
+    # 数据提前从数据库里读出来, 别的线程里看不到测试的事务里创建的数据
+    def __init__(self, queryset):
+        super().__init__(queryset)
+        self.query = queryset.query
+        self.model = queryset.model
+        self.queries_count = 0
+        self.lock = threading.Lock()
+
+    def __getitem__(self, item):
+        with self.lock:
+            self.queries_count += 1
+        time.sleep(0.05)
+        return super().__getitem__(item)
+
+
+class GrowingQuerySet(SlowQuerySet):
+    # 模拟不断有新的 object 写进数据库, 一开始数据库里是空的
+    # commit_next 按照 created_at 的顺序一个一个写进去
+    def __init__(self, queryset):
+        super().__init__(queryset)
+        self.visible_count = 0
+
+    def commit_next(self):
+        with self.lock:
+            self.visible_count += 1
+            return list.__getitem__(self, len(self) - self.visible_count)
+
+    def __getitem__(self, item):
+        with self.lock:
+            self.queries_count += 1
+            visible = list.__getitem__(self, slice(len(self) - self.visible_count, None))
+        time.sleep(0.005)
+        return visible[item]
+
+
+class SlowModel:
+    objects = None
+
+    def __init__(self, id):
+        self.id = id
+
+
+def run_concurrently(func, threads_count=20):
+    results = [None] * threads_count
+    barrier = threading.Barrier(threads_count)
+
+    def run(index):
+        barrier.wait()
+        results[index] = func(index)
+
+    threads = [
+        threading.Thread(target=run, args=(index,))
+        for index in range(threads_count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
 
 
 class UtilsTests(TestCase):
@@ -16,4 +101,341 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_redis_connection_pool(self):
+        # 多个线程同时拿到的是同一个 client, 共用一个 connection pool
+        RedisClient.conn = None
+        clients = run_concurrently(lambda index: RedisClient.get_connection())
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+        conn = clients[0]
+
+        # 每个线程执行命令的时候都从 pool 里借一个 connection
+        run_concurrently(lambda index: conn.incr('counter'), threads_count=10)
+        self.assertEqual(conn.get('counter'), b'10')
+        stats = RedisClient.get_pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['max_connections'], 50)
+        self.assertGreater(stats[0]['created_connections'], 1)
+        self.assertLessEqual(stats[0]['created_connections'], 10)
+        self.assertEqual(stats[0]['in_use_connections'], 0)
+
+        # 没有配置 replica 的时候读写都走主库
+        self.assertIs(RedisClient.get_read_connection(), conn)
+        with self.settings(REDIS_REPLICAS=[('127.0.0.1', 6379)]):
+            replica = RedisClient.get_read_connection()
+            self.assertIsNot(replica, conn)
+            self.assertEqual(replica.get('counter'), b'10')
+            self.assertEqual(len(RedisClient.get_pool_stats()), 2)
+        RedisClient.replica_conns = None
+
+    @override_settings(REDIS_PIPELINE_BATCH_SIZE=2)
+    def test_push_objects_many(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        newsfeed = NewsFeed.objects.create(user=user, tweet=tweet)
+        for i in range(3):
+            conn.rpush('key{}'.format(i), 'old')
+
+        # key3 不在 cache 里, 跳过不 push, 等读的时候再从数据库里 load
+        key_to_obj = {'key{}'.format(i): newsfeed for i in range(4)}
+        self.assertEqual(RedisHelper.push_objects_many(key_to_obj), 3)
+        for i in range(3):
+            cached_list = conn.lrange('key{}'.format(i), 0, -1)
+            self.assertEqual(len(cached_list), 2)
+            self.assertEqual(cached_list[1], b'old')
+        self.assertEqual(conn.exists('key3'), 0)
+
+    def test_redis_model_serializer(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        newsfeed = NewsFeed.objects.create(user=user, tweet=tweet)
+
+        for obj in [tweet, newsfeed]:
+            serialized_data = RedisModelSerializer.serialize(obj)
+            self.assertEqual(serialized_data[:1], CompactModelSerializer.HEADER)
+            self.assertLess(
+                len(serialized_data),
+                len(DjangoModelSerializer.serialize(obj)),
+            )
+            cached_obj = RedisModelSerializer.deserialize(serialized_data)
+            self.assertEqual(cached_obj, obj)
+            self.assertEqual(cached_obj.created_at, obj.created_at)
+            self.assertEqual(cached_obj.user_id, obj.user_id)
+        self.assertEqual(cached_obj.tweet_id, tweet.id)
+
+        # 切换格式之前写进 cache 的 json 数据也可以读出来
+        serialized_data = DjangoModelSerializer.serialize(tweet)
+        cached_tweet = RedisModelSerializer.deserialize(serialized_data.encode())
+        self.assertEqual(cached_tweet.content, tweet.content)
+        self.assertEqual(cached_tweet.created_at, tweet.created_at)
+        with override_settings(REDIS_SERIALIZER='json'):
+            self.assertEqual(RedisModelSerializer.serialize(tweet), serialized_data)
+
+    def test_compact_serializer_schema_mismatch(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for _ in range(2)]
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at', '-id')
+
+        # 模拟 model 的字段改过之后, cache 里还是按照旧的字段列表写的数据
+        label, fingerprint, *values = msgpack.unpackb(
+            RedisModelSerializer.serialize(tweets[1])[1:],
+        )
+        stale_data = CompactModelSerializer.HEADER + msgpack.packb(
+            [label, fingerprint + 1] + values,
+        )
+        with self.assertRaises(SchemaMismatchError):
+            RedisModelSerializer.deserialize(stale_data)
+        # 没有指纹的旧版本格式也一样
+        with self.assertRaises(SchemaMismatchError):
+            RedisModelSerializer.deserialize(bytes([1]) + msgpack.packb(values))
+
+        # 读到对不上的数据的时候当成 cache miss, 从数据库里重建
+        conn = RedisClient.get_connection()
+        conn.rpush('stale_tweets', stale_data)
+        objects = RedisHelper.load_objects('stale_tweets', queryset)
+        self.assertEqual([obj.id for obj in objects], [tweets[1].id, tweets[0].id])
+        objects = RedisHelper.load_objects('stale_tweets', queryset)
+        self.assertEqual([obj.id for obj in objects], [tweets[1].id, tweets[0].id])
+
+    def test_get_objects_through_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        user_ids = [user.id for user in users]
+        MemcachedHelper.get_object_through_cache(User, user_ids[0])
+
+        # 只有 cache miss 的两个 user 需要查数据库, 而且只用一条 query
+        with self.assertNumQueries(1):
+            id_to_user = MemcachedHelper.get_objects_through_cache(
+                User,
+                user_ids + [user_ids[0], None, -1],
+            )
+        self.assertEqual(set(id_to_user.keys()), set(user_ids))
+        for user in users:
+            self.assertEqual(id_to_user[user.id].username, user.username)
+
+        # 全部 cache hit
+        with self.assertNumQueries(0):
+            id_to_user = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        self.assertEqual(set(id_to_user.keys()), set(user_ids))
+
+        # prefetch 之后访问 cached_user 不需要再访问 cache
+        tweets = [self.create_tweet(user) for user in users]
+        MemcachedHelper.prefetch_objects_through_cache(
+            tweets,
+            User,
+            'user_id',
+            'cached_user',
+        )
+        self.clear_cache()
+        with self.assertNumQueries(0):
+            for tweet, user in zip(tweets, users):
+                self.assertEqual(tweet.cached_user.username, user.username)
+
+    def test_load_objects_single_flight(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user1')
+        for i in range(5):
+            self.create_tweet(user)
+        queryset = SlowQuerySet(
+            Tweet.objects.filter(user=user).order_by('-created_at', '-id'),
+        )
+        tweets = list(queryset)
+
+        # 20 个请求同时 cache miss, 只有一个去数据库里重建, 其他的等重建好了直接读 cache
+        results = run_concurrently(
+            lambda index: RedisHelper.load_objects('key', queryset),
+        )
+        self.assertEqual(queryset.queries_count, 1)
+        for objects in results:
+            self.assertEqual([tweet.id for tweet in objects], [tweet.id for tweet in tweets])
+        self.assertEqual(conn.llen('key'), 5)
+        self.assertEqual(conn.exists('rebuild_lock:key'), 0)
+
+        # 一直等不到重建好的话就直接查数据库, 但是不写 cache
+        conn.delete('key')
+        conn.set('rebuild_lock:key', 'other')
+        with self.settings(CACHE_REBUILD_WAIT_TIMEOUT=0.05):
+            objects = RedisHelper.load_objects('key', queryset, 2)
+        self.assertEqual([tweet.id for tweet in objects], [tweets[0].id, tweets[1].id])
+        self.assertEqual(queryset.queries_count, 2)
+        self.assertEqual(conn.exists('key'), 0)
+
+    def test_load_objects_early_refresh(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user1')
+        for i in range(3):
+            self.create_tweet(user)
+        queryset = SlowQuerySet(
+            Tweet.objects.filter(user=user).order_by('-created_at', '-id'),
+        )
+        tweets = list(queryset)
+        RedisHelper.load_objects('key', queryset)
+        self.assertEqual(queryset.queries_count, 1)
+        cost_key = CACHE_REBUILD_COST_PATTERN.format(key='key')
+        self.assertGreater(int(conn.get(cost_key)), 0)
+
+        # 离过期还很久, 不会 refresh
+        conn.set(cost_key, 100)
+        with mock.patch('utils.redis_helper.random.random', return_value=0.5):
+            RedisHelper.load_objects('key', queryset)
+        self.assertEqual(queryset.queries_count, 1)
+
+        # 快过期了, 提前 refresh, 过期时间也重新算
+        conn.pexpire('key', 50)
+        with mock.patch('utils.redis_helper.random.random', return_value=0.5):
+            objects = RedisHelper.load_objects('key', queryset)
+        self.assertEqual(queryset.queries_count, 2)
+        self.assertEqual([tweet.id for tweet in objects], [tweet.id for tweet in tweets])
+        self.assertGreater(conn.ttl('key'), 50)
+        self.assertEqual(conn.llen('key'), 3)
+
+        # 已经有别人在 refresh 了, 直接用旧的数据
+        conn.pexpire('key', 50)
+        conn.set(cost_key, 100)
+        conn.set('rebuild_lock:key', 'other')
+        with mock.patch('utils.redis_helper.random.random', return_value=0.5):
+            objects = RedisHelper.load_objects('key', queryset, 2)
+        self.assertEqual(queryset.queries_count, 2)
+        self.assertEqual([tweet.id for tweet in objects], [tweets[0].id, tweets[1].id])
+
+    @override_settings(CACHE_REBUILD_WAIT_TIMEOUT=0.05)
+    def test_concurrent_push_and_rebuild(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user1')
+        for i in range(40):
+            self.create_tweet(user)
+        tweets = list(Tweet.objects.filter(user=user).order_by('-created_at', '-id'))
+        # sorted set 的 object 是从 memcached 里取的, 别的线程里访问不到测试的数据库
+        MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id for tweet in tweets])
+
+        for helper in [RedisHelper, RedisSortedSetHelper]:
+            RedisClient.clear()
+            queryset = GrowingQuerySet(
+                Tweet.objects.filter(user=user).order_by('-created_at', '-id'),
+            )
+            loaded_lists = []
+
+            # 一半的线程不断地写入新的 tweet 并 push 到 cache 里
+            # 另一半的线程不断地读, 并且随机删掉 key 模拟过期, 让读和 push 同时触发重建
+            def run(index):
+                rng = random.Random(index)
+                for i in range(10):
+                    if index % 2 == 0:
+                        if i < 8:
+                            tweet = queryset.commit_next()
+                            # 写数据库和 push 之间总会隔一小段时间, 比如 on_commit 的回调
+                            time.sleep(rng.random() * 0.01)
+                            helper.push_object('key', tweet, queryset)
+                        continue
+                    loaded_lists.append(helper.load_objects('key', queryset))
+                    if rng.random() < 0.3:
+                        conn.delete(helper.get_key('key'))
+
+            run_concurrently(run, threads_count=10)
+
+            # 读到的 timeline 里不能有重复, 而且一定是按照 (created_at, id) 倒序的
+            for objects in loaded_lists:
+                sort_keys = [(tweet.created_at, tweet.id) for tweet in objects]
+                self.assertEqual(sort_keys, sorted(set(sort_keys), reverse=True))
+            # 所有的写都结束之后 cache 里的就是最新的 20 个 tweets
+            self.assertEqual(
+                [tweet.id for tweet in helper.load_objects('key', queryset)],
+                [tweet.id for tweet in tweets[:20]],
+            )
+
+    def test_get_object_through_cache_single_flight(self):
+        queries = []
+
+        def get(id):
+            queries.append(id)
+            time.sleep(0.05)
+            return SlowModel(id)
+
+        with mock.patch.object(SlowModel, 'objects', mock.Mock(get=get)):
+            results = run_concurrently(
+                lambda index: MemcachedHelper.get_object_through_cache(SlowModel, 1),
+            )
+        self.assertEqual(queries, [1])
+        self.assertEqual(set(obj.id for obj in results), {1})
+
+    def test_identity_map(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(2)]
+        # 不在请求里的时候没有 identity map, 每次从 memcached 里取出来的都是新的 object
+        self.assertIsNone(IdentityMap.current())
+        self.assertIsNot(
+            MemcachedHelper.get_object_through_cache(User, users[0].id),
+            MemcachedHelper.get_object_through_cache(User, users[0].id),
+        )
+
+        MemcachedHelper.get_objects_through_cache(User, [users[0].id, users[1].id])
+        with IdentityMap.activate() as identity_map:
+            user = MemcachedHelper.get_object_through_cache(User, users[0].id)
+            with self.assertNumQueries(0):
+                id_to_user = MemcachedHelper.get_objects_through_cache(
+                    User,
+                    [users[0].id, users[1].id],
+                )
+            self.assertIs(id_to_user[users[0].id], user)
+            self.assertIs(
+                MemcachedHelper.get_object_through_cache(User, users[1].id),
+                id_to_user[users[1].id],
+            )
+            self.assertEqual((identity_map.hits, identity_map.misses), (2, 2))
+
+            # 同一个用户的 profile 只取一次, 新取出来的 user 上也能直接用
+            profile = user.profile
+            UserService.prefetch_profiles_through_cache(list(id_to_user.values()))
+            self.assertIs(UserService.get_profile_through_cache(users[0].id), profile)
+
+            # 修改之后和 memcached 里的 cache 一起作废
+            users[0].save()
+            profile.save()
+            self.assertIsNot(MemcachedHelper.get_object_through_cache(User, users[0].id), user)
+            self.assertIsNot(UserService.get_profile_through_cache(users[0].id), profile)
+        self.assertIsNone(IdentityMap.current())
+
+    def test_identity_map_returns_mapped_objects(self):
+        user = self.create_user('linghu')
+        get_cached_objects = MemcachedHelper.get_cached_objects
+        get_cached_profiles = UserService.get_cached_profiles
+        with IdentityMap.activate():
+            mapped_user = User.objects.get(id=user.id)
+            mapped_profile = UserProfile.objects.create(user=user)
+
+            # 模拟 async 的请求里, 读 memcached 的过程中别的协程先把同一个 user 和 profile 放进了 identity map
+            def add_user_first(model_class, object_ids):
+                IdentityMap.add(User, user.id, mapped_user)
+                return get_cached_objects(model_class, object_ids)
+
+            def add_profile_first(user_ids):
+                IdentityMap.add(UserProfile, user.id, mapped_profile)
+                return get_cached_profiles(user_ids)
+
+            with mock.patch.object(
+                MemcachedHelper,
+                'get_cached_objects',
+                side_effect=add_user_first,
+            ):
+                id_to_user = MemcachedHelper.get_objects_through_cache(User, [user.id])
+            self.assertIs(id_to_user[user.id], mapped_user)
+
+            # 返回的是 identity map 里的那个, 而不是自己读出来的那个
+            with mock.patch.object(
+                UserService,
+                'get_cached_profiles',
+                side_effect=add_profile_first,
+            ):
+                UserService.prefetch_profiles_through_cache([user])
+            self.assertIs(user.profile, mapped_profile)
+
+    @override_settings(IDENTITY_MAP_STATS_HEADERS=True)
+    def test_identity_map_middleware(self):
+        user, client = self.create_user_and_client('linghu')
+        for _ in range(3):
+            self.create_tweet(user)
+        response = client.get('/api/tweets/', {'user_id': user.id})
+        self.assertEqual(response.status_code, 200)
+        # 同一个作者的三条 tweet, user 和 profile 都是第一次没有命中, 之后都是同一个 object
+        self.assertEqual(response['X-Identity-Map-Misses'], '2')
+        self.assertIsNone(IdentityMap.current())